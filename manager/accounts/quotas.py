@@ -2,7 +2,7 @@ from datetime import datetime
 from typing import Callable, Dict, NamedTuple
 
 from django.core.cache import cache
-from django.db.models import F, Sum
+from django.db.models import F, Max, Sum
 from django.utils import timezone
 
 from accounts.models import Account, AccountTeam, AccountTier, AccountUser
@@ -11,6 +11,7 @@ from jobs.models import Job
 from manager.api.exceptions import AccountQuotaExceeded
 from projects.models.files import File, FileDownloads
 from projects.models.projects import Project
+from projects.models.snapshots import SnapshotFormat
 
 
 class AccountQuota(NamedTuple):
@@ -70,6 +71,26 @@ def bytes_to_gigabytes(value: float) -> float:
     return value / 1073741824.0
 
 
+def snapshots_storage_bytes(account: Account) -> int:
+    """
+    Calculate the storage, in bytes, used by the snapshots of an account's projects.
+
+    Files in snapshots in the `blobs` format are only stored once for each
+    fingerprint so they are only counted once.
+    """
+    files = File.objects.filter(project__account=account, snapshot__isnull=False)
+    zips = files.exclude(snapshot__format=SnapshotFormat.blobs.name).aggregate(
+        storage=Sum("size")
+    )["storage"]
+    blobs = (
+        files.filter(snapshot__format=SnapshotFormat.blobs.name)
+        .values("fingerprint")
+        .annotate(blob_size=Max("size"))
+        .aggregate(storage=Sum("blob_size"))["storage"]
+    )
+    return (zips or 0) + (blobs or 0)
+
+
 class AccountQuotas:
     """List of account quotas."""
 
@@ -133,12 +154,7 @@ class AccountQuotas:
 
     STORAGE_SNAPSHOTS = AccountQuota(
         "storage_snapshots",
-        lambda account: bytes_to_gigabytes(
-            File.objects.filter(
-                project__account=account, snapshot__isnull=False
-            ).aggregate(storage=Sum("size"))["storage"]
-            or 0
-        ),
+        lambda account: bytes_to_gigabytes(snapshots_storage_bytes(account)),
         "Snapshot storage limit has been reached."
         "Please upgrade the plan for the account.",
     )
@@ -63,6 +63,7 @@ class JobAdmin(admin.ModelAdmin):
         "anon_users",
         "worker",
         "retries",
+        "children_status",
         "callback_type",
         "callback_id",
         "callback_method",
@@ -155,6 +155,7 @@ class JobCreateSerializer(JobRetrieveSerializer):
             "users",
             "retries",
             "worker",
+            "children_status",
         ]
 
     project = serializers.HiddenField(
@@ -191,7 +192,15 @@ class JobUpdateSerializer(JobRetrieveSerializer):
     class Meta:
         model = Job
         exclude = ["secrets"]
-        read_only_fields = ["creator", "created", "method", "params", "zone", "queue"]
+        read_only_fields = [
+            "creator",
+            "created",
+            "method",
+            "params",
+            "zone",
+            "queue",
+            "children_status",
+        ]
 
 
 class ZoneSerializer(serializers.ModelSerializer):
@@ -3,6 +3,7 @@ import os
 import re
 from typing import List, Optional
 
+from django.db import transaction
 from django.utils import timezone
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import (
@@ -15,6 +16,7 @@ from rest_framework import (
     viewsets,
 )
 from rest_framework.decorators import action
+from rest_framework.generics import get_object_or_404
 from rest_framework.request import Request
 from rest_framework.response import Response
 
@@ -273,11 +275,39 @@ class JobsViewSet(mixins.UpdateModelMixin, viewsets.GenericViewSet):
 
         This action is intended only to be used by the `overseer` service
         for it to update the details of a job based on events
-        from the job queue.
+        from the job queue. Returns any part of the update that was deferred
+        and which should be sent again (see `defer_log`).
         """
-        job = self.get_object()
-        job.update(data=request.data)
-        return Response()
+        with transaction.atomic():
+            # Lock the job so that concurrent updates to it are serialized
+            job = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            data, retry = job.defer_log(request.data)
+            job.update(data=data)
+        return Response(dict(retry=retry) if retry else None)
+
+    @swagger_auto_schema(responses={200: "OK"})
+    @action(detail=False, methods=["POST"])
+    def updates(self, request: Request) -> Response:
+        """
+        Update several jobs.
+
+        This action is intended only to be used by the `overseer` service
+        when batching updates. Receives an ordered array of updates, each
+        with the `id` of the job and the fields to update.
+        Returns any updates that were deferred and which should
+        be sent again.
+        """
+        updates = request.data
+        if not isinstance(updates, list) or not all(
+            isinstance(update, dict) and str(update.get("id", "")).isdigit()
+            for update in updates
+        ):
+            raise exceptions.ValidationError(
+                "Expected an array of objects each with an integer `id`."
+            )
+
+        retry = Job.update_many(updates)
+        return Response(dict(retry=retry) if retry else None)
 
 
 class WorkersViewSet(viewsets.GenericViewSet):
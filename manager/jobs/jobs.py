@@ -5,6 +5,8 @@ Defines three functions involved in a job's lifecycle:
 
 - `dispatch_job` - send a job to a queue
 - `update_job` - update the status of a job by checking it's (intermediate) result
+- `update_jobs` - apply a batch of updates to several jobs at once
+- `complete_jobs` - get the results of succeeded jobs and run their callbacks
 - `check_job` - for a parent job, trigger any child jobs, and / or update it's status
 - `cancel_job` - remove job from the queue, or terminate it if already started
 
@@ -12,11 +14,16 @@ Defines three functions involved in a job's lifecycle:
 import datetime
 import logging
 import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
 
 from celery import Celery, signature
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 from celery.result import AsyncResult
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import Count, Q
 from django.utils import timezone
 
 from jobs.models import Job, JobMethod, JobStatus, Queue, Worker
@@ -71,6 +78,18 @@ def dispatch_job(job: Job) -> Job:
                 # Dispatch all child jobs simultaneously
                 for child in children:
                     dispatch_job(child)
+            elif job.method == JobMethod.dag.value:
+                # Dispatch all child jobs that have no dependencies; others
+                # will be status WAITING and will get dispatched later, on update
+                # of the parent, once all of their dependencies have succeeded.
+                dependencies = get_dependencies(children)
+                for child in children:
+                    if dependencies[child.id]:
+                        child.is_active = True
+                        child.status = JobStatus.WAITING.value
+                        child.save()
+                    else:
+                        dispatch_job(child)
             else:
                 # Dispatch the first child; subsequent children
                 # will be status WAITING and will get dispatched later
@@ -83,8 +102,16 @@ def dispatch_job(job: Job) -> Job:
                         child.status = JobStatus.WAITING.value
                         child.save()
 
+            # Record the counts of child statuses so that the status of this job
+            # can be updated as those change without querying all children
+            job.children_status = count_states(children)
+
             job.is_active = True
             job.status = JobStatus.DISPATCHED.value
+    elif job.has_ended:
+        # Job was completed without needing a worker
+        # (e.g. a `pin` job resolved from the cache)
+        return job
     else:
         # Find queues that have active workers on them
         # order by descending priority
@@ -142,54 +169,38 @@ def dispatch_job(job: Job) -> Job:
     return job
 
 
-def update_job(job: Job, data={}, force: bool = False) -> Job:
+def update_job(
+    job: Job, data={}, force: bool = False, update_parent: bool = True
+) -> Job:
     """
     Update a job.
 
     This method is triggered by a PATCH request from the
     `overseer` service. It updates the status, and other fields of
-    the job, and if the job has a parent, updates it's status too.
+    the job, and if the job has a parent, and the job's state has changed,
+    updates the parent's counts of child states and it's status too.
 
     See https://stackoverflow.com/a/38267978 for important considerations
     in using AsyncResult.
+
+    Set `update_parent` to `False` to skip updating the job's parent
+    (e.g. when the caller will update it later, as in `update_jobs`).
     """
     # Avoid unnecessary update
     if not job.is_active and not force:
         return job
 
     was_active = job.is_active
+    old_state = child_state(job)
 
     if JobMethod.is_compound(job.method):
-        # Update the status of compound jobs based on children
-        status = job.status
-        is_active = False
-        all_previous_succeeded = True
-        any_previous_failed = False
-        for child in job.get_children():
-            # If the child has a 'higher' status then update the
-            # status of the compound job
-            status = JobStatus.highest([status, child.status])
-
-            # If the child is still waiting then...
-            if child.status == JobStatus.WAITING.value:
-                # If all previous have succeeded, dispatch it
-                if all_previous_succeeded:
-                    dispatch_job(child)
-                # If any previous have failed, cancel it
-                elif any_previous_failed:
-                    cancel_job(child)
-
-            if child.status != JobStatus.SUCCESS.value:
-                all_previous_succeeded = False
-            if child.status == JobStatus.FAILURE.value:
-                any_previous_failed = True
-
-            # If the child is still active then the compound job is active
-            if child.is_active:
-                is_active = True
-
-        job.is_active = is_active
-        job.status = JobStatus.RUNNING.value if is_active else status
+        # Update the status of compound jobs based on the counts
+        # of the statuses of its children (counting them if this
+        # has not been done yet e.g. for jobs dispatched before these
+        # counts were recorded)
+        if job.children_status is None:
+            job.children_status = count_states(job.get_children())
+        aggregate_job(job)
 
     else:
         status = data.get("status")
@@ -201,6 +212,14 @@ def update_job(job: Job, data={}, force: bool = False) -> Job:
         if JobStatus.rank(status) < JobStatus.rank(job.status):
             return job
 
+        # Append any batch of log entries to the job's log (a batch that
+        # can not be appended yet should have been split off using `defer_log`)
+        data = dict(data)
+        if "log_seq" in data:
+            log = append_log(job.log, data.pop("log_seq"), data.pop("log", []))
+            if log is not None:
+                job.log = log
+
         # Update fields sent by `overseer` service, including `status`
         for key, value in data.items():
             setattr(job, key, value)
@@ -209,35 +228,32 @@ def update_job(job: Job, data={}, force: bool = False) -> Job:
             return AsyncResult(str(job.id), app=app)
 
         # If job succeeded then get the result if we haven't already
+        # (unless that is deferred to `complete_jobs`)
+        deferred = False
         if status == JobStatus.SUCCESS.value and job.result is None:
-            response = None
-            attempts = 0
-            while not response and attempts < 5:
-                try:
-                    response = async_result().get(timeout=30)
-                except Exception:
-                    # Catch all errors, but log them. Occasional
-                    # errors encountered in prod include ResponseError and TimeoutError
-                    logger.warning(
-                        "Error getting async result",
-                        exc_info=True,
-                        extra=dict(id=job.id, method=job.method, attempts=attempts),
-                    )
-                    time.sleep(1)
-                    attempts += 1
+            if settings.JOB_RESULTS_ASYNC:
+                from jobs.tasks import complete_jobs as complete_jobs_task
 
-            if response:
-                job.result = response.get("result")
-                job.log = response.get("log")
+                deferred = True
+                transaction.on_commit(lambda: complete_jobs_task.delay())
             else:
-                logger.error(
-                    "Unable to get async result",
-                    extra=dict(id=job.id, method=job.method, attempts=attempts),
-                )
-                job.status = JobStatus.FAILURE.value
-                job.error = dict(
-                    type="RuntimeError", message="Unable to get result of job"
-                )
+                response = None
+                attempts = 0
+                while not response and attempts < 5:
+                    try:
+                        response = async_result().get(timeout=30)
+                    except Exception:
+                        # Catch all errors, but log them. Occasional
+                        # errors encountered in prod include ResponseError and TimeoutError
+                        logger.warning(
+                            "Error getting async result",
+                            exc_info=True,
+                            extra=dict(id=job.id, method=job.method, attempts=attempts),
+                        )
+                        time.sleep(1)
+                        attempts += 1
+
+                set_result(job, response)
 
         # If job failed then get the error
         # For FAILURE, `info` is the raised Exception
@@ -247,7 +263,7 @@ def update_job(job: Job, data={}, force: bool = False) -> Job:
                 job.error = dict(type=type(info).__name__, message=str(info))
 
         # If the job has just ended then mark it as inactive
-        if JobStatus.has_ended(status):
+        if JobStatus.has_ended(status) and not deferred:
             job.is_active = False
 
     # If the job is no longer active clear its secrets and run its callback
@@ -259,13 +275,513 @@ def update_job(job: Job, data={}, force: bool = False) -> Job:
     job.save()
 
     # If the job has a parent then update it too
-    if job.parent:
-        update_job(job.parent)
+    if job.parent_id and update_parent:
+        update_parent_job(job.parent_id, state_changes(old_state, child_state(job)))
+
+    return job
+
+
+def child_state(job: Job) -> Optional[str]:
+    """
+    Get the state of a job, as counted by its parent.
+
+    This is the job's status, except for jobs that have ended but
+    are still active (i.e. their result is still to be fetched by `complete_jobs`)
+    which are counted as `RUNNING`.
+    """
+    if job.is_active and JobStatus.has_ended(job.status):
+        return JobStatus.RUNNING.value
+    return job.status
+
+
+def count_states(children) -> Dict[str, int]:
+    """Count the number of child jobs in each state."""
+    states = (child_state(child) for child in children)
+    return dict(Counter(state for state in states if state))
+
+
+def state_changes(old: Optional[str], new: Optional[str]) -> Counter:
+    """Get the changes in counts of child states for a single child."""
+    changes: Counter = Counter()
+    if old != new:
+        if old:
+            changes[old] -= 1
+        if new:
+            changes[new] += 1
+    return changes
+
+
+def aggregate_job(job: Job) -> Job:
+    """
+    Update the status of a compound job from the counts of the states of its children.
+
+    For series jobs, dispatches the next waiting child if all previous children
+    have succeeded, or cancels all waiting children if any have failed
+    (or otherwise ended without succeeding). Only the next waiting child is
+    queried so the cost of each update is independent of the number of children.
+    For `dag` jobs, see `advance_dag`.
+    """
+    counts: Counter = Counter(job.children_status or {})
+
+    def total(predicate) -> int:
+        return sum(count for state, count in counts.items() if predicate(state))
+
+    waiting = JobStatus.WAITING.value
+    if job.method == JobMethod.dag.value:
+        advance_dag(job, counts)
+    while job.method == JobMethod.series.value and counts[waiting] > 0:
+        if total(
+            lambda state: JobStatus.has_ended(state)
+            and state != JobStatus.SUCCESS.value
+        ):
+            for child in job.children.filter(status=waiting):
+                cancel_job(child, update_parent=False)
+            counts[JobStatus.CANCELLED.value] += counts[waiting]
+            counts[waiting] = 0
+        elif not total(
+            lambda state: state != waiting and not JobStatus.has_ended(state)
+        ):
+            child = job.children.filter(status=waiting).order_by("id").first()
+            if child is None:
+                counts[waiting] = 0
+                break
+            dispatch_job(child)
+            counts[waiting] -= 1
+            counts[child_state(child)] += 1
+        else:
+            break
+
+    job.children_status = {state: count for state, count in counts.items() if count}
+
+    is_active = total(lambda state: not JobStatus.has_ended(state)) > 0
+    job.is_active = is_active
+    job.status = (
+        JobStatus.RUNNING.value
+        if is_active
+        else JobStatus.highest(
+            [state for state, count in counts.items() if count] or [job.status]
+        )
+    )
+    return job
+
+
+def get_dependencies(children: List[Job]) -> Dict[int, Set[int]]:
+    """
+    Get the dependencies of each of the children of a `dag` job.
+
+    Checks that dependencies are only on siblings and that there are
+    no cycles (using Kahn's topological sort algorithm), so that
+    every child will eventually be dispatched.
+    """
+    ids = {child.id for child in children}
+    dependencies: Dict[int, Set[int]] = {id: set() for id in ids}
+    for child_id, dependency_id in Job.dependencies.through.objects.filter(
+        from_job__in=ids
+    ).values_list("from_job_id", "to_job_id"):
+        if dependency_id not in ids:
+            raise ValueError(
+                "Job {} depends on job {} which is not a sibling".format(
+                    child_id, dependency_id
+                )
+            )
+        dependencies[child_id].add(dependency_id)
+
+    remaining = {id: set(deps) for id, deps in dependencies.items()}
+    ready = [id for id, deps in remaining.items() if not deps]
+    while ready:
+        id = ready.pop()
+        del remaining[id]
+        for other, deps in remaining.items():
+            if id in deps:
+                deps.remove(id)
+                if not deps:
+                    ready.append(other)
+    if remaining:
+        raise ValueError(
+            "Job dependencies have a cycle involving jobs {}".format(
+                sorted(remaining.keys())
+            )
+        )
+
+    return dependencies
+
+
+def advance_dag(job: Job, counts: Counter) -> None:
+    """
+    Dispatch, or cancel, the waiting children of a `dag` job.
+
+    Dispatches every waiting child whose dependencies have all succeeded
+    (and have been completed i.e. their callbacks have been run), and cancels
+    any waiting child that has a dependency that has failed (or otherwise ended
+    without succeeding). Repeats until there are no more changes
+    because cancellations propagate to dependants, and children
+    that are empty compound jobs succeed as soon as they are dispatched.
+    Updates `counts` in place.
+    """
+    waiting = JobStatus.WAITING.value
+    unsuccessful = [
+        status.value
+        for status in JobStatus
+        if JobStatus.has_ended(status.value) and status != JobStatus.SUCCESS
+    ]
+
+    changed = True
+    while changed and counts[waiting] > 0:
+        changed = False
+        children = job.children.filter(status=waiting).annotate(
+            dependencies_count=Count("dependencies", distinct=True),
+            dependencies_succeeded=Count(
+                "dependencies",
+                filter=Q(
+                    dependencies__status=JobStatus.SUCCESS.value,
+                    dependencies__is_active=False,
+                ),
+                distinct=True,
+            ),
+            dependencies_unsuccessful=Count(
+                "dependencies",
+                filter=Q(dependencies__status__in=unsuccessful),
+                distinct=True,
+            ),
+        )
+        for child in children.order_by("id"):
+            if child.dependencies_unsuccessful > 0:
+                cancel_job(child, update_parent=False)
+            elif child.dependencies_succeeded == child.dependencies_count:
+                dispatch_job(child)
+            else:
+                continue
+
+            state = child_state(child)
+            counts[waiting] -= 1
+            counts[state] += 1
+            if state and JobStatus.has_ended(state):
+                changed = True
+
+
+def add_child_job(parent: Job, child: Job) -> Job:
+    """
+    Add a child to a compound job that has already been dispatched, and dispatch it.
+
+    Used by callbacks that find that more needs to be done before the parent
+    has finished (e.g. uploading the blobs of a snapshot that are not yet stored).
+    The parent's counts of child states are updated so that it does not
+    end until the new child does.
+    """
+    child.parent = parent
+    dispatch_job(child)
+    update_parent_job(parent.id, state_changes(None, child_state(child)))
+    return child
+
+
+def update_parent_job(parent_id: int, changes: Counter) -> None:
+    """
+    Update a compound job given changes in the states of its children.
 
+    The parent job is locked while its counts are updated so that concurrent
+    updates of sibling jobs do not clobber each other.
+    """
+    changes = Counter({state: count for state, count in changes.items() if count})
+    if not changes:
+        return
+
+    with transaction.atomic():
+        parent = Job.objects.select_for_update().get(id=parent_id)
+        # If there are no counts yet, then `update_job` will count the children
+        # (which will already reflect these changes)
+        if parent.children_status is not None:
+            counts: Counter = Counter(parent.children_status)
+            counts.update(changes)
+            parent.children_status = dict(counts)
+        update_job(parent)
+
+
+def set_result(job: Job, response: Optional[Dict]) -> Job:
+    """
+    Set the result and log of a succeeded job from the response of the worker.
+
+    If there is no response, the job is marked as failed.
+    """
+    if response:
+        job.result = response.get("result")
+        job.log = response.get("log")
+    else:
+        logger.error(
+            "Unable to get async result", extra=dict(id=job.id, method=job.method),
+        )
+        job.status = JobStatus.FAILURE.value
+        job.error = dict(type="RuntimeError", message="Unable to get result of job")
     return job
 
 
-def cancel_job(job: Job) -> Job:
+def complete_jobs(
+    batch_size: int = 100, timeout: float = 30, expiry: Optional[float] = None
+) -> int:
+    """
+    Complete jobs that have succeeded but whose results have not yet been fetched.
+
+    This function is called by the `complete_jobs` task in the `assistant`
+    when `settings.JOB_RESULTS_ASYNC` is true. It gets the results of
+    batches of jobs with a single multi-key fetch from the result backend
+    (e.g. Redis `MGET`), marks the jobs as inactive, runs their callbacks
+    and updates their parents.
+
+    Results are fetched before any rows are locked so that updates to the jobs
+    (e.g. from the `overseer`) are not blocked while waiting for the result backend.
+    Then only the jobs with results are locked, skipping those that are already
+    locked, so that several tasks can run concurrently without completing
+    the same job twice. Jobs without results are left active to be completed
+    by a later run (e.g. of the periodic task created in the `jobs` migrations)
+    unless their result has not been available for `expiry` seconds since they
+    were last updated (defaulting to `settings.JOB_RESULTS_EXPIRY`), in which case
+    they are failed.
+
+    Returns the number of jobs completed.
+    """
+    if expiry is None:
+        expiry = settings.JOB_RESULTS_EXPIRY
+    expired = timezone.now() - datetime.timedelta(seconds=expiry)
+
+    completed = 0
+    last_id = 0
+    while True:
+        candidates = list(
+            Job.objects.filter(
+                id__gt=last_id,
+                status=JobStatus.SUCCESS.value,
+                is_active=True,
+                result__isnull=True,
+            )
+            .exclude(
+                method__in=[
+                    JobMethod.parallel.value,
+                    JobMethod.series.value,
+                    JobMethod.dag.value,
+                ]
+            )
+            .order_by("id")
+            .values_list("id", "updated")[:batch_size]
+        )
+        if not candidates:
+            return completed
+        last_id = candidates[-1][0]
+
+        responses = {}
+        timed_out = False
+        try:
+            for task_id, meta in app.backend.get_many(
+                [str(id) for id, updated in candidates], timeout=timeout
+            ):
+                if meta.get("status") == JobStatus.SUCCESS.value:
+                    responses[int(task_id)] = meta.get("result")
+        except CeleryTimeoutError:
+            timed_out = True
+            logger.warning(
+                "Timed out getting async results",
+                extra=dict(
+                    ids=[id for id, updated in candidates if id not in responses]
+                ),
+            )
+
+        # Jobs are only failed for want of a result if the backend responded
+        ids = [
+            id
+            for id, updated in candidates
+            if id in responses or (updated < expired and not timed_out)
+        ]
+        if not ids:
+            continue
+
+        with transaction.atomic():
+            jobs = list(
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(
+                    id__in=ids,
+                    status=JobStatus.SUCCESS.value,
+                    is_active=True,
+                    result__isnull=True,
+                )
+                .order_by("id")
+            )
+
+            changes: Dict[int, Counter] = defaultdict(Counter)
+            for job in jobs:
+                old_state = child_state(job)
+                set_result(job, responses.get(job.id))
+                job.is_active = False
+                job.secrets = None
+                job.run_callback()
+                job.save()
+
+                if job.parent_id:
+                    changes[job.parent_id].update(
+                        state_changes(old_state, child_state(job))
+                    )
+
+            for parent_id in sorted(changes.keys()):
+                update_parent_job(parent_id, changes[parent_id])
+
+            completed += len(jobs)
+
+
+def collapse_updates(updates: List[Dict]) -> Tuple[Dict[str, Dict], List[Dict]]:
+    """
+    Collapse an ordered list of job updates into one update per job.
+
+    Each update is a dictionary with the `id` of the job and the fields to
+    update. Later updates for a job override fields of earlier ones
+    except when they have a lower ranked status (these are ignored
+    entirely, consistent with `update_job`), and batches of log entries,
+    which are combined. Jobs are kept in the order in
+    which they first appear.
+
+    Batches of log entries may arrive in any order. If two batches for a job
+    can not be combined (because entries between them are missing) the later
+    batch is deferred. Returns the collapsed updates and the deferred updates.
+    """
+    collapsed: Dict[str, Dict] = {}
+    deferred: List[Dict] = []
+    for update in updates:
+        data = dict(update)
+        id = str(data.pop("id"))
+
+        existing = collapsed.get(id)
+        if existing is None:
+            collapsed[id] = data
+            continue
+
+        status = data.get("status")
+        if status and JobStatus.rank(status) < JobStatus.rank(
+            existing.get("status", "")
+        ):
+            continue
+
+        # Combine batches of log entries, in order of their sequence numbers
+        if "log_seq" in data and "log" in existing:
+            (seq, first), (later_seq, later) = sorted(
+                [
+                    (existing.get("log_seq", 0), existing["log"]),
+                    (data["log_seq"], data.get("log", [])),
+                ],
+                key=lambda batch: batch[0],
+            )
+            log = append_log(first, later_seq - seq, later)
+            if log is None:
+                deferred.append(
+                    dict(
+                        id=update["id"],
+                        status=data.get("status", existing.get("status")),
+                        log=later,
+                        log_seq=later_seq,
+                    )
+                )
+                log = first
+            data["log"] = log
+            if "log_seq" in existing:
+                data["log_seq"] = seq
+            else:
+                del data["log_seq"]
+
+        existing.update(data)
+    return collapsed, deferred
+
+
+def append_log(log: Optional[List], seq: int, entries: List) -> Optional[List]:
+    """
+    Append a batch of log entries to a job's log.
+
+    Workers send log entries in batches, along with `seq`, the index of the
+    first entry of the batch in the complete log. Entries that are already in
+    the log (e.g. because a batch was received twice) are skipped. Returns `None`
+    if the batch can not be appended yet because entries before it are missing
+    (e.g. because an earlier batch has not been received yet).
+    """
+    log = list(log or [])
+    if seq > len(log):
+        return None
+    return log + entries[len(log) - seq :]
+
+
+def defer_log(job: Job, data: Dict) -> Tuple[Dict, List[Dict]]:
+    """
+    Split off a batch of log entries that can not be appended to a job's log yet.
+
+    Requests from the `overseer` are sent concurrently, retried and replayed so
+    batches of log entries can arrive out of order. Rather than appending a batch
+    with entries missing before it, it is returned so that the `overseer` can send
+    it again later. Batches for jobs that have ended are not deferred because
+    their complete log is set when their result is fetched.
+    Returns the update without the batch, and the deferred updates (if any).
+    """
+    if (
+        "log_seq" in data
+        and job.is_active
+        and not JobStatus.has_ended(job.status)
+        and data["log_seq"] > len(job.log or [])
+    ):
+        data = dict(data)
+        deferred = dict(
+            id=job.id,
+            status=data.get("status"),
+            log=data.pop("log", []),
+            log_seq=data.pop("log_seq"),
+        )
+        return data, [deferred]
+    return data, []
+
+
+def update_jobs(updates: List[Dict]) -> List[Dict]:
+    """
+    Update several jobs.
+
+    This method is triggered by a POST request from the `overseer`
+    service when it is batching job updates. The updates are collapsed
+    (see `collapse_updates`) and applied within a single transaction.
+    Each job's update has its own savepoint so that an error updating
+    one job does not prevent the others from being updated.
+    Parents are updated once, after all their children in the batch,
+    rather than once for every child update.
+
+    Returns the updates that were deferred (see `defer_log`) and which
+    should be sent again.
+    """
+    collapsed, deferred = collapse_updates(updates)
+
+    with transaction.atomic():
+        jobs = Job.objects.select_for_update().in_bulk(list(collapsed.keys()))
+
+        changes: Dict[int, Counter] = defaultdict(Counter)
+        for id, data in collapsed.items():
+            job = jobs.get(int(id))
+            if job is None:
+                logger.warning("Job to update was not found", extra=dict(id=id))
+                continue
+
+            data, later = defer_log(job, data)
+            deferred += later
+
+            old_state = child_state(job)
+            try:
+                with transaction.atomic():
+                    update_job(job, data, update_parent=False)
+            except Exception:
+                logger.error(
+                    "Error updating job", exc_info=True, extra=dict(id=id, data=data)
+                )
+                continue
+
+            if job.parent_id:
+                changes[job.parent_id].update(
+                    state_changes(old_state, child_state(job))
+                )
+
+        for parent_id in sorted(changes.keys()):
+            update_parent_job(parent_id, changes[parent_id])
+
+    return deferred
+
+
+def cancel_job(job: Job, update_parent: bool = True) -> Job:
     """
     Cancel a job.
 
@@ -274,15 +790,22 @@ def cancel_job(job: Job) -> Job:
     one task per process.
     See `worker/worker.py` for the reasoning for using `SIGUSR1`.
     See https://docs.celeryproject.org/en/stable/userguide/workers.html#revoke-revoking-tasks
+
+    Set `update_parent` to `False` to skip updating the job's parent
+    (e.g. when the parent is itself being cancelled).
     """
     if job.is_active:
+        old_state = child_state(job)
         if JobMethod.is_compound(job.method):
             for child in job.children.all():
-                cancel_job(child)
+                cancel_job(child, update_parent=False)
         else:
             app.control.revoke(str(job.id), terminate=True, signal="SIGUSR1")
         job.status = JobStatus.CANCELLED.value
         job.is_active = False
         job.secrets = None
         job.save()
+
+        if job.parent_id and update_parent:
+            update_parent_job(job.parent_id, state_changes(old_state, job.status))
     return job
@@ -1,7 +1,24 @@
+import datetime
+from unittest import mock
+
 import pytest
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from django.utils import timezone
 
-from accounts.models import Account
-from jobs.jobs import dispatch_job
+from accounts.models import Account, AccountTier
+from jobs.jobs import (
+    add_child_job,
+    aggregate_job,
+    append_log,
+    cancel_job,
+    collapse_updates,
+    complete_jobs,
+    defer_log,
+    dispatch_job,
+    state_changes,
+    update_job,
+    update_jobs,
+)
 from jobs.models import Job, JobStatus
 
 
@@ -47,3 +64,268 @@ def test_dispatch_series():
     assert children[0].status == JobStatus.DISPATCHED.value
     assert children[1].status is None
     assert children[2].status is None
+
+
+def test_collapse_updates():
+    collapsed, deferred = collapse_updates(
+        [
+            dict(id=1, status="RECEIVED", worker="w1"),
+            dict(id=2, status="STARTED"),
+            dict(id=1, status="STARTED", began="2021-01-01T00:00:00Z"),
+            dict(id=1, status="RUNNING", log=[dict(level=2, message="Hello")]),
+            dict(id=2, status="SUCCESS", runtime=1.5),
+            # Lower rank than existing status so ignored
+            dict(id=2, status="RUNNING", log=[]),
+        ]
+    )
+
+    assert list(collapsed.keys()) == ["1", "2"]
+    assert collapsed["1"] == dict(
+        status="RUNNING",
+        worker="w1",
+        began="2021-01-01T00:00:00Z",
+        log=[dict(level=2, message="Hello")],
+    )
+    assert collapsed["2"] == dict(status="SUCCESS", runtime=1.5)
+    assert deferred == []
+
+
+def test_collapse_updates_logs():
+    a, b, c, d = [dict(message=message) for message in "abcd"]
+    collapsed, deferred = collapse_updates(
+        [
+            dict(id=1, status="RUNNING", log=[a, b], log_seq=0),
+            dict(id=1, status="RUNNING", log=[c], log_seq=2),
+            dict(id=2, status="RUNNING", log=[a]),
+            dict(id=2, status="RUNNING", log=[b, c], log_seq=1),
+            dict(id=3, status="RUNNING", log=[c], log_seq=2),
+            dict(id=3, status="RUNNING", log=[c, d], log_seq=2),
+            # Out of order
+            dict(id=4, status="RUNNING", log=[c, d], log_seq=2),
+            dict(id=4, status="RUNNING", log=[b], log_seq=1),
+            # Out of order, with a gap
+            dict(id=5, status="RUNNING", log=[d], log_seq=3),
+            dict(id=5, status="RUNNING", log=[b], log_seq=1),
+        ]
+    )
+    assert collapsed["1"] == dict(status="RUNNING", log=[a, b, c], log_seq=0)
+    assert collapsed["2"] == dict(status="RUNNING", log=[a, b, c])
+    assert collapsed["3"] == dict(status="RUNNING", log=[c, d], log_seq=2)
+    assert collapsed["4"] == dict(status="RUNNING", log=[b, c, d], log_seq=1)
+    assert collapsed["5"] == dict(status="RUNNING", log=[b], log_seq=1)
+    assert deferred == [dict(id=5, status="RUNNING", log=[d], log_seq=3)]
+
+
+def test_append_log():
+    a, b, c = [dict(message=message) for message in "abc"]
+    assert append_log(None, 0, [a]) == [a]
+    assert append_log([a], 1, [b, c]) == [a, b, c]
+    # Already received entries are skipped
+    assert append_log([a, b], 1, [b, c]) == [a, b, c]
+    assert append_log([a, b], 0, [a]) == [a, b]
+    # Not appended if some are missing
+    assert append_log([a], 2, [c]) is None
+
+
+@pytest.mark.django_db
+def test_update_job_log():
+    job = Job.objects.create(method="sleep", is_active=True)
+    a, b, c = [dict(message=message) for message in "abc"]
+
+    update_job(job, dict(status="RUNNING", log=[a, b], log_seq=0))
+    update_job(job, dict(status="RUNNING", log=[c], log_seq=2))
+    job.refresh_from_db()
+    assert job.log == [a, b, c]
+
+
+@pytest.mark.django_db
+def test_update_jobs_log_out_of_order():
+    job = Job.objects.create(method="sleep", is_active=True)
+    a, b, c, d, e = [dict(message=message) for message in "abcde"]
+
+    # A batch that arrives before an earlier one is deferred
+    deferred = update_jobs([dict(id=job.id, status="RUNNING", log=[c, d], log_seq=2)])
+    assert deferred == [dict(id=job.id, status="RUNNING", log=[c, d], log_seq=2)]
+    job.refresh_from_db()
+    assert job.status == "RUNNING"
+    assert job.log is None
+
+    deferred = update_jobs(
+        [
+            dict(id=job.id, status="RUNNING", log=[e], log_seq=4),
+            dict(id=job.id, status="RUNNING", log=[a, b], log_seq=0),
+        ]
+    )
+    assert deferred == [dict(id=job.id, status="RUNNING", log=[e], log_seq=4)]
+    job.refresh_from_db()
+    assert job.log == [a, b]
+
+    # When sent again, the deferred batches are appended in order
+    assert update_jobs([dict(id=job.id, status="RUNNING", log=[e], log_seq=4)]) != []
+    assert update_jobs([dict(id=job.id, status="RUNNING", log=[c, d], log_seq=2)]) == []
+    assert update_jobs([dict(id=job.id, status="RUNNING", log=[e], log_seq=4)]) == []
+    job.refresh_from_db()
+    assert job.log == [a, b, c, d, e]
+
+    # Batches are not deferred once the job has ended
+    job.status = "SUCCESS"
+    assert defer_log(job, dict(status="RUNNING", log=[e], log_seq=9)) == (
+        dict(status="RUNNING", log=[e], log_seq=9),
+        [],
+    )
+
+
+def test_state_changes():
+    assert state_changes("RUNNING", "RUNNING") == {}
+    assert state_changes(None, "DISPATCHED") == {"DISPATCHED": 1}
+    assert state_changes("RUNNING", "SUCCESS") == {"RUNNING": -1, "SUCCESS": 1}
+
+
+def test_aggregate_job():
+    job = Job(method="parallel", children_status={"RUNNING": 1, "SUCCESS": 2})
+    aggregate_job(job)
+    assert job.is_active
+    assert job.status == "RUNNING"
+
+    job.children_status = {"RUNNING": 0, "SUCCESS": 2, "FAILURE": 1}
+    aggregate_job(job)
+    assert not job.is_active
+    assert job.status == "FAILURE"
+    assert job.children_status == {"SUCCESS": 2, "FAILURE": 1}
+
+
+@pytest.mark.django_db
+def test_dispatch_dag():
+    AccountTier.objects.create()
+    Account.objects.create(name="stencila")
+
+    parent = Job.objects.create(method="dag")
+    a, b, c, d = [Job.objects.create(method="sleep", parent=parent) for _ in range(4)]
+    c.dependencies.set([a, b])
+    d.dependencies.set([c])
+
+    dispatch_job(parent)
+
+    def statuses():
+        return [Job.objects.get(id=job.id).status for job in (a, b, c, d)]
+
+    assert statuses() == ["DISPATCHED", "DISPATCHED", "WAITING", "WAITING"]
+    assert parent.children_status == {"DISPATCHED": 2, "WAITING": 2}
+
+    def succeed(job):
+        job = Job.objects.get(id=job.id)
+        job.result = "done"
+        update_job(job, dict(status="SUCCESS"))
+
+    succeed(a)
+    assert statuses() == ["SUCCESS", "DISPATCHED", "WAITING", "WAITING"]
+
+    succeed(b)
+    assert statuses() == ["SUCCESS", "SUCCESS", "DISPATCHED", "WAITING"]
+
+    succeed(c)
+    succeed(d)
+    parent = Job.objects.get(id=parent.id)
+    assert parent.status == "SUCCESS"
+    assert not parent.is_active
+    assert parent.children_status == {"SUCCESS": 4}
+
+
+@pytest.mark.django_db
+def test_add_child_job():
+    """
+    A child added to a running compound job must end before it does.
+    """
+    AccountTier.objects.create()
+    Account.objects.create(name="stencila")
+
+    parent = Job.objects.create(method="dag")
+    a = Job.objects.create(method="sleep", parent=parent)
+    dispatch_job(parent)
+
+    b = add_child_job(parent, Job.objects.create(method="sleep"))
+    assert b.parent_id == parent.id
+    assert b.status == "DISPATCHED"
+    assert Job.objects.get(id=parent.id).children_status == {"DISPATCHED": 2}
+
+    for job in (a, b):
+        job = Job.objects.get(id=job.id)
+        job.result = "done"
+        update_job(job, dict(status="SUCCESS"))
+        assert Job.objects.get(id=parent.id).is_active == (job == a)
+
+    parent = Job.objects.get(id=parent.id)
+    assert parent.status == "SUCCESS"
+    assert parent.children_status == {"SUCCESS": 2}
+
+
+@pytest.mark.django_db
+def test_dispatch_dag_cancels_dependants():
+    AccountTier.objects.create()
+    Account.objects.create(name="stencila")
+
+    parent = Job.objects.create(method="dag")
+    a, b, c = [Job.objects.create(method="sleep", parent=parent) for _ in range(3)]
+    b.dependencies.set([a])
+    c.dependencies.set([b])
+
+    dispatch_job(parent)
+    cancel_job(Job.objects.get(id=a.id))
+
+    assert [Job.objects.get(id=job.id).status for job in (a, b, c)] == [
+        "CANCELLED",
+        "CANCELLED",
+        "CANCELLED",
+    ]
+    parent = Job.objects.get(id=parent.id)
+    assert parent.status == "CANCELLED"
+    assert not parent.is_active
+
+
+@pytest.mark.django_db
+def test_dispatch_dag_cycle():
+    parent = Job.objects.create(method="dag")
+    a, b = [Job.objects.create(method="sleep", parent=parent) for _ in range(2)]
+    a.dependencies.set([b])
+    b.dependencies.set([a])
+
+    with pytest.raises(ValueError, match="cycle"):
+        dispatch_job(parent)
+
+
+@pytest.mark.django_db
+def test_complete_jobs():
+    answered, unanswered, expired = [
+        Job.objects.create(method="sleep", status="SUCCESS", is_active=True)
+        for index in range(3)
+    ]
+    Job.objects.filter(id=expired.id).update(
+        updated=timezone.now() - datetime.timedelta(hours=2)
+    )
+
+    def get_many(ids, timeout):
+        yield str(answered.id), dict(status="SUCCESS", result=dict(result=42, log=[]))
+        raise CeleryTimeoutError()
+
+    with mock.patch("jobs.jobs.app") as app:
+        app.backend.get_many.side_effect = get_many
+        assert complete_jobs(expiry=3600) == 1
+
+        # Jobs without a result are left active for a later run
+        answered.refresh_from_db()
+        assert not answered.is_active
+        assert answered.result == 42
+        for job in (unanswered, expired):
+            job.refresh_from_db()
+            assert job.is_active
+            assert job.status == "SUCCESS"
+
+        # Unless their result has been unavailable for too long
+        app.backend.get_many.side_effect = None
+        app.backend.get_many.return_value = []
+        assert complete_jobs(expiry=3600) == 1
+        expired.refresh_from_db()
+        assert not expired.is_active
+        assert expired.status == "FAILURE"
+        unanswered.refresh_from_db()
+        assert unanswered.is_active
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-18 05:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0014_job_secrets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='children_status',
+            field=models.JSONField(blank=True, help_text='For compound jobs, the number of child jobs in each status; a JSON object. Used to update the status of the job without querying all children.', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.11 on 2026-10-18 06:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0015_job_children_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='dependencies',
+            field=models.ManyToManyField(blank=True, help_text='Sibling jobs (i.e. other children of a `dag` job) that must succeed before this job is dispatched.', related_name='dependants', to='jobs.Job'),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='method',
+            field=models.CharField(choices=[('parallel', 'parallel'), ('series', 'series'), ('dag', 'dag'), ('clean', 'clean'), ('archive', 'archive'), ('zip', 'zip'), ('pull', 'pull'), ('push', 'push'), ('extract', 'extract'), ('convert', 'convert'), ('pin', 'pin'), ('register', 'register'), ('compile', 'compile'), ('build', 'build'), ('execute', 'execute'), ('session', 'session'), ('sleep', 'sleep')], help_text='The job method.', max_length=32),
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_periodic_task(apps, schema_editor):
+    # Periodically complete any succeeded jobs whose results were not
+    # fetched when they were updated (e.g. because the result backend timed out
+    # or the `assistant` was restarted). See `jobs.tasks.complete_jobs`.
+    IntervalSchedule = apps.get_model("django_celery_beat", "IntervalSchedule")
+    PeriodicTask = apps.get_model("django_celery_beat", "PeriodicTask")
+    schedule, created = IntervalSchedule.objects.get_or_create(
+        every=60, period="seconds"
+    )
+    PeriodicTask.objects.get_or_create(
+        name="Complete jobs",
+        defaults=dict(task="jobs.tasks.complete_jobs", interval=schedule),
+    )
+
+
+def delete_periodic_task(apps, schema_editor):
+    PeriodicTask = apps.get_model("django_celery_beat", "PeriodicTask")
+    PeriodicTask.objects.filter(name="Complete jobs").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_beat', '0012_periodictask_expire_seconds'),
+        ('jobs', '0016_auto_20261018_0610'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_periodic_task, delete_periodic_task),
+    ]
@@ -1,7 +1,7 @@
 import json
 import re
 from enum import unique
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import inflect
 import shortuuid
@@ -352,6 +352,7 @@ class JobMethod(EnumChoice):
 
     parallel = "parallel"
     series = "series"
+    dag = "dag"
 
     clean = "clean"
     archive = "archive"
@@ -379,7 +380,9 @@ class JobMethod(EnumChoice):
     @classmethod
     def is_compound(cls, method: str) -> bool:
         """Is this a compound job method."""
-        return method in [member.value for member in (cls.parallel, cls.series)]
+        return method in [
+            member.value for member in (cls.parallel, cls.series, cls.dag)
+        ]
 
 
 @unique
@@ -679,6 +682,15 @@ class Job(models.Model):
         help_text="The parent job",
     )
 
+    dependencies = models.ManyToManyField(
+        "Job",
+        blank=True,
+        symmetrical=False,
+        related_name="dependants",
+        help_text="Sibling jobs (i.e. other children of a `dag` job) that "
+        "must succeed before this job is dispatched.",
+    )
+
     began = models.DateTimeField(
         null=True, blank=True, help_text="The time the job began."
     )
@@ -718,6 +730,13 @@ class Job(models.Model):
         help_text="The job log; a JSON array of log objects, including any errors.",
     )
 
+    children_status = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="For compound jobs, the number of child jobs in each status; "
+        "a JSON object. Used to update the status of the job without querying all children.",
+    )
+
     runtime = models.FloatField(
         null=True, blank=True, help_text="The running time of the job."
     )
@@ -949,12 +968,31 @@ class Job(models.Model):
 
         return dispatch_job(self)
 
+    def add_child(self, child: "Job") -> "Job":
+        """Add a child to the job, after it has been dispatched."""
+        from jobs.jobs import add_child_job
+
+        return add_child_job(self, child)
+
     def update(self, *args, **kwargs) -> "Job":
         """Update the job."""
         from jobs.jobs import update_job
 
         return update_job(self, *args, **kwargs)
 
+    def defer_log(self, data: Dict) -> Tuple[Dict, List[Dict]]:
+        """Split off any log entries that can not be appended yet."""
+        from jobs.jobs import defer_log
+
+        return defer_log(self, data)
+
+    @staticmethod
+    def update_many(updates: List[Dict]) -> List[Dict]:
+        """Update several jobs, returning any deferred updates."""
+        from jobs.jobs import update_jobs
+
+        return update_jobs(updates)
+
     def cancel(self) -> "Job":
         """Cancel the job."""
         from jobs.jobs import cancel_job
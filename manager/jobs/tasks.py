@@ -0,0 +1,20 @@
+from celery import shared_task
+
+from jobs.jobs import complete_jobs as complete_jobs_func
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=1)
+def complete_jobs(self):
+    """
+    Complete jobs that have succeeded but whose results have not yet been fetched.
+
+    Called when a job is updated with a `SUCCESS` status (when
+    `settings.JOB_RESULTS_ASYNC` is true), and every minute by a periodic
+    task (created in the `jobs` migrations), to catch any jobs missed
+    e.g. due to the `assistant` being restarted. Retries if there is an
+    error getting results e.g. if the result backend is temporarily unavailable.
+    """
+    try:
+        return complete_jobs_func()
+    except Exception as exc:
+        raise self.retry(exc=exc)
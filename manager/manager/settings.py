@@ -503,6 +503,12 @@ class Prod(Configuration):
     WORKING_ROOT = values.Value()
     SNAPSHOTS_ROOT = values.Value()
 
+    # The format for new project snapshots (see `projects.models.snapshots`).
+    # `zip` stores a zip archive of all files for each snapshot,
+    # `blobs` stores each file once in a content-addressed blob area
+    # (which must be readable by sessions without signed URLs).
+    SNAPSHOT_FORMAT = values.Value("zip")
+
     # Allow for username / password API authentication
     # This is usually disallowed in production (in favour of tokens)
     # but is permitted during development for convenience.
@@ -535,6 +541,19 @@ class Prod(Configuration):
     # A list of job methods restricted to staff members
     JOB_METHODS_STAFF_ONLY: List[str] = []
 
+    # Get the results of succeeded jobs, and run their callbacks,
+    # in the `assistant` (see `jobs.tasks.complete_jobs`) rather than
+    # while handling the request from the `overseer` that updates the job.
+    JOB_RESULTS_ASYNC = values.BooleanValue(True)
+
+    # Seconds after which a succeeded job whose result is still not available
+    # in the result backend is marked as failed (see `jobs.jobs.complete_jobs`)
+    JOB_RESULTS_EXPIRY = values.IntegerValue(3600)
+
+    # Complete `pin` jobs using fresh digests from the cache shared
+    # with workers (at `CACHE_URL`) rather than dispatching them to a worker
+    JOB_PIN_FROM_CACHE = values.BooleanValue(False)
+
     @classmethod
     def post_setup(cls):
         """Do additional configuration after initial setup."""
@@ -685,6 +704,10 @@ class Dev(Local):
     # Use local URLs to more easily tests connections to jobs
     JOB_URLS_LOCAL = True
 
+    # Get job results synchronously so that the `assistant`
+    # does not need to be running during development
+    JOB_RESULTS_ASYNC = values.BooleanValue(False)
+
 
 class Test(Local):
     """
@@ -708,3 +731,6 @@ class Test(Local):
 
     # During testing this value needs to be set but is not used
     CACHE_URL = ""
+
+    # Get job results synchronously so that tests do not need the `assistant`
+    JOB_RESULTS_ASYNC = False
@@ -10,7 +10,7 @@ from a different domain (ala googleusercontent.com and githubusercontent.com).
 """
 
 import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 from urllib.parse import urljoin
 
 import google.cloud.storage
@@ -56,6 +56,14 @@ class FileSystemStorage(BaseFileSystemStorage):
         """
         return None
 
+    def generate_post_policies(self, paths: List[str]) -> Optional[Dict[str, dict]]:
+        """
+        Generate policies that can be used to POST several files.
+
+        Not available for this tpe of storage.
+        """
+        return None
+
 
 class GoogleCloudStorage(BaseGoogleCloudStorage):
     """
@@ -92,9 +100,25 @@ class GoogleCloudStorage(BaseGoogleCloudStorage):
 
         See `generate_signed_post_policy_v4` in https://googleapis.dev/python/storage/latest/client.html
         """
+        policies = self.generate_post_policies([path])
+        return policies[path] if policies else None
+
+    def generate_post_policies(self, paths: List[str]) -> Optional[Dict[str, dict]]:
+        """
+        Generate policies that can be used to POST several files to the bucket.
+
+        Each policy can only be used to POST the file at its path (the policy
+        always has a condition on the exact `key`) so one is needed for each file.
+        """
         client = google.cloud.storage.Client()
-        return client.generate_signed_post_policy_v4(
-            self.bucket_name, path, expiration=datetime.timedelta(hours=1)
+        return dict(
+            (
+                path,
+                client.generate_signed_post_policy_v4(
+                    self.bucket_name, path, expiration=datetime.timedelta(hours=1),
+                ),
+            )
+            for path in paths
         )
 
 
@@ -0,0 +1,49 @@
+import base64
+import json
+from unittest import mock
+
+import google.cloud.storage
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.oauth2 import service_account
+
+from manager.storage import GoogleCloudStorage
+
+
+def test_generate_post_policies():
+    """
+    Each policy only allows a POST to the exact path it is for.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    credentials = service_account.Credentials.from_service_account_info(
+        dict(
+            type="service_account",
+            client_email="test@example.iam.gserviceaccount.com",
+            token_uri="https://oauth2.googleapis.com/token",
+            private_key=key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ).decode(),
+        )
+    )
+    client = google.cloud.storage.Client(project="test", credentials=credentials)
+
+    paths = ["blobs/ab/abc", "blobs/de/def"]
+    with mock.patch("google.cloud.storage.Client", return_value=client):
+        policies = GoogleCloudStorage(bucket_name="bucket").generate_post_policies(
+            paths
+        )
+
+    assert sorted(policies.keys()) == paths
+    for path, policy in policies.items():
+        assert policy["fields"]["key"] == path
+        conditions = json.loads(base64.b64decode(policy["fields"]["policy"]))[
+            "conditions"
+        ]
+        keys = [
+            condition
+            for condition in conditions
+            if "key" in condition or "$key" in condition
+        ]
+        assert keys == [{"key": path}]
@@ -623,6 +623,7 @@ class SnapshotSerializer(serializers.ModelSerializer):
             "creator",
             "created",
             "container_image",
+            "fingerprint",
             "job",
         ]
 
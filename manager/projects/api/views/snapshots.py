@@ -160,7 +160,7 @@ class ProjectsSnapshotsViewSet(
         The user should have read access to the project.
         """
         snapshot = self.get_object()
-        return snapshot.file_response(snapshot.zip_name)
+        return snapshot.archive_response()
 
     @action(detail=True, methods=["post"])
     def session(self, request: Request, *args, **kwargs) -> Response:
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-18 06:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0031_auto_20210328_2341'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='format',
+            field=models.CharField(choices=[('zip', 'Zip archive'), ('blobs', 'Content-addressed blobs')], default='zip', help_text="The format that the snapshot's files are stored in.", max_length=16),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0032_snapshot_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='revision',
+            field=models.TextField(blank=True, help_text='The revision of the source when it was last pulled (e.g. a commit SHA or ETag). Used to avoid pulling the source again if it has not changed.', null=True),
+        ),
+    ]
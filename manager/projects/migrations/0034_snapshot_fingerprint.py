@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0033_source_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text="The SHA256 fingerprint of the snapshot's zip archive, or manifest. Used to verify it when it is fetched for a session.", max_length=64, null=True),
+        ),
+    ]
@@ -1,8 +1,12 @@
 import datetime
+import json
+import logging
 import os
-from typing import Dict, List, Optional
+import time
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlencode
 
+import redis
 import shortuuid
 from django.conf import settings
 from django.core.files.base import ContentFile
@@ -15,7 +19,7 @@ from django.utils import timezone
 from meta.views import Meta
 
 from accounts.models import Account, AccountTeam
-from jobs.models import Job, JobMethod
+from jobs.models import Job, JobMethod, JobStatus
 from manager.helpers import EnumChoice
 from manager.storage import (
     StorageUsageMixin,
@@ -25,6 +29,65 @@ from manager.storage import (
 )
 from users.models import User
 
+logger = logging.getLogger(__name__)
+
+
+def parse_container_image(
+    container_image: Optional[str],
+) -> Optional[Tuple[str, str, str]]:
+    """
+    Parse a container image identifier into its registry host, repository and alias.
+
+    Applies the same defaults as the `pin` job in the `worker`. Returns `None`
+    if the identifier is already pinned to a digest.
+    """
+    image = container_image or "stencila/executa-midi"
+    if "@" in image or image.startswith("sha256:"):
+        return None
+
+    parts = image.split("/")
+    if len(parts) > 1 and "." in parts[0]:
+        host, image = parts[0], "/".join(parts[1:])
+    else:
+        host = "registry-1.docker.io"
+
+    repo, _, alias = image.partition(":")
+    return host, repo, alias or "latest"
+
+
+redis_client: Optional[redis.Redis] = None
+
+
+def get_cached_pin(container_image: Optional[str]) -> Optional[str]:
+    """
+    Get the pinned version of a container image from the cache shared with workers.
+
+    The cache is populated by `pin` jobs (see `DigestCache` in the `worker`).
+    Returns `None` if there is no fresh entry for the image, or the cache
+    is not available.
+    """
+    global redis_client
+
+    parsed = parse_container_image(container_image)
+    if not parsed or not settings.CACHE_URL:
+        return None
+    host, repo, alias = parsed
+
+    try:
+        if redis_client is None:
+            redis_client = redis.Redis.from_url(settings.CACHE_URL, socket_timeout=5)
+        data = redis_client.get(f"pin:digest:{host}/{repo}:{alias}")
+    except redis.RedisError as exc:
+        logger.warning(f"Unable to read from pin cache: {exc}")
+        return None
+
+    if not data:
+        return None
+    entry = json.loads(data)
+    if entry.get("expires", 0) < time.time():
+        return None
+    return entry.get("image")
+
 
 class ProjectLiveness(EnumChoice):
     """
@@ -408,11 +471,12 @@ class Project(StorageUsageMixin, models.Model):
         # #for trigger in self.triggers.all():
         #    trigger.evaluate(event=event, context=dict(event=event, source=source))
 
-    def cleanup(self, user: User) -> Job:
+    def cleanup(self, user: User, keep: Optional[List[str]] = None) -> Job:
         """
         Clean the project's working directory.
 
-        Removes all files from the working directory.
+        Removes all files from the working directory, except for the
+        paths in `keep`.
         In the future, this may be smarter and only remove
         those files that are orphaned (i.e. not registered as part of the pipeline).
 
@@ -424,20 +488,24 @@ class Project(StorageUsageMixin, models.Model):
             project=self,
             creator=user,
             method=JobMethod.clean.name,
+            params=dict(keep=keep) if keep else None,
             description=f"Clean project '{self.name}'",
             **Job.create_callback(self, "cleanup_callback"),
         )
 
     def cleanup_callback(self, job: Job):
         """
-        Set all project files as non-current.
+        Set all project files, other than those kept, as non-current.
 
         This will remove derived files (e.g. converted from another format) and
         files from a source.
         """
         from projects.models.files import File
 
-        File.objects.filter(project=self, current=True).update(current=False)
+        keep = (job.params or {}).get("keep") or []
+        File.objects.filter(project=self, current=True).exclude(path__in=keep).update(
+            current=False
+        )
 
     def pull(self, user: User) -> Job:
         """
@@ -495,10 +563,12 @@ class Project(StorageUsageMixin, models.Model):
         we go through the `File` method e.g. `File.convert`. This more safely enables
         project forking etc.
 
-        In the future should do a topological sort so that the
-        jobs get executed in parallel if possible, and in series if necessary.
+        The jobs are children of a `dag` job, with each job depending on the job
+        that regenerates its upstream file (if any), so that they get executed
+        in parallel if possible, and in series if necessary.
         """
-        subjobs = []
+        subjobs: Dict[str, Job] = {}
+        upstreams: Dict[str, str] = {}
         for file in self.files.filter(
             current=True,
             upstreams__isnull=False,
@@ -519,18 +589,23 @@ class Project(StorageUsageMixin, models.Model):
         ):
             # Convert jobs only have one upstream
             upstream = file.upstreams.first()
-            subjob = upstream.convert(user, file.path)
-            subjobs.append(subjob)
+            subjobs[file.path] = upstream.convert(user, file.path)
+            upstreams[file.path] = upstream.path
 
         if len(subjobs) > 0:
-            parallel = Job.objects.create(
+            for path, subjob in subjobs.items():
+                dependency = subjobs.get(upstreams[path])
+                if dependency:
+                    subjob.dependencies.add(dependency)
+
+            dag = Job.objects.create(
                 project=self,
                 creator=user,
-                method=JobMethod.parallel.name,
+                method=JobMethod.dag.name,
                 description="Update derived files",
             )
-            parallel.children.set(subjobs)
-            return parallel
+            dag.children.set(subjobs.values())
+            return dag
         else:
             return None
 
@@ -541,8 +616,13 @@ class Project(StorageUsageMixin, models.Model):
         Does not change the project's `container_image` field, but
         rather, returns a pinned version of it. The callback should
         use that value.
+
+        If `JOB_PIN_FROM_CACHE` is on, and there is a fresh digest for the
+        container image in the cache shared with workers, then the job is
+        completed (and its callback run) immediately rather than being
+        dispatched to a worker.
         """
-        return Job.objects.create(
+        job = Job.objects.create(
             project=self,
             creator=user,
             method=JobMethod.pin.name,
@@ -551,24 +631,68 @@ class Project(StorageUsageMixin, models.Model):
             **callback,
         )
 
-    def archive(self, user: User, snapshot: str, path: str, **callback) -> Job:
+        if settings.JOB_PIN_FROM_CACHE:
+            image = get_cached_pin(self.container_image)
+            if image:
+                job.result = image
+                job.status = JobStatus.SUCCESS.value
+                job.is_active = False
+                job.runtime = 0
+                job.save()
+                job.run_callback()
+
+        return job
+
+    def archive(
+        self,
+        user: User,
+        snapshot: str,
+        path: str,
+        format: str = "zip",
+        blobs: Optional[List[str]] = None,
+        uploads: Optional[Dict[str, str]] = None,
+        parent: Optional[Job] = None,
+        **callback,
+    ) -> Job:
         """
         Archive the project's working directory.
 
         Creates a copy of the project's working directory
-        on the `snapshots` storage.
-        """
-        # Get the upload policy
-        policy = snapshots_storage().generate_post_policy(path)
-        url = policy.get("url") if policy else None
-        secrets = policy.get("fields") if policy else None
+        on the `snapshots` storage. For the `blobs` format, the files
+        are stored as content-addressed blobs under the `path` prefix.
+        Without `uploads`, the job only lists the files. Otherwise, `uploads`
+        maps the fingerprint of each blob to upload to its location (and
+        each needs its own upload policy), and `blobs` are the fingerprints
+        of the blobs that are already stored.
+        """
+        storage = snapshots_storage()
+        params = dict(project=self.id, snapshot=snapshot, path=path)
+        if format == "blobs":
+            params.update(format="blobs")
+            url = secrets = None
+            if uploads is not None:
+                params.update(blobs=blobs or [], uploads=list(uploads.keys()))
+                policies = storage.generate_post_policies(list(uploads.values()))
+                if policies:
+                    # All policies are for the same bucket, and so URL
+                    url = list(policies.values())[0]["url"]
+                    secrets = dict(
+                        (fingerprint, policies[location]["fields"])
+                        for fingerprint, location in uploads.items()
+                    )
+        else:
+            policy = storage.generate_post_policy(path)
+            url = policy.get("url") if policy else None
+            secrets = policy.get("fields") if policy else None
+        params.update(url=url)
 
         return Job.objects.create(
             project=self,
             creator=user,
             method=JobMethod.archive.name,
-            params=dict(project=self.id, snapshot=snapshot, path=path, url=url,),
+            params=params,
             secrets=secrets,
+            parent=parent,
             description=f"Archive project '{self.name}'",
             **callback,
         )
@@ -1,6 +1,14 @@
+import json
+import time
+from unittest import mock
+
 import pytest
+from django.test import override_settings
 
-from projects.models.projects import ProjectRole
+from jobs.jobs import dispatch_job
+from jobs.models import JobStatus
+from manager.testing import DatabaseTestCase
+from projects.models.projects import Project, ProjectRole, parse_container_image
 
 
 def test_project_role_from_string():
@@ -24,3 +32,54 @@ def test_project_role_and_above():
     assert ProjectRole.and_above(ProjectRole.OWNER) == [
         ProjectRole.OWNER,
     ]
+
+
+def test_parse_container_image():
+    assert parse_container_image(None) == (
+        "registry-1.docker.io",
+        "stencila/executa-midi",
+        "latest",
+    )
+    assert parse_container_image("org/name:1.2") == (
+        "registry-1.docker.io",
+        "org/name",
+        "1.2",
+    )
+    assert parse_container_image("registry.io:5432/org/name") == (
+        "registry.io:5432",
+        "org/name",
+        "latest",
+    )
+    assert parse_container_image("org/name@sha256:abc") is None
+
+
+class PinTests(DatabaseTestCase):
+    @override_settings(JOB_PIN_FROM_CACHE=True, CACHE_URL="redis://cache")
+    def test_pin_from_cache(self):
+        project = Project.objects.create(account=self.ada.personal_account, name="p")
+        entry = dict(
+            digest="sha256:abc",
+            image="docker.io/stencila/executa-midi@sha256:abc",
+            time=time.time(),
+            expires=time.time() + 60,
+        )
+        client = mock.Mock()
+        with mock.patch("projects.models.projects.redis_client", client):
+            # Fresh entry, so job is completed immediately and not dispatched
+            client.get.return_value = json.dumps(entry)
+            job = project.pin(self.ada)
+            client.get.assert_called_with(
+                "pin:digest:registry-1.docker.io/stencila/executa-midi:latest"
+            )
+            assert job.status == JobStatus.SUCCESS.value
+            assert job.result == entry["image"]
+            with mock.patch("jobs.jobs.signature") as signature:
+                dispatch_job(job)
+                signature.assert_not_called()
+
+            # Stale entry, so job is dispatched to a worker as usual
+            entry["expires"] = time.time() - 1
+            client.get.return_value = json.dumps(entry)
+            job = project.pin(self.ada)
+            assert job.status is None
+            assert job.result is None
@@ -1,18 +1,56 @@
+import hashlib
+import json
 import os
-from typing import Optional
+from typing import Iterator, List, Optional, Set
 
 import shortuuid
-from django.db import models
-from django.http import HttpRequest
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, pre_delete
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from stream_zip import ZIP_AUTO, stream_zip
 
 from jobs.models import Job, JobMethod
+from manager.helpers import EnumChoice
 from manager.storage import StorageUsageMixin, snapshots_storage
 from projects.models.files import File, get_modified
 from projects.models.projects import Project
 from users.models import User
 
 
+class SnapshotFormat(EnumChoice):
+    """
+    The format that the files of a snapshot are stored in.
+
+    For `zip`, all the files are stored in a zip archive for each snapshot.
+    For `blobs`, each file is stored once, named by its fingerprint, in a
+    content-addressed blob area that is shared by all snapshots. The paths
+    and fingerprints of each snapshot's files are stored in its manifest.
+    """
+
+    zip = "Zip archive"
+    blobs = "Content-addressed blobs"
+
+
+# The prefix for blobs within the snapshot storage
+BLOBS_PREFIX = "blobs/"
+
+# The name of the manifest file within the snapshot's directory
+MANIFEST_NAME = "manifest.json"
+
+
+def blob_location(fingerprint: str) -> str:
+    """
+    Get the location of a blob relative to the root of the snapshot storage.
+
+    Must match the location used by the `archive` job.
+    """
+    return f"{BLOBS_PREFIX}{fingerprint[:2]}/{fingerprint}"
+
+
 def generate_snapshot_id():
     """
     Generate a unique snapshot id.
@@ -32,6 +70,8 @@ class Snapshot(StorageUsageMixin, models.Model):
 
     The `zip_name` field provides a way of providing a more useful filename
     when downloading the archive (it is populated with the project name and snapshot number).
+
+    The `format` field determines how the snapshot's files are stored (see `SnapshotFormat`).
     """
 
     id = models.CharField(
@@ -79,6 +119,21 @@ class Snapshot(StorageUsageMixin, models.Model):
         help_text="The name of snapshot's Zip file (within the snapshot directory).",
     )
 
+    format = models.CharField(
+        max_length=16,
+        choices=SnapshotFormat.as_choices(),
+        default=SnapshotFormat.zip.name,
+        help_text="The format that the snapshot's files are stored in.",
+    )
+
+    fingerprint = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text="The SHA256 fingerprint of the snapshot's zip archive, or manifest. "
+        "Used to verify it when it is fetched for a session.",
+    )
+
     container_image = models.TextField(
         null=True,
         blank=True,
@@ -139,15 +194,29 @@ class Snapshot(StorageUsageMixin, models.Model):
         """
         Snapshot the project.
         """
-        snapshot = Snapshot.objects.create(project=project, creator=user)
+        snapshot = Snapshot.objects.create(
+            project=project, creator=user, format=settings.SNAPSHOT_FORMAT
+        )
 
+        # The jobs needed to create the snapshot are children of a `dag` job
+        # so that they run in parallel where possible e.g. pinning the container image
+        # does not need to wait for anything.
         subjobs = []
 
-        # Clean the project's working directory
-        subjobs.append(project.cleanup(user))
+        # Clean the project's working directory, keeping files from sources
+        # with a known revision so that they need not be pulled again if unchanged
+        keep = list(
+            File.objects.filter(
+                project=project, current=True, source__revision__isnull=False
+            ).values_list("path", flat=True)
+        )
+        clean = project.cleanup(user, keep=keep)
+        subjobs.append(clean)
 
         # Pull the project's sources
-        subjobs.append(project.pull(user))
+        pull = project.pull(user)
+        pull.dependencies.add(clean)
+        subjobs.append(pull)
 
         # "Reflow" the project (regenerate derived files)
         # NB 2021-06-16 This is commented out because it was causing
@@ -156,6 +225,7 @@ class Snapshot(StorageUsageMixin, models.Model):
         # reintroducing.
         # reflow = project.reflow(user)
         # if reflow:
+        #     reflow.dependencies.add(pull)
         #     subjobs.append(reflow)
 
         # Pin the container image
@@ -163,6 +233,9 @@ class Snapshot(StorageUsageMixin, models.Model):
             project.pin(user, **Job.create_callback(snapshot, "pin_callback"))
         )
 
+        # Archive dependencies
+        archive_dependencies = [pull]
+
         # Create an index.html if a "main" file is defined
         main = project.get_main()
         if main:
@@ -172,23 +245,38 @@ class Snapshot(StorageUsageMixin, models.Model):
             if theme:
                 options["theme"] = theme
 
-            subjobs.append(main.convert(user, "index.html", options=options))
+            convert = main.convert(user, "index.html", options=options)
+            convert.dependencies.add(pull)
+            subjobs.append(convert)
+            archive_dependencies.append(convert)
 
-        # This is currently required to populate field `zip_name` below
-        snapshot.save()
+        # This is currently required to populate field `zip_name` below.
+        # Only these fields are saved because sub-job callbacks (e.g. `pin_callback`
+        # when the pin is completed from the cache) may have already updated others.
+        snapshot.save(update_fields=["number", "path", "zip_name"])
 
         # Archive the working directory to the snapshot directory
-        subjobs.append(
-            project.archive(
+        # (or, for the `blobs` format, to the blob area)
+        if snapshot.format == SnapshotFormat.blobs.name:
+            archive = project.archive(
+                user,
+                snapshot=snapshot.id,
+                path=BLOBS_PREFIX,
+                format=SnapshotFormat.blobs.name,
+                **Job.create_callback(snapshot, "archive_callback"),
+            )
+        else:
+            archive = project.archive(
                 user,
                 snapshot=snapshot.id,
                 path=f"{project.id}/{snapshot.id}/{snapshot.zip_name}",
                 **Job.create_callback(snapshot, "archive_callback"),
             )
-        )
+        archive.dependencies.set(archive_dependencies)
+        subjobs.append(archive)
 
         job = Job.objects.create(
-            method=JobMethod.series.name,
+            method=JobMethod.dag.name,
             description="Snapshot project '{0}'".format(project.name),
             project=project,
             creator=user,
@@ -197,7 +285,7 @@ class Snapshot(StorageUsageMixin, models.Model):
         job.dispatch()
 
         snapshot.job = job
-        snapshot.save()
+        snapshot.save(update_fields=["job"])
 
         return snapshot
 
@@ -212,13 +300,50 @@ class Snapshot(StorageUsageMixin, models.Model):
 
     def archive_callback(self, job: Job):
         """
-        Update the files associated with this snapshot.
+        Update the files, and fingerprint, of this snapshot.
 
         Called when the `archive` sub-job is complete.
+
+        For the `blobs` format, the first `archive` job only lists the files.
+        If any of their blobs are not yet stored, another `archive` job is added
+        to the snapshot's job to upload them (with an upload policy for each),
+        and the files are only recorded when it is complete (so that
+        the snapshot never refers to blobs that are not stored).
         """
         result = job.result
         if not result:
             return
+        files = result.get("files", {})
+
+        if (
+            self.format == SnapshotFormat.blobs.name
+            and (job.params or {}).get("uploads") is None
+        ):
+            fingerprints = set(
+                info["fingerprint"]
+                for info in files.values()
+                if info.get("fingerprint")
+            )
+            stored = fingerprints.intersection(self.stored_blobs())
+            uploads = fingerprints - stored
+            if uploads:
+                upload = self.project.archive(
+                    job.creator,
+                    snapshot=self.id,
+                    path=BLOBS_PREFIX,
+                    format=SnapshotFormat.blobs.name,
+                    blobs=sorted(stored),
+                    uploads=dict(
+                        (fingerprint, blob_location(fingerprint))
+                        for fingerprint in sorted(uploads)
+                    ),
+                    **Job.create_callback(self, "archive_callback"),
+                )
+                if job.parent:
+                    job.parent.add_child(upload)
+                else:
+                    upload.dispatch()
+                return
 
         # Do a batch insert of files. This is much faster when there are a lot of file
         # than inserting each file individually.
@@ -237,10 +362,43 @@ class Snapshot(StorageUsageMixin, models.Model):
                     encoding=info.get("encoding"),
                     fingerprint=info.get("fingerprint"),
                 )
-                for path, info in result.items()
+                for path, info in files.items()
             ]
         )
 
+        if self.format == SnapshotFormat.blobs.name:
+            manifest = json.dumps(
+                dict(
+                    version=1,
+                    files=dict(
+                        (path, info.get("fingerprint")) for path, info in files.items()
+                    ),
+                )
+            ).encode()
+            self.STORAGE.save(self.manifest_location(), ContentFile(manifest))
+            self.fingerprint = hashlib.sha256(manifest).hexdigest()
+        else:
+            self.fingerprint = result.get("fingerprint")
+        self.save(update_fields=["fingerprint"])
+
+    def stored_blobs(self) -> List[str]:
+        """
+        Get the fingerprints of the blobs already stored for the project.
+
+        These are the fingerprints of the files in the project's other
+        snapshots in the `blobs` format and do not need to be uploaded again.
+        """
+        return list(
+            File.objects.filter(
+                project=self.project,
+                snapshot__format=SnapshotFormat.blobs.name,
+                fingerprint__isnull=False,
+            )
+            .exclude(snapshot=self)
+            .values_list("fingerprint", flat=True)
+            .distinct()
+        )
+
     def session(self, request: HttpRequest) -> Job:
         """
         Create a session job for the snapshot.
@@ -253,7 +411,15 @@ class Snapshot(StorageUsageMixin, models.Model):
             method=JobMethod.session.name,
             params=dict(
                 snapshot=self.id,
-                snapshot_url=self.file_url(self.zip_name),
+                **(
+                    dict(
+                        snapshot_url=self.STORAGE.url(self.manifest_location()),
+                        blobs_url=self.STORAGE.url(BLOBS_PREFIX),
+                    )
+                    if self.format == SnapshotFormat.blobs.name
+                    else dict(snapshot_url=self.file_url(self.zip_name))
+                ),
+                snapshot_fingerprint=self.fingerprint,
                 container_image=self.container_image,
                 mem_request=project.session_memory,
                 mem_limit=project.session_memory,
@@ -292,5 +458,126 @@ class Snapshot(StorageUsageMixin, models.Model):
     def file_location(self, file: str) -> str:
         """
         Get the location of one of the snapshot's files relative to the root of the storage volume.
+
+        For snapshots in the `blobs` format, this is the location of the blob
+        with the file's fingerprint.
         """
+        if self.format == SnapshotFormat.blobs.name:
+            fingerprint = (
+                self.files.filter(path=file)
+                .values_list("fingerprint", flat=True)
+                .first()
+            )
+            if fingerprint:
+                return blob_location(fingerprint)
         return os.path.join(self.path, file)
+
+    def manifest_location(self) -> str:
+        """
+        Get the location of the snapshot's manifest relative to the root of the storage volume.
+        """
+        return os.path.join(self.path, MANIFEST_NAME)
+
+    def archive_response(self) -> HttpResponse:
+        """
+        Create a HTTP response to a request to download the snapshot's zip archive.
+
+        Snapshots in the `blobs` format do not have a zip archive so
+        one is generated from the blobs as the response is streamed.
+        """
+        if self.format != SnapshotFormat.blobs.name:
+            return self.file_response(self.zip_name)
+
+        response = StreamingHttpResponse(
+            self.zip_blobs(), content_type="application/zip"
+        )
+        response["Content-Disposition"] = f'attachment; filename="{self.zip_name}"'
+        return response
+
+    def zip_blobs(self) -> Iterator[bytes]:
+        """
+        Generate a zip archive of the snapshot's files, from their blobs, in chunks.
+        """
+
+        def chunks(file: File) -> Iterator[bytes]:
+            with self.STORAGE.open(blob_location(file.fingerprint)) as source:
+                yield from iter(lambda: source.read(1024 * 1024), b"")
+
+        yield from stream_zip(
+            (
+                (
+                    file.path,
+                    file.modified or file.updated,
+                    0o100644,
+                    ZIP_AUTO(file.size or 0),
+                    chunks(file),
+                )
+                for file in self.files.order_by("path")
+            ),
+            chunk_size=1024 * 1024,
+        )
+
+
+def delete_unused_blobs(fingerprints: Set[str]):
+    """
+    Delete blobs that are no longer used by any snapshot.
+
+    Blobs are shared by all snapshots in the `blobs` format so they are reference
+    counted using the fingerprints of those snapshots' files. Blobs that an
+    `archive` job of a snapshot still being created is uploading, or was told were
+    already stored, are also kept until the job has been completed and its
+    callback has recorded the snapshot's files. That is, while the job is active
+    (which it is after it has ended, until its result has been fetched
+    and its callback run) or has not been dispatched yet.
+    """
+    used = set(
+        File.objects.filter(
+            snapshot__format=SnapshotFormat.blobs.name, fingerprint__in=fingerprints
+        ).values_list("fingerprint", flat=True)
+    )
+    for params in (
+        Job.objects.filter(method=JobMethod.archive.name, params__format="blobs")
+        .filter(Q(is_active=True) | Q(status__isnull=True))
+        .values_list("params", flat=True)
+    ):
+        used.update(params.get("blobs") or [])
+        used.update(params.get("uploads") or [])
+
+    for fingerprint in fingerprints - used:
+        Snapshot.STORAGE.delete(blob_location(fingerprint))
+
+
+def collect_snapshot_blobs(sender, instance: Snapshot, **kwargs):
+    """
+    Record the fingerprints of the files of a snapshot that is about to be deleted.
+
+    Done before deletion because the snapshot's files are deleted along with it.
+    """
+    if instance.format == SnapshotFormat.blobs.name:
+        instance._blobs = set(
+            instance.files.filter(fingerprint__isnull=False).values_list(
+                "fingerprint", flat=True
+            )
+        )
+
+
+def delete_snapshot_blobs(sender, instance: Snapshot, **kwargs):
+    """
+    Delete the manifest, and unused blobs, of a snapshot once it has been deleted.
+
+    Deferred until the transaction is committed so that blobs are not deleted
+    if the deletion of the snapshot is rolled back.
+    """
+    if instance.format == SnapshotFormat.blobs.name:
+        fingerprints = getattr(instance, "_blobs", set())
+        location = instance.manifest_location()
+
+        def delete():
+            Snapshot.STORAGE.delete(location)
+            delete_unused_blobs(fingerprints)
+
+        transaction.on_commit(delete)
+
+
+pre_delete.connect(collect_snapshot_blobs, sender=Snapshot)
+post_delete.connect(delete_snapshot_blobs, sender=Snapshot)
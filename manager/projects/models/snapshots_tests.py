@@ -0,0 +1,204 @@
+import hashlib
+import io
+import json
+import tempfile
+import time
+from unittest import mock
+from zipfile import ZipFile
+
+from django.test import override_settings
+from django.utils import timezone
+
+from accounts.quotas import snapshots_storage_bytes
+from jobs.models import Job, JobMethod, JobStatus
+from manager.storage import FileSystemStorage
+from manager.testing import DatabaseTestCase
+from projects.models.snapshots import Snapshot, SnapshotFormat, blob_location
+
+
+def fingerprint(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class SnapshotsTests(DatabaseTestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(location=self.temp.name)
+        patcher = mock.patch.object(Snapshot, "STORAGE", self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.temp.cleanup)
+
+    def archive(self, snapshot, contents):
+        """
+        Simulate the archive jobs for a snapshot.
+
+        Returns the fingerprints of the blobs that were uploaded.
+        """
+        files = dict(
+            (path, dict(size=len(content), fingerprint=fingerprint(content)))
+            for path, content in contents.items()
+        )
+        listing = Job.objects.create(
+            project=snapshot.project,
+            method=JobMethod.archive.name,
+            params=dict(format="blobs"),
+            result=dict(files=files),
+            status=JobStatus.SUCCESS.name,
+        )
+        with mock.patch("jobs.jobs.signature"):
+            snapshot.archive_callback(listing)
+
+        upload = Job.objects.filter(
+            method=JobMethod.archive.name,
+            params__snapshot=snapshot.id,
+            id__gt=listing.id,
+        ).first()
+        if upload is None:
+            return []
+
+        uploads = upload.params["uploads"]
+        for content in contents.values():
+            if fingerprint(content) in uploads:
+                self.storage.save(
+                    blob_location(fingerprint(content)), io.BytesIO(content)
+                )
+        upload.result = dict(files=files)
+        upload.status = JobStatus.SUCCESS.name
+        upload.is_active = False
+        upload.save()
+        snapshot.archive_callback(upload)
+        return uploads
+
+    def test_blobs_format(self):
+        project = self.ada_public
+        first = Snapshot.objects.create(
+            project=project, format=SnapshotFormat.blobs.name
+        )
+        assert self.archive(first, {"a.txt": b"A", "b/b.txt": b"B"}) == sorted(
+            [fingerprint(b"A"), fingerprint(b"B")]
+        )
+
+        # Manifest is written, and file locations are those of the blobs
+        with self.storage.open(first.manifest_location()) as file:
+            manifest = file.read()
+        assert json.loads(manifest)["files"] == {
+            "a.txt": fingerprint(b"A"),
+            "b/b.txt": fingerprint(b"B"),
+        }
+        assert first.fingerprint == fingerprint(manifest)
+        assert first.file_location("a.txt") == blob_location(fingerprint(b"A"))
+        assert first.file_content("b/b.txt") == b"B"
+
+        # A second snapshot only needs to store new blobs
+        second = Snapshot.objects.create(
+            project=project, format=SnapshotFormat.blobs.name
+        )
+        assert sorted(second.stored_blobs()) == sorted(
+            [fingerprint(b"A"), fingerprint(b"B")]
+        )
+        assert self.archive(second, {"a.txt": b"A", "c.txt": b"CC"}) == [
+            fingerprint(b"CC")
+        ]
+
+        # If all blobs are stored, none are uploaded
+        third = Snapshot.objects.create(
+            project=project, format=SnapshotFormat.blobs.name
+        )
+        assert self.archive(third, {"c.txt": b"CC"}) == []
+        assert third.file_content("c.txt") == b"CC"
+
+        # Blobs are only counted once towards storage usage
+        assert snapshots_storage_bytes(project.account) == 4
+
+        # A zip archive can be generated from the blobs
+        with ZipFile(io.BytesIO(b"".join(second.zip_blobs()))) as zip_file:
+            assert zip_file.namelist() == ["a.txt", "c.txt"]
+            assert zip_file.read("c.txt") == b"CC"
+
+    def test_zip_format(self):
+        snapshot = Snapshot.objects.create(project=self.ada_public)
+        assert snapshot.format == SnapshotFormat.zip.name
+        assert snapshot.file_location("a.txt") == f"{snapshot.path}/a.txt"
+
+        # The fingerprint of the zip archive is recorded from the archive job
+        job = Job.objects.create(
+            project=snapshot.project,
+            method=JobMethod.archive.name,
+            result=dict(files={"a.txt": dict(size=1)}, fingerprint="abc"),
+        )
+        snapshot.archive_callback(job)
+        assert Snapshot.objects.get(id=snapshot.id).fingerprint == "abc"
+        assert snapshot.files.count() == 1
+
+    @override_settings(JOB_PIN_FROM_CACHE=True, CACHE_URL="redis://cache")
+    def test_create_pin_from_cache(self):
+        image = "docker.io/stencila/executa-midi@sha256:abc"
+        client = mock.Mock()
+        client.get.return_value = json.dumps(
+            dict(
+                digest="sha256:abc",
+                image=image,
+                time=time.time(),
+                expires=time.time() + 60,
+            )
+        )
+        with mock.patch("projects.models.projects.redis_client", client), mock.patch(
+            "jobs.jobs.signature"
+        ):
+            snapshot = Snapshot.create(self.ada_public, self.ada)
+
+        # The image set by the pin callback is not overwritten when
+        # the snapshot is saved again
+        assert snapshot.job is not None
+        assert Snapshot.objects.get(id=snapshot.id).container_image == image
+
+    def test_delete_blobs(self):
+        project = self.ada_public
+        first = Snapshot.objects.create(
+            project=project, format=SnapshotFormat.blobs.name
+        )
+        self.archive(first, {"a.txt": b"A", "b.txt": b"B"})
+        second = Snapshot.objects.create(
+            project=project, format=SnapshotFormat.blobs.name
+        )
+        self.archive(second, {"a.txt": b"A"})
+
+        # Blobs still used by another snapshot are kept
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        assert not self.storage.exists(first.manifest_location())
+        assert self.storage.exists(blob_location(fingerprint(b"A")))
+        assert not self.storage.exists(blob_location(fingerprint(b"B")))
+
+        # Blobs that an archive job that has not been dispatched,
+        # or has ended but not yet been completed (its result fetched and its
+        # callback run), relies on are kept
+        waiting = Job.objects.create(
+            project=project,
+            method=JobMethod.archive.name,
+            params=dict(format="blobs", blobs=[fingerprint(b"A")], uploads=[]),
+        )
+        ended = Job.objects.create(
+            project=project,
+            method=JobMethod.archive.name,
+            params=dict(format="blobs", blobs=[], uploads=[fingerprint(b"A")]),
+            status=JobStatus.SUCCESS.name,
+            ended=timezone.now(),
+            is_active=True,
+        )
+        for job in (waiting, ended):
+            with self.captureOnCommitCallbacks(execute=True):
+                Snapshot.objects.get(id=second.id).delete()
+            assert self.storage.exists(blob_location(fingerprint(b"A")))
+            job.status = JobStatus.SUCCESS.name
+            job.is_active = False
+            job.save()
+            second.save(force_insert=True)
+            self.archive(second, {"a.txt": b"A"})
+
+        # Once they have been completed, unused blobs are deleted
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        assert not self.storage.exists(blob_location(fingerprint(b"A")))
+        assert snapshots_storage_bytes(project.account) == 0
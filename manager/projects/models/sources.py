@@ -3,7 +3,7 @@ import logging
 import os
 import re
 from enum import Enum, unique
-from typing import Dict, List, Optional, Type, Union
+from typing import Dict, List, Optional, Tuple, Type, Union
 
 import shortuuid
 from allauth.socialaccount.models import SocialApp
@@ -22,7 +22,7 @@ from oauth2client.client import GoogleCredentials
 from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
 
-from jobs.models import Job, JobMethod
+from jobs.models import Job, JobMethod, JobStatus
 from manager.api import exceptions
 from manager.helpers import EnumChoice
 from manager.storage import uploads_storage
@@ -70,6 +70,28 @@ def NON_POLYMORPHIC_CASCADE(collector, field, sub_objs, using):
     return models.CASCADE(collector, field, sub_objs.non_polymorphic(), using)
 
 
+def parse_pull_result(
+    result: Optional[Dict],
+) -> Tuple[Optional[Dict[str, Dict]], Optional[str], bool]:
+    """
+    Parse the result of a `pull` job into its files, revision and whether it was unchanged.
+
+    Workers return a dictionary with `files`, `revision`, `unchanged` and an
+    integer `version` (currently 2). Older workers returned only the dictionary
+    of files pulled (keyed by path, with a dictionary of info for each) so results
+    without an integer `version` are treated as being of that shape.
+    """
+    if not result or not isinstance(result, dict):
+        return None, None, False
+    if isinstance(result.get("version"), int):
+        return (
+            result.get("files"),
+            result.get("revision"),
+            bool(result.get("unchanged")),
+        )
+    return result, None, False
+
+
 class Source(PolymorphicModel):
     """
     A project source.
@@ -130,6 +152,13 @@ class Source(PolymorphicModel):
         help_text="Jobs associated with this source. e.g. pull, push or convert jobs.",
     )
 
+    revision = models.TextField(
+        null=True,
+        blank=True,
+        help_text="The revision of the source when it was last pulled (e.g. a commit SHA or ETag). "
+        "Used to avoid pulling the source again if it has not changed.",
+    )
+
     # The default object manager which will fetch data from multiple
     # tables (one query for each type of source)
     objects = PolymorphicManager()
@@ -351,10 +380,32 @@ class Source(PolymorphicModel):
         Pull the source to the filesystem.
 
         Creates a job, and adds it to the source's `jobs` list.
+        If the source has been pulled before, to the same path, then the
+        revision and files from that pull are passed to the job so that it
+        can skip pulling the source again if it is unchanged.
         """
         source = self.to_address()
         source["type"] = source.type_name
 
+        params = dict(source=source, path=self.path)
+        if self.revision:
+            last = (
+                self.jobs.filter(
+                    method=JobMethod.pull.value, status=JobStatus.SUCCESS.value
+                )
+                .order_by("-id")
+                .first()
+            )
+            if (
+                last
+                and last.params
+                and last.params.get("source") == source
+                and last.params.get("path") == self.path
+            ):
+                files, revision, unchanged = parse_pull_result(last.result)
+                if files and revision == self.revision:
+                    params.update(revision=revision, files=files)
+
         description = "Pull {0}"
         if self.type_class == "UploadSource":
             description = "Collect {0}"
@@ -364,7 +415,7 @@ class Source(PolymorphicModel):
             project=self.project,
             creator=user or self.creator,
             method=JobMethod.pull.value,
-            params=dict(source=source, path=self.path),
+            params=params,
             description=description,
             secrets=self.get_secrets(user),
             **Job.create_callback(self, "pull_callback"),
@@ -377,10 +428,14 @@ class Source(PolymorphicModel):
         """
         Update the files associated with this source.
         """
-        result = job.result
-        if not result:
+        files, revision, unchanged = parse_pull_result(job.result)
+        if files is None:
             return
 
+        if revision != self.revision:
+            self.revision = revision
+            self.save(update_fields=["revision"])
+
         from projects.models.files import File, get_modified
 
         # All existing files for the source are made "non-current" (i.e. will not
@@ -405,13 +460,14 @@ class Source(PolymorphicModel):
                     encoding=info.get("encoding"),
                     fingerprint=info.get("fingerprint"),
                 )
-                for path, info in result.items()
+                for path, info in files.items()
             ]
         )
 
         # Asynchronously check whether the project's image needs to be updated given
         # that there are updated files.
-        update_image_for_project.delay(project_id=self.project.id)
+        if not unchanged:
+            update_image_for_project.delay(project_id=self.project.id)
 
     def extract(
         self, review, user: Optional[User] = None, filters: Optional[Dict] = None
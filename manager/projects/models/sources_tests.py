@@ -1,8 +1,11 @@
+from unittest import mock
+
 import pytest
 from django.core.exceptions import ValidationError
 from django.db.models import Q
 
 from accounts.models import Account, AccountTier
+from jobs.models import JobStatus
 from manager.testing import DatabaseTestCase
 from projects.models.projects import Project
 from projects.models.sources import (
@@ -16,6 +19,7 @@ from projects.models.sources import (
     SourceAddress,
     UploadSource,
     UrlSource,
+    parse_pull_result,
 )
 
 
@@ -374,6 +378,21 @@ def test_urlsource_parse_address():
         UrlSource.parse_address("foo", strict=True)
 
 
+def test_parse_pull_result():
+    files = {"a.txt": {"size": 1, "fingerprint": "abc"}}
+    assert parse_pull_result(
+        {"files": files, "revision": "1", "unchanged": True, "version": 2}
+    ) == (files, "1", True)
+
+    # Results from older workers are only the files pulled, which may
+    # have paths that are the same as the keys of newer results
+    legacy = {name: {"size": 1} for name in ("files", "revision", "unchanged")}
+    assert parse_pull_result(legacy) == (legacy, None, False)
+    assert parse_pull_result(files) == (files, None, False)
+
+    assert parse_pull_result(None) == (None, None, False)
+
+
 class SourcesTests(DatabaseTestCase):
     def test_delete_project_with_source(self):
         """
@@ -383,3 +402,64 @@ class SourcesTests(DatabaseTestCase):
         project = Project.objects.create(account=account, name="test-project")
         ElifeSource.objects.create(project=project, article=5000, path="article.xml")
         project.delete()
+
+    def test_pull_revision(self):
+        """
+        Test that the revision and files of the last pull are passed to the next.
+        """
+        account = Account.objects.create(name="test-account")
+        project = Project.objects.create(account=account, name="test-project")
+        source = UrlSource.objects.create(
+            project=project, url="https://example.org/a.txt", path="a.txt"
+        )
+        files = {"a.txt": {"size": 1, "fingerprint": "abc"}}
+
+        # A legacy result, without a revision
+        job = source.pull()
+        assert "revision" not in job.params
+        job.result = files
+        job.status = JobStatus.SUCCESS.value
+        job.save()
+        with mock.patch("projects.models.sources.update_image_for_project"):
+            source.pull_callback(job)
+        assert source.revision is None
+        assert list(
+            source.files.filter(current=True).values_list("path", flat=True)
+        ) == ["a.txt"]
+
+        job = source.pull()
+        assert "revision" not in job.params
+        job.result = {
+            "files": files,
+            "revision": "1",
+            "unchanged": False,
+            "version": 2,
+        }
+        job.status = JobStatus.SUCCESS.value
+        job.save()
+        with mock.patch("projects.models.sources.update_image_for_project") as update:
+            source.pull_callback(job)
+            update.delay.assert_called_once()
+        assert source.revision == "1"
+
+        job = source.pull()
+        assert job.params["revision"] == "1"
+        assert job.params["files"] == files
+        job.result = {
+            "files": files,
+            "revision": "1",
+            "unchanged": True,
+            "version": 2,
+        }
+        job.status = JobStatus.SUCCESS.value
+        job.save()
+        with mock.patch("projects.models.sources.update_image_for_project") as update:
+            source.pull_callback(job)
+            update.delay.assert_not_called()
+        assert source.files.filter(current=True).count() == 1
+
+        # Path changed so previous files can not be reused
+        source.path = "b.txt"
+        source.save()
+        job = source.pull()
+        assert "revision" not in job.params
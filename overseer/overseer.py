@@ -25,15 +25,16 @@ for this purpose (the results should be used for that, which is what
 `update_job` does; see https://github.com/celery/celery/issues/2190#issuecomment-51609500).
 """
 from datetime import datetime
-from typing import cast, Dict, List, Set, Union
+from typing import cast, Dict, List, Set, Tuple, Union
 import asyncio
+import concurrent.futures
 import json
 import logging
 import os
 import threading
 import time
 
-from prometheus_client import start_http_server, Summary, Gauge
+from prometheus_client import start_http_server, Counter, Histogram, Summary, Gauge
 from celery import Celery
 from celery.events.receiver import EventReceiver
 from celery.utils.objects import FallbackContext
@@ -57,19 +58,352 @@ client = httpx.AsyncClient(
 )
 
 
+# Metrics for the sender (defined here, rather than with the other metrics
+# below, because the sender thread is started before those are defined)
+
+sender_queue_depth = Gauge(
+    "overseer_sender_queue_depth", "Number of requests waiting to be sent."
+)
+
+sender_in_flight = Gauge(
+    "overseer_sender_in_flight", "Number of requests currently being sent."
+)
+
+sender_dropped = Counter(
+    "overseer_sender_dropped",
+    "Number of requests dropped because they could not be sent.",
+)
+
+sender_spooled = Counter(
+    "overseer_sender_spooled", "Number of requests written to the spool file."
+)
+
+sender_replayed = Counter(
+    "overseer_sender_replayed", "Number of requests replayed from the spool file."
+)
+
+
 class Sender(threading.Thread):
-    """A thread with an event loop to send requests to the `manager` service."""
+    """
+    A thread with an event loop to send requests to the `manager` service.
+
+    Requests are put on a bounded queue and sent by several concurrent
+    consumers. When the queue is full, the calling thread (usually the
+    main event handling thread) is blocked until there is room (i.e. back-pressure)
+    for up to `OVERSEER_QUEUE_TIMEOUT` seconds. Requests that fail
+    with a connection error, or a 5xx response, are retried with exponential backoff.
+    Requests that can not be queued, or that still fail after retrying, are appended to
+    the `OVERSEER_SPOOL_FILE` (if set) and replayed when the `manager`
+    is responding again. Otherwise, they are dropped.
+
+    If `OVERSEER_BATCH_SIZE` is greater than zero, job updates are
+    buffered and sent to the `manager` in a single request to `jobs/updates`
+    when the buffer reaches that size, or every `OVERSEER_BATCH_SECONDS`,
+    whichever happens first. This reduces the number of requests (and database
+    transactions) the `manager` has to handle during bursts of events.
+
+    Because requests are sent concurrently, retried and replayed, batches of log
+    entries for a job can arrive at the `manager` out of order. The `manager`
+    returns those that can not be appended to the job's log yet and they
+    are sent again, with exponential backoff, up to `OVERSEER_RETRY_ATTEMPTS` times.
+    """
+
+    # Maximum number of job updates to send in a single request.
+    # Zero means do not batch (send each update as a separate request).
+    batch_size = int(os.getenv("OVERSEER_BATCH_SIZE", 0))
+
+    # Maximum time to wait before sending buffered job updates
+    batch_seconds = float(os.getenv("OVERSEER_BATCH_SECONDS", 1))
+
+    # Maximum number of requests waiting to be sent
+    queue_size = int(os.getenv("OVERSEER_QUEUE_SIZE", 10000))
+
+    # Maximum time to wait for room in the queue before giving up on a request
+    queue_timeout = float(os.getenv("OVERSEER_QUEUE_TIMEOUT", 30))
+
+    # Number of requests that can be sent concurrently
+    concurrency = int(os.getenv("OVERSEER_CONCURRENCY", 10))
+
+    # Number of times to retry a failed request, and the initial
+    # time to wait between retries (doubled on each attempt)
+    retry_attempts = int(os.getenv("OVERSEER_RETRY_ATTEMPTS", 5))
+    retry_seconds = float(os.getenv("OVERSEER_RETRY_SECONDS", 0.5))
+
+    # Path of the file to spool requests to (if empty, requests are dropped instead)
+    spool_file: str = os.getenv("OVERSEER_SPOOL_FILE", "")
+
+    # How often to check whether there are spooled requests to replay
+    replay_seconds = float(os.getenv("OVERSEER_REPLAY_SECONDS", 30))
+
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.updates: List[dict] = []
+        # Number of times each deferred log batch has been sent again,
+        # and when it was first deferred
+        self.deferred: Dict[str, Tuple[int, float]] = {}
+        self.spool_lock = threading.Lock()
+        self.healthy = True
+        self.logger = logging.getLogger("overseer.Sender")
 
     def run(self):
         """Run the thread."""
-        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        sender_queue_depth.set_function(self.queue.qsize)
+
+        for _ in range(self.concurrency):
+            self.loop.create_task(self.consume())
+        if self.batch_size > 0:
+            self.loop.create_task(self.batch())
+        if self.spool_file:
+            self.loop.create_task(self.replay())
+
+        self.ready.set()
         self.loop.run_forever()
 
+    def request(self, method: str, url: str, **kwargs):
+        """
+        Queue a request to be sent.
+
+        Called from other threads. Blocks while the queue is full.
+        """
+        item = dict(method=method, url=url, **kwargs)
+        self.ready.wait()
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        try:
+            future.result(timeout=self.queue_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.overflow(item, "Queue is full")
+
+    def update_job(self, id, data: dict):
+        """Send, or buffer if batching, an update to a job."""
+        if self.batch_size > 0:
+            self.ready.wait()
+            self.loop.call_soon_threadsafe(self.buffer, dict(id=id, **data))
+        else:
+            self.request("PATCH", "jobs/{}".format(id), json=data)
+
+    def resend_job(self, id, data: dict):
+        """
+        Send, or buffer if batching, an update to a job again.
+
+        Called within the thread's event loop so can not block
+        waiting for room in the queue.
+        """
+        if self.batch_size > 0:
+            self.buffer(dict(id=id, **data))
+        else:
+            item = dict(method="PATCH", url="jobs/{}".format(id), json=data)
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.overflow(item, "Queue is full")
+
+    def retry_updates(self, updates: List[dict]):
+        """
+        Schedule job updates deferred by the `manager` to be sent again.
+
+        Called within the thread's event loop so does not need locking.
+        """
+        now = time.monotonic()
+
+        # Forget batches deferred long enough ago that they must have
+        # been appended, or given up on
+        window = (
+            self.retry_seconds * 2 ** (self.retry_attempts + 1) + self.replay_seconds
+        )
+        self.deferred = dict(
+            (key, value)
+            for key, value in self.deferred.items()
+            if now - value[1] < window
+        )
+
+        for update in updates:
+            data = dict(update)
+            id = data.pop("id")
+            key = "{0}:{1}".format(id, data.get("log_seq"))
+            attempt, first = self.deferred.pop(key, (0, now))
+            if attempt >= self.retry_attempts:
+                self.logger.warning(
+                    "Dropped deferred log entries for job {0} from {1}".format(
+                        id, data.get("log_seq")
+                    )
+                )
+                sender_dropped.inc()
+                continue
 
-# Start the sender
-sender = Sender()
-sender.daemon = True
-sender.start()
+            self.deferred[key] = (attempt + 1, first)
+            self.loop.call_later(
+                self.retry_seconds * 2 ** attempt, self.resend_job, id, data
+            )
+
+    def buffer(self, update: dict):
+        """
+        Add a job update to the buffer.
+
+        Called within the thread's event loop so does not need locking.
+        """
+        self.updates.append(update)
+        if len(self.updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Queue any buffered job updates as a single request."""
+        if self.updates:
+            updates, self.updates = self.updates, []
+            item = dict(method="POST", url="jobs/updates", json=updates)
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.overflow(item, "Queue is full")
+
+    async def batch(self):
+        """Periodically flush the buffer."""
+        while True:
+            await asyncio.sleep(self.batch_seconds)
+            self.flush()
+
+    async def consume(self):
+        """Take requests off the queue and send them."""
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.send(item)
+            except Exception:
+                self.logger.exception("Unexpected error sending request")
+            finally:
+                self.queue.task_done()
+
+    async def send(self, item: dict):
+        """Send a request, retrying with exponential backoff if necessary."""
+        delay = self.retry_seconds
+        for attempt in range(self.retry_attempts + 1):
+            if attempt > 0:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+            sender_in_flight.inc()
+            try:
+                response = await client.send(client.build_request(**item))
+            except httpx.HTTPError as exc:
+                error = str(exc)
+            else:
+                if response.status_code < 500:
+                    self.healthy = True
+                    if response.is_error:
+                        self.logger.warning(
+                            "Error response from manager for {0} {1}: {2}".format(
+                                item["method"], item["url"], response.status_code
+                            )
+                        )
+                    elif response.content:
+                        self.retry_updates(response.json().get("retry", []))
+                    return
+                error = "Status {}".format(response.status_code)
+            finally:
+                sender_in_flight.dec()
+
+            self.healthy = False
+            self.logger.debug(
+                "Attempt {0} to send {1} {2} failed: {3}".format(
+                    attempt + 1, item["method"], item["url"], error
+                )
+            )
+
+        self.overflow(item, error)
+
+    def overflow(self, item: dict, reason: str):
+        """
+        Handle a request that could not be queued or sent.
+
+        Appends the request to the spool file, if configured, otherwise drops it.
+        Called from both the main thread and the sender thread.
+        """
+        if self.spool_file:
+            with self.spool_lock, open(self.spool_file, "a") as file:
+                file.write(json.dumps(item) + "\n")
+            sender_spooled.inc()
+        else:
+            self.logger.warning(
+                "Dropped request {0} {1}: {2}".format(
+                    item["method"], item["url"], reason
+                )
+            )
+            sender_dropped.inc()
+
+    async def probe(self):
+        """Check whether the `manager` is responding again."""
+        try:
+            response = await client.get("status")
+        except httpx.HTTPError:
+            return
+        self.healthy = response.status_code < 500
+
+    async def replay_spool(self, replay_file: str):
+        """Replay spooled requests, if any, by putting them back on the queue."""
+        if not self.healthy and os.path.exists(self.spool_file):
+            await self.probe()
+
+        if os.path.exists(replay_file) or (
+            self.healthy and os.path.exists(self.spool_file)
+        ):
+            if not os.path.exists(replay_file):
+                with self.spool_lock:
+                    os.rename(self.spool_file, replay_file)
+
+            try:
+                # Parse all requests before queueing any so that a malformed
+                # line (e.g. one truncated when the process was killed) can not
+                # cause requests to be queued again on the next replay
+                items = []
+                with open(replay_file) as file:
+                    for number, line in enumerate(file, 1):
+                        if not line.strip():
+                            continue
+                        try:
+                            items.append(json.loads(line))
+                        except ValueError as exc:
+                            self.logger.warning(
+                                "Skipped malformed spooled request on line {0}: {1}".format(
+                                    number, exc
+                                )
+                            )
+
+                for item in items:
+                    await self.queue.put(item)
+                    sender_replayed.inc()
+            finally:
+                os.unlink(replay_file)
+            self.logger.info("Replayed {} spooled requests".format(len(items)))
+
+    async def replay(self):
+        """
+        Periodically replay any spooled requests.
+
+        If the last request failed, the `manager` is probed before
+        replaying. The spool file is renamed before being read so that requests that
+        fail again are appended to a new spool file. A `.replay` file left over
+        from a previous process (e.g. one that was killed during replay) is
+        replayed first.
+        """
+        replay_file = self.spool_file + ".replay"
+        while True:
+            try:
+                await self.replay_spool(replay_file)
+            except Exception:
+                self.logger.exception("Unexpected error replaying spooled requests")
+
+            await asyncio.sleep(self.replay_seconds)
+
+
+# Start the sender (unless imported e.g. for testing)
+if __name__ == "__main__":
+    sender = Sender()
+    sender.daemon = True
+    sender.start()
 
 
 def request(method: str, url: str, **kwargs):
@@ -77,10 +411,10 @@ def request(method: str, url: str, **kwargs):
     Get the sender thread to send a request to the `manager`.
 
     To maximize throughput of events, and because it is not necessary to
-    get the respone, this is "fire and forget".
+    get the respone, this is "fire and forget" (apart from blocking
+    when the sender's queue is full).
     """
-    request = client.build_request(method=method, url=url, **kwargs)
-    asyncio.run_coroutine_threadsafe(client.send(request), sender.loop)
+    sender.request(method, url, **kwargs)
 
 
 Event = Dict[str, Union[str, int, float]]
@@ -100,10 +434,11 @@ def update_job(id, data: dict):
     """
     Update a job.
 
-    Sends a PATCH request to the `manager` to update the
-    state of the job. Reused below for individual task event handlers.
+    Sends a PATCH request (or if batching, a POST request for
+    several jobs) to the `manager` to update the state of the job.
+    Reused below for individual task event handlers.
     """
-    request("PATCH", "jobs/{}".format(id), json=data)
+    sender.update_job(id, data)
 
 
 def task_sent(event: Event):
@@ -169,6 +504,16 @@ def task_updated(event: Event):
         if value:
             data.update({field: value})
 
+    # Log entries are sent in batches with the sequence number (index) of the
+    # first entry so that the `manager` can append them to the job's log
+    if "log" in data and event.get("log_seq") is not None:
+        data["log_seq"] = event["log_seq"]
+
+    # Sessions report how they were started, and how long each phase took
+    session_start = event.get("session_start")
+    if isinstance(session_start, dict):
+        observe_session_start(session_start)
+
     update_job(event["task_id"], data)
 
 
@@ -310,6 +655,38 @@ queue_length_worker_ratio = Gauge(
 )
 
 
+session_start_buckets = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+session_start_seconds = Histogram(
+    "overseer_session_start_seconds",
+    "Time taken to start sessions, by whether a pre-started pod was claimed or one was cold started.",
+    ["method", "container_image", "node_pool"],
+    buckets=session_start_buckets,
+)
+
+session_start_phase_seconds = Histogram(
+    "overseer_session_start_phase_seconds",
+    "Time taken to get to each phase of session start up from the previous phase.",
+    ["phase", "container_image", "node_pool"],
+    buckets=session_start_buckets,
+)
+
+
+def observe_session_start(start: dict):
+    """
+    Record the start up time, and the duration of each phase, of a session.
+
+    See `KubernetesSession.do` in `worker` for the phases.
+    """
+    image = start.get("container_image", "")
+    pool = start.get("node_pool", "")
+    session_start_seconds.labels(start.get("method", "cold"), image, pool).observe(
+        start.get("seconds", 0)
+    )
+    for phase, seconds in (start.get("durations") or {}).items():
+        session_start_phase_seconds.labels(phase, image, pool).observe(seconds)
+
+
 class Collector(threading.Thread):
     """
     A thread for collecting information on queues and workers.
@@ -456,15 +833,16 @@ class Collector(threading.Thread):
             time.sleep(self.periodicity_seconds)
 
 
-# Start the HTTP server to expose metrics
-start_http_server(4040)
+if __name__ == "__main__":
+    # Start the HTTP server to expose metrics
+    start_http_server(4040)
 
-# Start the collector
-collector = Collector(app=app)
-collector.daemon = True
-collector.start()
+    # Start the collector
+    collector = Collector(app=app)
+    collector.daemon = True
+    collector.start()
 
-# Start the receiver
-with app.connection() as connection:
-    receiver = Receiver(connection)
-    receiver.capture(limit=None, timeout=None, wakeup=True)
+    # Start the receiver
+    with app.connection() as connection:
+        receiver = Receiver(connection)
+        receiver.capture(limit=None, timeout=None, wakeup=True)
@@ -0,0 +1,37 @@
+"""Tests for the overseer's sender."""
+import asyncio
+import os
+
+os.environ.setdefault("BROKER_URL", "memory://")
+os.environ.setdefault("MANAGER_URL", "http://manager")
+
+from overseer import Sender  # noqa: E402
+
+
+def test_replay_spool_malformed(tmp_path):
+    """Malformed spooled requests are skipped and the replay file is removed."""
+    spool_file = str(tmp_path / "spool")
+    replay_file = spool_file + ".replay"
+    with open(spool_file, "w") as file:
+        file.write('{"method": "POST", "url": "jobs/1"}\n')
+        file.write('{"method": "POST", "url": "jo\n')
+        file.write("\n")
+        file.write('{"method": "PATCH", "url": "jobs/2"}\n')
+
+    sender = Sender()
+    sender.spool_file = spool_file
+
+    async def replay():
+        sender.queue = asyncio.Queue()
+        await sender.replay_spool(replay_file)
+        return [sender.queue.get_nowait() for _ in range(sender.queue.qsize())]
+
+    assert asyncio.run(replay()) == [
+        {"method": "POST", "url": "jobs/1"},
+        {"method": "PATCH", "url": "jobs/2"},
+    ]
+    assert not os.path.exists(spool_file)
+    assert not os.path.exists(replay_file)
+
+    # Nothing is replayed again
+    assert asyncio.run(replay()) == []
@@ -50,6 +50,41 @@ def get_content_root() -> str:
     return os.environ.get("CONTENT_ROOT", os.path.join(STORAGE_ROOT, "content"))
 
 
+def get_manifests_root() -> str:
+    """
+    Get the root of the file manifest storage.
+
+    Manifests record information on the files in a directory (e.g. a
+    project's working directory) so that unchanged files do not need
+    to be fingerprinted again. They are stored outside of the directory
+    itself so that they do not get listed, archived or cleaned along with it.
+    """
+    return os.environ.get("MANIFESTS_ROOT", os.path.join(STORAGE_ROOT, "manifests"))
+
+
+def get_manifests_verify() -> bool:
+    """
+    Get whether the information in file manifests should be verified.
+
+    Useful for checking that the manifest is not returning stale
+    information (e.g. on filesystems with coarse modification times).
+    """
+    return os.environ.get("MANIFESTS_VERIFY", "").lower() in ("1", "true", "yes")
+
+
+def get_files_workers() -> int:
+    """
+    Get the number of threads to use when getting information on files.
+
+    Fingerprinting files is mostly I/O and `hashlib` (which releases the GIL)
+    bound so using several threads speeds up listing directories with many files.
+    """
+    workers = os.environ.get("FILES_WORKERS")
+    if workers:
+        return max(1, int(workers))
+    return min(8, os.cpu_count() or 1)
+
+
 def get_node_modules_bin(name: str) -> str:
     """
     Get the path to a "bin" script installed in the configured `node_modules`.
@@ -1,17 +1,27 @@
+import hashlib
+import io
 import logging
 import os
 import shutil
 import tempfile
-from typing import Optional
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import httpx
+from stream_zip import ZIP_32, ZIP_AUTO, Method, stream_zip
 
-from config import get_snapshot_dir
+from config import get_files_workers, get_snapshot_dir, get_snapshots_root
 from jobs.base.job import Job
-from util.files import Files, ensure_dir, list_files
+from util.files import Files, ensure_dir, ensure_parent, file_mimetype, list_files
+from util.manifest import Manifest
 
 logger = logging.getLogger(__name__)
 
+# Size of chunks read from files, and of the chunks of the archive sent
+ZIP_CHUNK_SIZE = 1024 * 1024
+
 
 class Archive(Job):
     """
@@ -20,6 +30,20 @@ class Archive(Job):
     Previously, we copied all files to the snapshot dir. However, because there were
     performance and reliability issues with that, we now only copy `index.html` and
     related files. This is a temporary measure until we place these in a separate bucket.
+
+    Snapshots can be in one of two formats. For the `zip` format, the working directory
+    is archived into a zip file which is uploaded to `path`. For the `blobs` format, each
+    file is stored once, named by its fingerprint, in a content-addressed blob area under
+    the `path` prefix. This is done in two jobs. The first, without `uploads`, only lists
+    the files and their fingerprints. The manager then works out which blobs are not
+    already stored and creates a second job to upload those (`uploads`), with an upload
+    policy for each, in `secrets`, keyed by fingerprint. Every file must either be in
+    `uploads` or `blobs` (the fingerprints of blobs already stored e.g. for previous
+    snapshots). The manager records the path and fingerprint of each file as the
+    snapshot's manifest.
+
+    Returns the `files` archived and, for the `zip` format, the SHA256 `fingerprint`
+    of the zip archive (so that it can be verified when it is fetched for a session).
     """
 
     name = "archive"
@@ -31,14 +55,15 @@ class Archive(Job):
         path: str,
         url: Optional[str],
         secrets: Optional[dict],
+        format: str = "zip",
+        blobs: Optional[List[str]] = None,
+        uploads: Optional[List[str]] = None,
         **kwargs,
-    ) -> Files:
+    ) -> Dict:
         assert isinstance(project, int)
         assert isinstance(snapshot, str)
         assert isinstance(path, str)
 
-        files = list_files()
-
         # This section is temporary, in future index.html will be
         # placed in content storage.
         snapshot_dir = get_snapshot_dir(project, snapshot)
@@ -50,20 +75,246 @@ class Archive(Job):
                 "index.html.media", os.path.join(snapshot_dir, "index.html.media")
             )
 
-        temp_zip_base_name = tempfile.NamedTemporaryFile().name
-        shutil.make_archive(temp_zip_base_name, "zip", ".")
-        temp_zip_file_name = temp_zip_base_name + ".zip"
+        if format == "blobs":
+            if uploads is None:
+                return dict(files=list_files(".", manifest=True))
+            return dict(
+                files=archive_blobs(path, url, secrets or {}, blobs or [], uploads)
+            )
+
+        # Stream the zip archive directly to its destination (rather than
+        # writing it to a temporary file first). Files are fingerprinted
+        # as they are added to the archive so that each is only read once.
+        files: Files = {}
+        h = hashlib.sha256()
+
+        def fingerprinted(chunks: Iterator[bytes]) -> Iterator[bytes]:
+            for chunk in chunks:
+                h.update(chunk)
+                yield chunk
+
+        chunks = fingerprinted(zip_directory(".", files))
 
         if url:
+            boundary = uuid.uuid4().hex
             response = httpx.post(
-                url, data=secrets, files={"file": open(temp_zip_file_name, "rb")}
+                url,
+                content=multipart_body(
+                    secrets or {}, "file", os.path.basename(path), chunks, boundary
+                ),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+                timeout=60,
             )
             response.raise_for_status()
         else:
             # In development simulate POSTing by copying to the snapshot storage
             logger.warning("No URL was supplied, copying to snapshot dir")
-            from config import get_snapshots_root
+            with open(ensure_parent(get_snapshots_root(), path), "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+
+        return dict(files=files, fingerprint=h.hexdigest())
+
+
+def zip_directory(directory: str, files: Files) -> Iterator[bytes]:
+    """
+    Generate a zip archive of a directory in chunks.
+
+    As each file is added to the archive, it is fingerprinted and information
+    on it is added to `files`. The directory's manifest is used to avoid
+    sniffing the mimetype of files that have not changed, and updated with the
+    fingerprints.
+    """
+    manifest = Manifest.load(directory)
+
+    def member(path: str, name: str, stat: os.stat_result) -> Iterator[bytes]:
+        h = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(ZIP_CHUNK_SIZE), b""):
+                h.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+        entry = manifest.get(path, stat)
+        if entry:
+            mimetype, encoding = entry["mimetype"], entry["encoding"]
+        else:
+            mimetype, encoding = file_mimetype(path)
+
+        info = {
+            "size": size,
+            "mimetype": mimetype,
+            "encoding": encoding,
+            "modified": stat.st_mtime,
+            "fingerprint": h.hexdigest(),
+        }
+        files[name] = info
+        manifest.set(path, stat, info)
+
+    def members() -> Iterator[Tuple[str, datetime, int, Method, Iterable[bytes]]]:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            relative_dir = os.path.relpath(dirpath, directory)
+            if relative_dir != ".":
+                stat = os.stat(dirpath)
+                yield (
+                    relative_dir + "/",
+                    datetime.fromtimestamp(stat.st_mtime),
+                    stat.st_mode,
+                    ZIP_32,
+                    (),
+                )
+
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.normpath(os.path.join(relative_dir, filename))
+                stat = os.stat(path)
+                yield (
+                    name,
+                    datetime.fromtimestamp(stat.st_mtime),
+                    stat.st_mode,
+                    ZIP_AUTO(stat.st_size),
+                    member(path, name, stat),
+                )
+
+    yield from stream_zip(members(), chunk_size=ZIP_CHUNK_SIZE)
+    manifest.save()
+
+
+def archive_blobs(
+    prefix: str,
+    url: Optional[str],
+    secrets: Dict[str, dict],
+    blobs: List[str],
+    uploads: List[str],
+) -> Files:
+    """
+    Store the files in the current directory as content-addressed blobs.
+
+    Only files with fingerprints in `uploads` are stored, each using the
+    upload policy for its fingerprint in `secrets`. Blobs are uploaded in parallel.
+    Raises an error if a file is neither in `uploads` nor `blobs` (e.g. because
+    it was changed after the files were listed) since there is nowhere to store it.
+    """
+    files = list_files(".", manifest=True)
+
+    known = set(blobs)
+    wanted = set(uploads)
+    missing: Dict[str, str] = {}
+    for name, info in files.items():
+        fingerprint = info["fingerprint"]
+        if fingerprint in wanted:
+            missing.setdefault(fingerprint, name)
+        elif fingerprint not in known:
+            raise RuntimeError(f"File '{name}' changed while it was being archived")
+
+    logger.info(
+        f"Storing {len(missing)} new blobs for {len(files)} files "
+        f"({len(files) - len(missing)} already stored)"
+    )
+
+    with httpx.Client(timeout=60) as client, ThreadPoolExecutor(
+        max_workers=get_files_workers()
+    ) as executor:
+        futures = [
+            executor.submit(
+                store_blob,
+                name,
+                blob_path(prefix, fingerprint),
+                url,
+                secrets.get(fingerprint),
+                client,
+            )
+            for fingerprint, name in missing.items()
+        ]
+        for future in futures:
+            future.result()
+
+    return files
+
 
-            shutil.copy(temp_zip_file_name, os.path.join(get_snapshots_root(), path))
+def blob_path(prefix: str, fingerprint: str) -> str:
+    """
+    Get the path of a blob within the blob area.
+
+    Blobs are sharded into sub-directories using the first two characters of
+    their fingerprint to avoid having very large directories.
+    """
+    return f"{prefix}{fingerprint[:2]}/{fingerprint}"
 
-        return files
+
+def store_blob(
+    source: str,
+    path: str,
+    url: Optional[str],
+    secrets: Optional[dict],
+    client: httpx.Client,
+) -> None:
+    """
+    Store a file as a blob at `path`.
+
+    If a `url` is supplied, the file is POSTed to it, using the `secrets`
+    as the fields of the upload policy. Otherwise, in development, the file is
+    copied to the snapshot storage (via a temporary file so that a partially
+    written blob is never visible).
+    """
+    if url:
+
+        def chunks() -> Iterator[bytes]:
+            with open(source, "rb") as file:
+                yield from iter(lambda: file.read(ZIP_CHUNK_SIZE), b"")
+
+        boundary = uuid.uuid4().hex
+        response = client.post(
+            url,
+            content=multipart_body(
+                {**(secrets or {}), "key": path},
+                "file",
+                os.path.basename(path),
+                chunks(),
+                boundary,
+                "application/octet-stream",
+            ),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        response.raise_for_status()
+    else:
+        dest = os.path.join(get_snapshots_root(), path)
+        if os.path.exists(dest):
+            return
+        ensure_parent(dest)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(dest), suffix=".tmp", delete=False
+        ) as temp:
+            with open(source, "rb") as file:
+                shutil.copyfileobj(file, temp, ZIP_CHUNK_SIZE)
+        os.replace(temp.name, dest)
+
+
+def multipart_body(
+    fields: Dict[str, str],
+    name: str,
+    filename: str,
+    chunks: Iterator[bytes],
+    boundary: str,
+    content_type: str = "application/zip",
+) -> Iterator[bytes]:
+    """
+    Generate a `multipart/form-data` body with a file field streamed from `chunks`.
+
+    Used instead of `httpx`'s `files` argument, which requires a file-like object
+    that can be read (and has a known length) before the request is sent.
+    """
+    for key, value in fields.items():
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{key}"\r\n\r\n'
+            f"{value}\r\n"
+        ).encode()
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode()
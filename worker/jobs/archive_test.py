@@ -0,0 +1,168 @@
+import hashlib
+import io
+import os
+from unittest import mock
+from zipfile import ZipFile
+
+import pytest
+
+from util.working_directory import working_directory
+
+from .archive import Archive, multipart_body, zip_directory
+
+
+@pytest.fixture(autouse=True)
+def setup(tmp_path, monkeypatch):
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+    monkeypatch.setenv("SNAPSHOT_ROOT", str(tmp_path / "snapshots"))
+
+    project = tmp_path / "project"
+    (project / "dir" / "empty").mkdir(parents=True)
+    (project / "index.html").write_text("<h1>Hello</h1>")
+    (project / "dir" / "data.bin").write_bytes(os.urandom(3 * 1024 * 1024))
+
+
+def test_zip_directory(tmp_path):
+    files = {}
+    data = b"".join(zip_directory(str(tmp_path / "project"), files))
+
+    with ZipFile(io.BytesIO(data)) as zip_file:
+        assert sorted(zip_file.namelist()) == [
+            "dir/",
+            "dir/data.bin",
+            "dir/empty/",
+            "index.html",
+        ]
+        for name, info in files.items():
+            content = zip_file.read(name)
+            assert info["size"] == len(content)
+            assert info["fingerprint"] == hashlib.sha256(content).hexdigest()
+
+    assert files["index.html"]["mimetype"] == "text/html"
+
+
+def test_multipart_body():
+    body = b"".join(
+        multipart_body({"key": "a/b.zip"}, "file", "b.zip", iter([b"PK", b".."]), "XX")
+    )
+    assert body == (
+        b"--XX\r\n"
+        b'Content-Disposition: form-data; name="key"\r\n\r\n'
+        b"a/b.zip\r\n"
+        b"--XX\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="b.zip"\r\n'
+        b"Content-Type: application/zip\r\n\r\n"
+        b"PK..\r\n"
+        b"--XX--\r\n"
+    )
+
+
+def test_archive_no_url(tmp_path):
+    with working_directory(str(tmp_path / "project")):
+        result = Archive().do(1, "snap", "1/snap/snap.zip", None, None)
+
+    assert sorted(result["files"].keys()) == ["dir/data.bin", "index.html"]
+    assert os.path.exists(tmp_path / "snapshots" / "1" / "snap" / "index.html")
+    archive = tmp_path / "snapshots" / "1" / "snap" / "snap.zip"
+    assert result["fingerprint"] == hashlib.sha256(archive.read_bytes()).hexdigest()
+    with ZipFile(archive) as zip_file:
+        assert zip_file.read("index.html") == b"<h1>Hello</h1>"
+
+
+def test_archive_url(tmp_path):
+    bodies = []
+
+    def post(url, content, headers, **kwargs):
+        bodies.append(b"".join(content))
+        return mock.MagicMock()
+
+    with working_directory(str(tmp_path / "project")), mock.patch(
+        "httpx.post", side_effect=post
+    ):
+        result = Archive().do(
+            1, "snap", "1/snap/snap.zip", "https://example.org", {"key": "value"}
+        )
+
+    assert sorted(result["files"].keys()) == ["dir/data.bin", "index.html"]
+    assert b'name="key"\r\n\r\nvalue\r\n' in bodies[0]
+    assert b'filename="snap.zip"' in bodies[0]
+
+
+def test_archive_blobs_no_url(tmp_path):
+    project = tmp_path / "project"
+    (project / "copy.html").write_text("<h1>Hello</h1>")
+    index = hashlib.sha256(b"<h1>Hello</h1>").hexdigest()
+    data = hashlib.sha256((project / "dir" / "data.bin").read_bytes()).hexdigest()
+    blobs = tmp_path / "snapshots" / "blobs"
+
+    # Without `uploads`, files are only listed
+    with working_directory(str(project)):
+        files = Archive().do(1, "snap", "blobs/", None, None, format="blobs")["files"]
+    assert sorted(files.keys()) == ["copy.html", "dir/data.bin", "index.html"]
+    assert files["copy.html"]["fingerprint"] == index
+    assert not blobs.exists()
+
+    with working_directory(str(project)):
+        Archive().do(
+            1,
+            "snap",
+            "blobs/",
+            None,
+            None,
+            format="blobs",
+            blobs=[data],
+            uploads=[index],
+        )
+
+    # Files with the same content are stored once, and known blobs are not stored
+    assert [str(path.relative_to(blobs)) for path in blobs.glob("*/*")] == [
+        f"{index[:2]}/{index}"
+    ]
+    assert (blobs / index[:2] / index).read_text() == "<h1>Hello</h1>"
+
+    # Files that are neither to be uploaded nor already stored are an error
+    (project / "copy.html").write_text("<h1>Changed</h1>")
+    with working_directory(str(project)), pytest.raises(RuntimeError):
+        Archive().do(
+            1,
+            "snap",
+            "blobs/",
+            None,
+            None,
+            format="blobs",
+            blobs=[data],
+            uploads=[index],
+        )
+
+
+def test_archive_blobs_url(tmp_path):
+    bodies = []
+
+    def post(url, content, headers, **kwargs):
+        bodies.append(b"".join(content))
+        return mock.MagicMock()
+
+    index = hashlib.sha256(b"<h1>Hello</h1>").hexdigest()
+    data = hashlib.sha256(
+        (tmp_path / "project" / "dir" / "data.bin").read_bytes()
+    ).hexdigest()
+    with working_directory(str(tmp_path / "project")), mock.patch(
+        "httpx.Client.post", side_effect=post
+    ):
+        Archive().do(
+            1,
+            "snap",
+            "blobs/",
+            "https://example.org",
+            {index: {"policy": "xyz"}, data: {"policy": "abc"}},
+            format="blobs",
+            blobs=[],
+            uploads=[index, data],
+        )
+
+    # Each blob is uploaded using its own policy
+    assert len(bodies) == 2
+    body = [body for body in bodies if b"<h1>Hello</h1>" in body][0]
+    assert b'name="policy"\r\n\r\nxyz\r\n' in body
+    assert f'name="key"\r\n\r\nblobs/{index[:2]}/{index}\r\n'.encode() in body
+    assert b"Content-Type: application/octet-stream" in body
@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 import traceback
 from datetime import datetime
 from typing import Any, List, Optional
@@ -22,6 +24,12 @@ WARN = 1
 INFO = 2
 DEBUG = 3
 
+# Log entries are sent to the `overseer` in batches. A batch is sent when
+# this many seconds have passed since the last one, or when the messages of
+# the unsent entries exceed this many bytes
+LOG_FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", 1))
+LOG_FLUSH_BYTES = int(os.getenv("LOG_FLUSH_BYTES", 64 * 1024))
+
 # Get the Celery logger
 logger = get_task_logger(__name__)
 
@@ -51,6 +59,14 @@ class Job(celery.Task):
 
         self.task_id = None
         self.log_entries: List[Any] = []
+        self.log_sent = 0
+        self.log_bytes = 0
+        self.log_flushed = 0.0
+        self.log_timer: Optional[threading.Timer] = None
+        # Guards the log state and every call to `send_event` (log entries
+        # may be flushed from the timer's thread, and the connection used
+        # to send events is not thread safe)
+        self.log_lock = threading.RLock()
 
     def begin(self, task_id=None):
         """
@@ -61,29 +77,48 @@ class Job(celery.Task):
         initialization in advance.
         """
         self.task_id = task_id
-        self.log_entries = []
+        with self.log_lock:
+            if self.log_timer:
+                self.log_timer.cancel()
+                self.log_timer = None
+            self.log_entries = []
+            self.log_sent = 0
+            self.log_bytes = 0
+            self.log_flushed = 0.0
 
     def notify(self, state="RUNNING", **kwargs):
         """
         Send a notification to the `overseer` service.
 
-        Used to update the status, url, log etc of a job.
+        Used to update the status, url, log etc of a job. May be called
+        from the log timer's thread, so events are sent while holding the lock.
         """
         if self.task_id:
-            self.send_event(
-                "task-updated", task_id=self.task_id, state=state, **kwargs,
-            )
+            with self.log_lock:
+                self.send_event(
+                    "task-updated", task_id=self.task_id, state=state, **kwargs,
+                )
 
     def flush(self):
         """
         Flush the log.
 
-        In the future this may be more intelligent and buffer
-        sending of log events to reduce the number
-        of requests.
+        Sends the log entries that have not yet been sent, along with
+        the sequence number (the index in the log) of the first of them,
+        so that the `manager` can append them to the job's log.
         """
-        if len(self.log_entries):
-            self.notify(log=self.log_entries)
+        with self.log_lock:
+            if self.log_timer:
+                self.log_timer.cancel()
+                self.log_timer = None
+
+            seq = self.log_sent
+            entries = self.log_entries[seq:]
+            if entries:
+                self.notify(log=entries, log_seq=seq)
+                self.log_sent = seq + len(entries)
+                self.log_bytes = 0
+                self.log_flushed = time.monotonic()
 
     def log(self, level: int, message: str):
         """
@@ -97,6 +132,9 @@ class Job(celery.Task):
           state with the log as metadata thereby making the
           log and any extra details available to the `manager`.
           (see the `update_job` there for how these are extracted)
+
+        To avoid sending many small updates, entries are flushed
+        in batches (see `LOG_FLUSH_SECONDS` and `LOG_FLUSH_BYTES`).
         """
         log_message = "Job {0}: {1}".format(self.name, message)
         log_extra = {"task_id": self.task_id, "job_method": self.name}
@@ -109,10 +147,21 @@ class Job(celery.Task):
         else:
             logger.error(log_message, extra=log_extra)
 
-        self.log_entries.append(
-            dict(time=datetime.utcnow().isoformat(), level=level, message=message)
-        )
-        self.flush()
+        with self.log_lock:
+            self.log_entries.append(
+                dict(time=datetime.utcnow().isoformat(), level=level, message=message)
+            )
+            self.log_bytes += len(message)
+
+            # Flush now if enough time has passed, or there is enough to send.
+            # Otherwise, ensure that the entry is flushed later.
+            wait = LOG_FLUSH_SECONDS - (time.monotonic() - self.log_flushed)
+            if wait <= 0 or self.log_bytes >= LOG_FLUSH_BYTES:
+                self.flush()
+            elif self.log_timer is None:
+                self.log_timer = threading.Timer(wait, self.flush)
+                self.log_timer.daemon = True
+                self.log_timer.start()
 
     def error(self, message: str):
         """Log an error message."""
@@ -137,6 +186,7 @@ class Job(celery.Task):
         This method bundles the job result and the log together
         and returns them both as the Celery task result.
         """
+        self.flush()
         return dict(result=serialize(result), log=self.log_entries)
 
     def terminated(self):
@@ -163,6 +213,7 @@ class Job(celery.Task):
         by Celery (e.g. the job marked with `FAILURE`). However, before
         doing so it reports the error to Sentry.
         """
+        self.flush()
         sentry_sdk.capture_exception(exc)
         # Stringify the original exception to avoid issues that Celery has
         # with pickling some types of exceptions
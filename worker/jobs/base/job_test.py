@@ -1,3 +1,4 @@
+import time
 from unittest import mock
 
 import pytest
@@ -7,7 +8,7 @@ from .job import DEBUG, ERROR, INFO, WARN, Job
 
 
 def test_logging():
-    """On each log entry send_event is called with the log."""
+    """On each log entry send_event is called with the new log entries."""
     job = Job()
     job.begin(task_id=4321)
 
@@ -17,9 +18,10 @@ def test_logging():
         assert event == "task-updated"
         current["state"] = kwargs.get("state")
         current["log"] = kwargs.get("log")
+        current["log_seq"] = kwargs.get("log_seq")
 
-    with mock.patch(
-        "celery.Task.send_event", new=send_event,
+    with mock.patch("celery.Task.send_event", new=send_event,), mock.patch(
+        "jobs.base.job.LOG_FLUSH_SECONDS", 0
     ):
 
         for index, level in enumerate(["error", "warn", "info", "debug"]):
@@ -30,7 +32,72 @@ def test_logging():
             assert log["level"] == index
             assert log["message"] == "{} message".format(level)
             assert current["state"] == "RUNNING"
-            assert current["log"] == job.log_entries
+            assert current["log"] == [log]
+            assert current["log_seq"] == index
+
+
+def test_logging_batches():
+    """Log entries are sent in batches."""
+    job = Job()
+    job.begin(task_id=4321)
+
+    sent = []
+
+    def send_event(self, event, **kwargs):
+        sent.append((kwargs.get("log_seq"), kwargs.get("log")))
+
+    with mock.patch("celery.Task.send_event", new=send_event,), mock.patch(
+        "jobs.base.job.LOG_FLUSH_SECONDS", 0.2
+    ), mock.patch("jobs.base.job.LOG_FLUSH_BYTES", 20):
+        # First entry is sent straight away, subsequent ones are batched
+        job.info("one")
+        job.info("two")
+        job.info("three")
+        assert sent == [(0, job.log_entries[:1])]
+
+        # Sent when enough bytes are pending
+        job.info("a long message")
+        assert sent[1] == (1, job.log_entries[1:4])
+
+        # Sent after enough time has passed
+        job.info("four")
+        assert len(sent) == 2
+        time.sleep(0.5)
+        assert sent[2] == (4, job.log_entries[4:5])
+
+        # Any remaining entries are sent on success
+        job.info("five")
+        job.success(None)
+        assert sent[3] == (5, job.log_entries[5:6])
+        assert len(sent) == 4
+
+
+def test_logging_thread_safe():
+    """Events sent by the log timer never overlap with those sent by the job."""
+    job = Job()
+    job.begin(task_id=4321)
+
+    sending = []
+    overlapped = []
+
+    def send_event(self, event, **kwargs):
+        if sending:
+            overlapped.append(kwargs)
+        sending.append(kwargs)
+        time.sleep(0.1)
+        sending.pop()
+
+    with mock.patch("celery.Task.send_event", new=send_event,), mock.patch(
+        "jobs.base.job.LOG_FLUSH_SECONDS", 0.01
+    ):
+        job.info("one")
+        # Flushed by the timer while the job is sending another event
+        job.info("two")
+        job.notify(state="RUNNING", url="/")
+        time.sleep(0.3)
+
+    assert job.log_sent == 2
+    assert overlapped == []
 
 
 def test_success():
@@ -1,11 +1,25 @@
-import io
 import json
+import logging
+import os
+import selectors
 import subprocess
-import threading
-from typing import List, Optional, Union
+import tempfile
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union
 
 from .job import DEBUG, ERROR, INFO, WARN, Job
 
+logger = logging.getLogger(__name__)
+
+# Size of chunks read from, and written to, the subprocess's streams
+SUBPROCESS_CHUNK_SIZE = int(os.getenv("SUBPROCESS_CHUNK_SIZE", 64 * 1024))
+
+# Maximum bytes of `stdout` to hold in memory (when it is the job's result)
+# before spilling to a temporary file
+SUBPROCESS_STDOUT_MEMORY = int(os.getenv("SUBPROCESS_STDOUT_MEMORY", 16 * 1024 * 1024))
+
+# Maximum bytes of non-JSON `stderr` to keep for the job's log
+SUBPROCESS_STDERR_MAX = int(os.getenv("SUBPROCESS_STDERR_MAX", 1024 * 1024))
+
 
 class SubprocessJob(Job):
     """
@@ -34,60 +48,105 @@ class SubprocessJob(Job):
     def __init__(self):
         super().__init__()
         self.process = None
-        self.thread = None
-
-    def do(self, args: List[str], input: Optional[bytes] = None):  # type: ignore[override]
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def do(  # type: ignore[override]
+        self,
+        args: List[str],
+        input: Optional[bytes] = None,
+        stdout: Union[None, str, Callable[[bytes], Any]] = None,
+    ):
         """
         Do the job.
 
-        Override of `Job.do` which starts the subprocess, with a
-        thread to asynchronously read it's `stderr` in order to
-        update the log using the logic
+        Override of `Job.do` which starts the subprocess and then, using a
+        selector, concurrently writes any `input` to its `stdin` and reads
+        its `stdout` and `stderr` as they are produced (so that the subprocess
+        never blocks on a full pipe).
+
+        By default, `stdout` is the result of the job. It is held in memory up
+        to `SUBPROCESS_STDOUT_MEMORY` bytes and then spilled to a temporary file.
+        Alternatively, `stdout` can be a path to write it to, or a function which
+        is called with each chunk of it, in which case the result is `None`.
+
+        Each line of `stderr` is used to update the log using the logic
 
         - if a line can be parsed as JSON and has a `message` property
           then it assumed to be a log entry
-        - otherwise, it is treated as a INFO message, but changed to
+        - otherwise, it, and the remaining lines, are treated as a single
+          INFO message (up to `SUBPROCESS_STDERR_MAX` bytes), but changed to
           an ERROR if the exit code is non-zero
+
+        The number of bytes and lines read from each stream are recorded in `stats`.
         """
         self.process = subprocess.Popen(
             args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
+        self.stats = dict(stdout=dict(bytes=0, lines=0), stderr=dict(bytes=0, lines=0))
 
-        def handle_stderr(stderr: Union[List[str], io.TextIOWrapper]):
-            # Attempt to treat each line as a JSON log entry
-            failed = False
-            for index, line in enumerate(stderr):
-                try:
-                    entry = json.loads(line)
-                    if isinstance(entry, dict) and "message" in entry:
-                        self.log(
-                            level=entry.get("level", INFO), message=entry["message"]
-                        )
-                    else:
-                        self.info(line.strip())
-                except json.decoder.JSONDecodeError:
-                    failed = True
-                    break
-
-            # If failed then send the remainder of the lines as a single
-            # log entry
-            if failed:
-                self.info("".join(list(stderr)[index:]))
-
-        if input:
-            stdout_data, stderr_data = self.process.communicate(input=input)
-            if stderr_data:
-                handle_stderr(stderr_data.decode().split("\n"))
-        else:
-            self.thread = threading.Thread(
-                target=handle_stderr,
-                args=(io.TextIOWrapper(self.process.stderr, encoding="utf-8"),),  # type: ignore
+        result: Optional[BinaryIO] = None
+        if stdout is None:
+            result = tempfile.SpooledTemporaryFile(  # type: ignore
+                max_size=SUBPROCESS_STDOUT_MEMORY
             )
-            self.thread.start()
+            write = result.write  # type: ignore
+        elif isinstance(stdout, str):
+            result = open(stdout, "wb")
+            write = result.write
+        else:
+            write = stdout
+
+        stderr = StderrHandler(self)
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(self.process.stdout, selectors.EVENT_READ, "stdout")  # type: ignore
+            selector.register(self.process.stderr, selectors.EVENT_READ, "stderr")  # type: ignore
+            if input:
+                os.set_blocking(self.process.stdin.fileno(), False)  # type: ignore
+                selector.register(self.process.stdin, selectors.EVENT_WRITE, "stdin")  # type: ignore
+            written = 0
+
+            while selector.get_map():
+                for key, events in selector.select():
+                    if key.data == "stdin":
+                        end = written + SUBPROCESS_CHUNK_SIZE
+                        try:
+                            written += os.write(key.fd, input[written:end])  # type: ignore
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            # Subprocess exited, or closed stdin, before reading all input
+                            written = len(input)  # type: ignore
+                        if written >= len(input):  # type: ignore
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()  # type: ignore
+                        continue
+
+                    chunk = os.read(key.fd, SUBPROCESS_CHUNK_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        continue
+
+                    stats = self.stats[key.data]
+                    stats["bytes"] += len(chunk)
+                    stats["lines"] += chunk.count(b"\n")
+                    if key.data == "stdout":
+                        write(chunk)
+                    else:
+                        stderr.feed(chunk)
+
+            stderr.close()
             self.process.wait()
-            stdout_data = self.process.stdout.read()  # type: ignore
+        finally:
+            selector.close()
+            if result and stdout is not None:
+                result.close()
+
+        logger.debug(f"Subprocess {args[0]} streams: {self.stats}")
 
         if self.process.returncode != 0:
+            if result:
+                result.close()
             for log in self.log_entries:
                 log["level"] = ERROR
             raise RuntimeError(
@@ -96,7 +155,12 @@ class SubprocessJob(Job):
                 )
             )
 
-        return stdout_data.decode() if stdout_data else None
+        if stdout is None:
+            result.seek(0)  # type: ignore
+            stdout_data = result.read()  # type: ignore
+            result.close()  # type: ignore
+            return stdout_data.decode() if stdout_data else None
+        return None
 
     def terminated(self):
         """
@@ -106,3 +170,71 @@ class SubprocessJob(Job):
         subprocess.
         """
         self.process.kill()
+
+
+class StderrHandler:
+    """
+    Handles the `stderr` of a subprocess, line by line, as it is read.
+
+    See `SubprocessJob.do` for how lines are logged.
+    """
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.buffer = bytearray()
+        self.failed = False
+        self.remainder: List[str] = []
+        self.remainder_bytes = 0
+
+    def feed(self, chunk: bytes) -> None:
+        """
+        Handle a chunk of `stderr`.
+        """
+        self.buffer += chunk
+        start = 0
+        while True:
+            index = self.buffer.find(b"\n", start)
+            if index < 0:
+                break
+            end = index + 1
+            self.line(bytes(self.buffer[start:end]))
+            start = end
+        del self.buffer[:start]
+
+    def line(self, line: bytes) -> None:
+        """
+        Handle a line of `stderr`.
+        """
+        text = line.decode(errors="replace")
+        if not self.failed:
+            if not text.strip():
+                return
+            try:
+                entry = json.loads(text)
+            except json.decoder.JSONDecodeError:
+                self.failed = True
+            else:
+                if isinstance(entry, dict) and "message" in entry:
+                    self.job.log(
+                        level=entry.get("level", INFO), message=entry["message"]
+                    )
+                else:
+                    self.job.info(text.strip())
+                return
+
+        # After the first line that is not JSON, keep the remaining
+        # lines to send as a single log entry
+        if self.remainder_bytes < SUBPROCESS_STDERR_MAX:
+            self.remainder.append(text)
+            self.remainder_bytes += len(line)
+
+    def close(self) -> None:
+        """
+        Handle any remaining `stderr`.
+        """
+        if self.buffer:
+            self.line(bytes(self.buffer))
+            self.buffer.clear()
+        if self.remainder:
+            self.job.info("".join(self.remainder))
+            self.remainder = []
@@ -85,3 +85,58 @@ def test_logging_ongoing():
             "for index in 0 1 2 3 4 5; do sleep 0.1; echo $index 1>&2 ; done",
         ]
     )
+
+
+def test_large_streams(tmp_path):
+    """
+    Large amounts of input, stdout and stderr do not block the subprocess.
+
+    Both streams are larger than a pipe's buffer and are written
+    by the subprocess while it is still reading its input.
+    """
+    job = SubprocessJob()
+    job.send_event = lambda *args, **kwargs: None
+    job.begin()
+
+    input = b"x" * 1000000
+    script = (
+        "import sys\n"
+        "for line in sys.stdin:\n"
+        "  print(line, end='', file=sys.stderr)\n"
+        "  print(line, end='')\n"
+    )
+    result = job.do([sys.executable, "-c", script], input=input + b"\n" + input)
+    assert len(result) == 2000001
+    assert job.stats == dict(
+        stdout=dict(bytes=2000001, lines=1), stderr=dict(bytes=2000001, lines=1)
+    )
+
+    # Stdout can be written to a file...
+    path = str(tmp_path / "stdout.txt")
+    assert job.do(["bash", "-c", "seq 1 100000"], stdout=path) is None
+    with open(path) as file:
+        assert file.read().split() == [str(number) for number in range(1, 100001)]
+    assert job.stats["stdout"]["lines"] == 100000
+
+    # ...or to a sink
+    chunks = []
+    assert job.do(["bash", "-c", "seq 1 100000"], stdout=chunks.append) is None
+    assert b"".join(chunks) == open(path, "rb").read()
+
+
+def test_logging_remainder():
+    """Lines on stderr after the first non-JSON line are logged as a single entry."""
+    job = SubprocessJob()
+    job.send_event = lambda *args, **kwargs: None
+    job.begin()
+    job.do(
+        [
+            "bash",
+            "-c",
+            """echo '{"level": 1, "message": "A warning"}' 1>&2; echo 'a' 1>&2; echo 'b' 1>&2""",
+        ]
+    )
+    assert [(entry["level"], entry["message"]) for entry in job.log_entries] == [
+        (WARN, "A warning"),
+        (INFO, "a\nb\n"),
+    ]
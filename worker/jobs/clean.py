@@ -1,5 +1,6 @@
 import os
 import shutil
+from typing import List, Set
 
 from jobs.base.job import Job
 from util.files import Files, list_files
@@ -15,13 +16,20 @@ class Clean(Job):
 
     This is equivalent to `rm -rf .` so be very careful where you run
     this job.
+
+    Files in `keep` (e.g. those from sources that may not need to be
+    pulled again) are not removed.
     """
 
     name = "clean"
 
     def do(  # type: ignore
-        self, **kwargs
+        self, keep: List[str] = [], **kwargs
     ) -> Files:
+        if keep:
+            self.remove_except(set(os.path.normpath(path) for path in keep))
+            return list_files(manifest=True)
+
         for root, dirs, files in os.walk("."):
             for file in files:
                 try:
@@ -33,4 +41,24 @@ class Clean(Job):
                     shutil.rmtree(os.path.join(root, dir))
                 except Exception as exc:
                     self.warn(str(exc))
-        return list_files()
+        return list_files(manifest=True)
+
+    def remove_except(self, keep: Set[str]) -> None:
+        """
+        Remove all files, other than those in `keep`, and any empty directories.
+        """
+        for root, dirs, files in os.walk(".", topdown=False):
+            links = [dir for dir in dirs if os.path.islink(os.path.join(root, dir))]
+            for name in files + links:
+                path = os.path.normpath(os.path.join(root, name))
+                if path in keep:
+                    continue
+                try:
+                    os.unlink(path)
+                except Exception as exc:
+                    self.warn(str(exc))
+            if root != "." and not os.listdir(root):
+                try:
+                    os.rmdir(root)
+                except Exception as exc:
+                    self.warn(str(exc))
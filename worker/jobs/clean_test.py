@@ -24,3 +24,20 @@ def test_clean(tempdir):
 
         assert files == {}
         assert os.listdir() == []
+
+
+def test_clean_keep(tempdir):
+    with working_directory(tempdir.path):
+        open("a.txt", "w").write("a")
+        os.mkdir("c")
+        open("c/d.txt", "w").write("d")
+        os.mkdir("c/e")
+        open("c/e/f.txt", "w").write("f")
+        os.mkdir("g")
+        open("g/h.txt", "w").write("h")
+
+        files = Clean().do(keep=["c/e/f.txt", "./g/h.txt"])
+
+        assert sorted(files.keys()) == ["c/e/f.txt", "g/h.txt"]
+        assert sorted(os.listdir()) == ["c", "g"]
+        assert os.listdir("c") == ["e"]
@@ -1,19 +1,25 @@
 import json
+import logging
 import os
 import shutil
 import tempfile
-from typing import Dict, List, Optional, Union, cast
+from typing import Any, Dict, List, Optional, Union, cast
 
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 from oauth2client.client import GoogleCredentials
 
 from config import get_content_root, get_node_modules_bin
+from jobs.base.job import INFO
 from jobs.base.subprocess_job import SubprocessJob
+from jobs.convert_cache import get_convert_cache
+from jobs.convert_pool import ENCODA_POOL_TIMEOUT, ConvertPoolError, get_convert_pool
 from jobs.pull.gdoc import pull_gdoc
 from util.files import Files, list_files, move_files, temp_dir
 from util.gapis import gdrive_service
 
+logger = logging.getLogger(__name__)
+
 
 class Convert(SubprocessJob):
     """
@@ -33,6 +39,7 @@ class Convert(SubprocessJob):
         src: str = ".",
         dest: str = ".",
         secrets: Dict = {},
+        dependencies: Optional[List[str]] = None,
         **kwargs,
     ) -> Files:
         """
@@ -56,6 +63,10 @@ class Convert(SubprocessJob):
              defaulting to the current working directory
         dest: The destination storage directory e.g. `content/3212/`
               defaulting to the current working directory
+        dependencies: Paths of other files used in the conversion (e.g. images,
+                      bibliographies) so that cached outputs are not used if they change.
+                      Conversions are only cached if these are declared (use an empty
+                      list if there are none).
         """
         assert (isinstance(input, str) or isinstance(input, bytes)) and len(
             input
@@ -68,15 +79,35 @@ class Convert(SubprocessJob):
         # Rewrite output path(s) to a temporary directory
         temp = None
         outputs = output if isinstance(output, list) else [output]
+        names = list(outputs)
         for index, output in enumerate(outputs):
             if output != "-":
                 if temp is None:
                     temp = temp_dir()
                 outputs[index] = os.path.join(temp, output)
 
-        # Generate arguments to Encoda and call it
-        args = encoda_args(input, outputs, options)
-        result = super().do(args, input=input if isinstance(input, bytes) else None)
+        # Use the outputs of a previous, identical, conversion if possible
+        cache = get_convert_cache() if temp else None
+        key = (
+            cache.key(input, names, encoda_options(input, options), dependencies)
+            if cache
+            else None
+        )
+        result: Any = None
+        if cache and key and cache.get(key, cast(str, temp)):
+            self.debug("Using cached conversion outputs")
+        else:
+            # Do the conversion using a pooled Encoda process if possible, otherwise
+            # generate arguments to the Encoda CLI and call it
+            result = self.convert_pooled(input, outputs, options)
+            if result is False:
+                args = encoda_args(input, outputs, options)
+                result = super().do(
+                    args, input=input if isinstance(input, bytes) else None
+                )
+
+            if cache and key:
+                cache.put(key, cast(str, temp))
 
         # If the output is a stream then just return the bytes
         if len(outputs) == 1 and outputs[0] == "-":
@@ -109,6 +140,53 @@ class Convert(SubprocessJob):
 
         return files
 
+    def convert_pooled(
+        self,
+        input: Union[str, bytes],
+        outputs: List[str],
+        options: Dict[str, Union[str, bool]],
+    ) -> Any:
+        """
+        Do the conversion using a process from the pool of Encoda processes.
+
+        Returns `False` if the pool is disabled, the input can not be sent
+        to the process, or the conversion failed (in which case the caller
+        should fall back to the Encoda CLI which provides better error reporting).
+        """
+        pool = get_convert_pool()
+        if pool is None:
+            return False
+
+        # Content is sent to the pooled process as a JSON string, so
+        # binary content (e.g. a `docx` on stdin) needs to use the CLI
+        content = None
+        if isinstance(input, bytes):
+            try:
+                content = input.decode()
+            except UnicodeDecodeError:
+                return False
+
+        params = dict(
+            cwd=os.getcwd(),
+            input="-" if isinstance(input, bytes) else input,
+            content=content,
+            outputs=outputs,
+            options=encoda_options(input, options),
+        )
+        try:
+            with pool.process() as process:
+                self.process = process.process
+                response = process.call("convert", params, ENCODA_POOL_TIMEOUT)
+        except ConvertPoolError as exc:
+            logger.warning(f"Falling back to Encoda CLI: {exc}")
+            return False
+        finally:
+            self.process = None
+
+        for entry in response.get("log") or []:
+            self.log(level=entry.get("level", INFO), message=entry.get("message", ""))
+        return response.get("result")
+
 
 def encoda_args(  # type: ignore
     input: Union[str, bytes], outputs: List[str], options: Dict[str, Union[str, bool]],
@@ -122,11 +200,29 @@ def encoda_args(  # type: ignore
         "-" if isinstance(input, bytes) else input,
     ] + outputs
 
+    for name, value in encoda_options(input, options).items():
+        # Transform boolean values
+        if value is False:
+            value = "false"
+        if value is True:
+            value = "true"
+
+        args.append("--{}={}".format(name, value))
+    return args
+
+
+def encoda_options(  # type: ignore
+    input: Union[str, bytes], options: Dict[str, Union[str, bool]],
+) -> Dict[str, Union[str, bool]]:
+    """
+    Create a dictionary of Encoda options based on job inputs and options.
+    """
     # Ensure XML files with the `.jats.xml` extension are treated as
     # JATS format (otherwise they are treated as plain XML)
     if isinstance(input, str) and input.endswith(".jats.xml"):
         options["from"] = "jats"
 
+    result = {}
     for name, value in options.items():
         # Determine --from option
         # Encoda currently does not allow for mimetypes in the `from` option.
@@ -144,14 +240,8 @@ def encoda_args(  # type: ignore
             if isinstance(value, str) and "/" in value:
                 continue
 
-        # Transform boolean values
-        if value is False:
-            value = "false"
-        if value is True:
-            value = "true"
-
-        args.append("--{}={}".format(name, value))
-    return args
+        result[name] = value
+    return result
 
 
 def create_gdoc_source(output: str, secrets: Dict) -> Dict[str, str]:
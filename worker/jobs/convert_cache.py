@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+from config import get_node_modules_path
+from util.files import file_fingerprint, remove_dir
+
+logger = logging.getLogger(__name__)
+
+# Directory on the worker's local disk to store cached conversions in
+CONVERT_CACHE_ROOT = os.getenv(
+    "CONVERT_CACHE_ROOT", os.path.join(tempfile.gettempdir(), "convert-cache")
+)
+
+# Maximum total size, in bytes, of cached conversions.
+# Set to zero to disable the cache.
+CONVERT_CACHE_SIZE = int(os.getenv("CONVERT_CACHE_SIZE", 1024 ** 3))
+
+# Name of the file, within each cache entry, with information on it
+ENTRY_INFO = ".entry.json"
+
+
+@lru_cache()
+def encoda_version() -> Optional[str]:
+    """
+    Get the version of Encoda installed.
+
+    Returns `None` if the version could not be determined.
+    """
+    try:
+        with open(get_node_modules_path("@stencila/encoda/package.json")) as file:
+            return json.load(file).get("version")
+    except Exception:
+        return None
+
+
+class ConvertCache:
+    """
+    A cache of conversion outputs.
+
+    Entries are keyed by the SHA256 fingerprint of the input (and the files
+    it declares as dependencies), the names of the outputs, the (normalized)
+    Encoda options and the version of Encoda. Only conversions which declare
+    their dependencies are cached. Each entry is a directory containing the files created
+    by the conversion. When the total size of entries exceeds `max_size`, the
+    least recently used entries are removed.
+    """
+
+    def __init__(
+        self, root: str = CONVERT_CACHE_ROOT, max_size: int = CONVERT_CACHE_SIZE
+    ):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(
+        self,
+        input: Union[str, bytes],
+        outputs: List[str],
+        options: Dict[str, Union[str, bool]],
+        dependencies: Optional[List[str]] = None,
+    ) -> Optional[str]:
+        """
+        Get the cache key for a conversion.
+
+        Returns `None` if the conversion can not be cached e.g. because
+        the input is not a file, or one of the outputs is a stream.
+        Conversions that do not declare their `dependencies` (an empty
+        list if there are none) are not cached because the other files they
+        may use are unknown and cached outputs could be stale.
+        """
+        version = encoda_version()
+        if version is None or dependencies is None or "-" in outputs:
+            return None
+
+        if isinstance(input, bytes):
+            fingerprint = hashlib.sha256(input).hexdigest()
+        elif os.path.isfile(input):
+            fingerprint = self.fingerprint(input, dependencies)
+        else:
+            return None
+
+        data = json.dumps(
+            dict(input=fingerprint, outputs=outputs, options=options, encoda=version),
+            sort_keys=True,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def fingerprint(self, input: str, dependencies: List[str] = []) -> str:
+        """
+        Generate a fingerprint for an input file.
+
+        Conversions may use other files relative to the input (e.g. images,
+        bibliographies) so the fingerprint includes those declared as `dependencies`
+        (a missing dependency is fingerprinted as `None`). Other files are not
+        fingerprinted because doing so for the input's whole directory (often the
+        whole project) can take longer than the conversion itself.
+        """
+        fingerprints = dict(
+            (path, file_fingerprint(path) if os.path.isfile(path) else None)
+            for path in dependencies
+        )
+        fingerprints[input] = file_fingerprint(input)
+        return hashlib.sha256(
+            json.dumps(fingerprints, sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, key: str, dest: str) -> bool:
+        """
+        Copy the outputs of a cached conversion to the `dest` directory.
+
+        Returns `False` if there is no entry for the key.
+        """
+        entry = os.path.join(self.root, key)
+        try:
+            shutil.copytree(
+                entry,
+                dest,
+                dirs_exist_ok=True,
+                ignore=shutil.ignore_patterns(ENTRY_INFO),
+            )
+            # Update the entry's modification time, used as its last use time
+            os.utime(entry)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            logger.info(f"Convert cache miss (hits {self.hits}, misses {self.misses})")
+            return False
+
+        with self.lock:
+            self.hits += 1
+        logger.info(f"Convert cache hit (hits {self.hits}, misses {self.misses})")
+        return True
+
+    def put(self, key: str, source: str) -> None:
+        """
+        Store the outputs of a conversion from the `source` directory.
+
+        Files are copied to a temporary directory, which is then renamed, so that
+        other processes never see a partially written entry.
+        """
+        entry = os.path.join(self.root, key)
+        if os.path.exists(entry):
+            return
+
+        os.makedirs(self.root, exist_ok=True)
+        temp = tempfile.mkdtemp(dir=self.root, prefix=".")
+        try:
+            shutil.copytree(source, temp, dirs_exist_ok=True)
+            size = sum(
+                os.path.getsize(os.path.join(dirpath, filename))
+                for dirpath, dirnames, filenames in os.walk(temp)
+                for filename in filenames
+            )
+            with open(os.path.join(temp, ENTRY_INFO), "w") as file:
+                json.dump(dict(size=size), file)
+            os.rename(temp, entry)
+        except OSError as exc:
+            # Most likely another process stored the same entry
+            # first, or the disk is full
+            logger.warning(f"Unable to store convert cache entry: {exc}")
+            remove_dir(temp)
+            return
+
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is within `max_size`.
+        """
+        entries = []
+        total = 0
+        for item in os.scandir(self.root):
+            if item.name.startswith(".") or not item.is_dir():
+                continue
+            try:
+                with open(os.path.join(item.path, ENTRY_INFO)) as file:
+                    size = json.load(file)["size"]
+                used = item.stat().st_mtime
+            except Exception:
+                continue
+            entries.append((used, size, item.path))
+            total += size
+
+        for used, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            remove_dir(path)
+            total -= size
+
+
+cache: Optional[ConvertCache] = None
+
+
+def get_convert_cache() -> Optional[ConvertCache]:
+    """
+    Get the conversion cache for this worker.
+
+    Returns `None` if the cache is disabled.
+    """
+    global cache
+    if CONVERT_CACHE_SIZE <= 0:
+        return None
+    if cache is None:
+        cache = ConvertCache()
+    return cache
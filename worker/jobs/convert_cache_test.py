@@ -0,0 +1,142 @@
+import os
+from unittest import mock
+
+import pytest
+
+from util.working_directory import working_directory
+
+from .convert import Convert
+from .convert_cache import ConvertCache
+
+
+@pytest.fixture(autouse=True)
+def setup(tmp_path, monkeypatch):
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+    monkeypatch.setattr("jobs.convert_cache.encoda_version", lambda: "1.2.3")
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def test_key(tmp_path):
+    cache = ConvertCache(str(tmp_path / "cache"))
+
+    with working_directory(str(tmp_path)):
+        write("dir/input.md", "# Hello")
+        key = cache.key("dir/input.md", ["dir/output.html"], {"theme": "elife"}, [])
+        assert key is not None
+
+        # Same key for identical conversion
+        assert key == cache.key(
+            "dir/input.md", ["dir/output.html"], {"theme": "elife"}, []
+        )
+
+        # Different key for different outputs or options
+        assert key != cache.key("dir/input.md", ["dir/output.docx"], {}, [])
+        assert key != cache.key(
+            "dir/input.md", ["dir/output.html"], {"theme": "stencila"}, []
+        )
+
+        # Other files in the directory (e.g. previous outputs) are ignored
+        write("dir/output.html", "<h1>Hello</h1>")
+        write("dir/output.html.media/image.png", "")
+        write("dir/image.png", "")
+        assert key == cache.key(
+            "dir/input.md", ["dir/output.html"], {"theme": "elife"}, []
+        )
+
+        # Unless they are declared as dependencies
+        with_image = cache.key(
+            "dir/input.md", ["dir/output.html"], {"theme": "elife"}, ["dir/image.png"]
+        )
+        assert with_image != key
+        write("dir/image.png", "changed")
+        assert with_image != cache.key(
+            "dir/input.md", ["dir/output.html"], {"theme": "elife"}, ["dir/image.png"]
+        )
+
+        # Different key for a changed input
+        write("dir/input.md", "# Hello world")
+        assert key != cache.key(
+            "dir/input.md", ["dir/output.html"], {"theme": "elife"}, []
+        )
+
+        # Not cacheable
+        assert cache.key("dir/input.md", ["dir/output.html"], {}) is None
+        assert cache.key(b"# Hello", ["dir/output.html"], {}) is None
+        assert cache.key("dir/foo.md", ["dir/output.html"], {}, []) is None
+        assert cache.key("dir/input.md", ["-"], {}, []) is None
+        with mock.patch("jobs.convert_cache.encoda_version", return_value=None):
+            assert cache.key("dir/input.md", ["dir/output.html"], {}, []) is None
+
+
+def test_get_put(tmp_path):
+    cache = ConvertCache(str(tmp_path / "cache"))
+    write(str(tmp_path / "source" / "output.html"), "<h1>Hello</h1>")
+    write(str(tmp_path / "source" / "output.html.media" / "image.png"), "image")
+
+    assert not cache.get("key", str(tmp_path / "dest"))
+    assert cache.misses == 1
+
+    cache.put("key", str(tmp_path / "source"))
+    assert cache.get("key", str(tmp_path / "dest"))
+    assert cache.hits == 1
+    assert sorted(os.listdir(tmp_path / "dest")) == [
+        "output.html",
+        "output.html.media",
+    ]
+
+
+def test_evict(tmp_path):
+    cache = ConvertCache(str(tmp_path / "cache"), max_size=20)
+    write(str(tmp_path / "source" / "file.txt"), "0123456789")
+
+    cache.put("a", str(tmp_path / "source"))
+    os.utime(str(tmp_path / "cache" / "a"), (1, 1))
+    cache.put("b", str(tmp_path / "source"))
+    assert sorted(os.listdir(tmp_path / "cache")) == ["a", "b"]
+
+    # Use "a" so that "b" is the least recently used
+    os.utime(str(tmp_path / "cache" / "b"), (2, 2))
+    assert cache.get("a", str(tmp_path / "dest"))
+    cache.put("c", str(tmp_path / "source"))
+    assert sorted(os.listdir(tmp_path / "cache")) == ["a", "c"]
+
+
+def test_convert(tmp_path, monkeypatch):
+    cache = ConvertCache(str(tmp_path / "cache"))
+    monkeypatch.setattr("jobs.convert.get_convert_cache", lambda: cache)
+
+    def convert(input, outputs, options):
+        write(outputs[0], "<h1>Hello</h1>")
+        return None
+
+    os.makedirs(tmp_path / "project")
+    with working_directory(str(tmp_path / "project")):
+        write("input.md", "# Hello")
+
+        with mock.patch.object(
+            Convert, "convert_pooled", side_effect=convert
+        ) as convert_pooled:
+            files = Convert().do("input.md", "output.html", dependencies=[])
+            assert convert_pooled.call_count == 1
+            assert list(files.keys()) == ["output.html"]
+
+            cached = Convert().do("input.md", "output.html", dependencies=[])
+            assert (
+                cached["output.html"]["fingerprint"]
+                == files["output.html"]["fingerprint"]
+            )
+            assert convert_pooled.call_count == 1
+            assert cache.hits == 1
+
+            # Conversions without declared dependencies are not cached
+            Convert().do("input.md", "output.html")
+            assert convert_pooled.call_count == 2
+            assert cache.hits == 1
+
+        with open("output.html") as file:
+            assert file.read() == "<h1>Hello</h1>"
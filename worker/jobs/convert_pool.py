@@ -0,0 +1,278 @@
+import atexit
+import json
+import logging
+import os
+import select
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from config import NODE_MODULES
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of Encoda processes in each worker process's pool.
+# Set to zero to disable the pool and always use the Encoda CLI.
+ENCODA_POOL_SIZE = int(os.getenv("ENCODA_POOL_SIZE", 1))
+
+# Number of requests after which a process is replaced (to limit the
+# impact of any memory leaks)
+ENCODA_POOL_MAX_REQUESTS = int(os.getenv("ENCODA_POOL_MAX_REQUESTS", 100))
+
+# Seconds to wait for a conversion before killing the process
+ENCODA_POOL_TIMEOUT = float(os.getenv("ENCODA_POOL_TIMEOUT", 600))
+
+# Seconds a process can be idle before it is pinged to check it is healthy
+ENCODA_POOL_IDLE = float(os.getenv("ENCODA_POOL_IDLE", 60))
+
+# Seconds to wait for a response to a ping
+ENCODA_POOL_PING_TIMEOUT = float(os.getenv("ENCODA_POOL_PING_TIMEOUT", 10))
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(__file__), "convert_server.js")
+
+
+class ConvertPoolError(Exception):
+    """
+    An error communicating with a pooled Encoda process.
+
+    Raised if a process could not be started, exited or timed out,
+    or responded with an error. Callers should fall back to using the
+    Encoda CLI.
+    """
+
+    pass
+
+
+class EncodaProcess:
+    """
+    A long-lived Encoda process.
+
+    Communicates with `convert_server.js` using line-delimited
+    JSON-RPC over the process's `stdin` and `stdout`. The process's
+    `stderr` is inherited so that any unexpected output from it ends
+    up in the worker's logs.
+    """
+
+    def __init__(self, args: Optional[List[str]] = None):
+        env = dict(os.environ)
+        env["NODE_PATH"] = NODE_MODULES
+        try:
+            self.process = subprocess.Popen(
+                args or ["node", SERVER_SCRIPT],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                env=env,
+            )
+        except OSError as exc:
+            raise ConvertPoolError(f"Unable to start Encoda process: {exc}")
+
+        self.id = 0
+        self.buffer = bytearray()
+        self.requests = 0
+        self.used = time.monotonic()
+
+    def alive(self) -> bool:
+        """
+        Check whether the process is still running.
+        """
+        return self.process.poll() is None
+
+    def call(self, method: str, params: Dict[str, Any], timeout: float) -> Any:
+        """
+        Call a method and return the response.
+
+        If the process does not respond within `timeout` seconds,
+        it is killed.
+        """
+        self.id += 1
+        self.used = time.monotonic()
+        request = dict(jsonrpc="2.0", id=self.id, method=method, params=params)
+        try:
+            self.process.stdin.write((json.dumps(request) + "\n").encode())  # type: ignore
+            self.process.stdin.flush()  # type: ignore
+        except OSError as exc:
+            raise ConvertPoolError(f"Unable to send request: {exc}")
+
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self.readline(deadline)
+            if line is None:
+                self.close()
+                raise ConvertPoolError(f"Request timed out after {timeout}s")
+            if not line:
+                raise ConvertPoolError("Process exited unexpectedly")
+
+            try:
+                response = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                response = None
+            if not isinstance(response, dict) or response.get("id") != self.id:
+                # Something other than the server wrote to stdout, skip it
+                logger.debug(f"Ignoring output from Encoda process: {line!r}")
+                continue
+
+            self.used = time.monotonic()
+            if "error" in response:
+                raise ConvertPoolError(response["error"].get("message"))
+            return response
+
+    def readline(self, deadline: float) -> Optional[bytes]:
+        """
+        Read a line from the process's `stdout`.
+
+        Returns `None` if no line was available before the `deadline`,
+        or an empty byte string if the process has exited. Reads directly from the
+        file descriptor, rather than using `readline()`, so that `select()`
+        is not confused by lines sitting in a Python buffer.
+        """
+        fd = self.process.stdout.fileno()  # type: ignore
+        start = 0
+        while True:
+            index = self.buffer.find(b"\n", start)
+            if index >= 0:
+                break
+            start = len(self.buffer)
+
+            remaining = deadline - time.monotonic()
+            ready, _, _ = select.select([fd], [], [], max(remaining, 0))
+            if not ready:
+                return None
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b""
+            self.buffer += chunk
+
+        line = bytes(self.buffer[:index])
+        del self.buffer[: index + 1]
+        return line
+
+    def ping(self, timeout: float = ENCODA_POOL_PING_TIMEOUT) -> bool:
+        """
+        Check that the process is responding to requests.
+        """
+        try:
+            return self.call("ping", {}, timeout).get("result") is True
+        except ConvertPoolError:
+            return False
+
+    def close(self) -> None:
+        """
+        Close the process.
+        """
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class ConvertPool:
+    """
+    A pool of long-lived Encoda processes.
+
+    Processes are started on demand (up to `size` of them) and
+    reused for subsequent conversions. Before being reused, a process
+    is checked to still be running and, if it has been idle for a while,
+    that it responds to a ping. Processes are replaced after `max_requests`
+    conversions, or if a request to them fails.
+    """
+
+    def __init__(
+        self,
+        size: int = ENCODA_POOL_SIZE,
+        max_requests: int = ENCODA_POOL_MAX_REQUESTS,
+        args: Optional[List[str]] = None,
+    ):
+        self.size = size
+        self.max_requests = max_requests
+        self.args = args
+        self.idle: List[EncodaProcess] = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def process(self) -> Iterator[EncodaProcess]:
+        """
+        Get a process from the pool and return it to the pool when done.
+
+        Processes that raised an error while being used are closed rather
+        than being returned to the pool.
+        """
+        self.slots.acquire()
+        try:
+            process = self.acquire()
+            try:
+                yield process
+            except Exception:
+                process.close()
+                raise
+            process.requests += 1
+            self.release(process)
+        finally:
+            self.slots.release()
+
+    def acquire(self) -> EncodaProcess:
+        """
+        Get a healthy idle process, or start a new one.
+        """
+        while True:
+            with self.lock:
+                process = self.idle.pop() if self.idle else None
+            if process is None:
+                return EncodaProcess(self.args)
+            if process.alive() and (
+                time.monotonic() - process.used < ENCODA_POOL_IDLE or process.ping()
+            ):
+                return process
+            logger.warning("Replacing unhealthy Encoda process")
+            process.close()
+
+    def release(self, process: EncodaProcess) -> None:
+        """
+        Return a process to the pool, or close it if it has reached `max_requests`.
+        """
+        if not process.alive() or process.requests >= self.max_requests:
+            process.close()
+            return
+        with self.lock:
+            self.idle.append(process)
+
+    def convert(
+        self, params: Dict[str, Any], timeout: float = ENCODA_POOL_TIMEOUT
+    ) -> Dict[str, Any]:
+        """
+        Do a conversion using a process from the pool.
+
+        Returns the JSON-RPC response which includes the `result`
+        and any `log` entries.
+        """
+        with self.process() as process:
+            return process.call("convert", params, timeout)
+
+    def close(self) -> None:
+        """
+        Close all idle processes.
+        """
+        with self.lock:
+            processes, self.idle = self.idle, []
+        for process in processes:
+            process.close()
+
+
+pool: Optional[ConvertPool] = None
+
+
+def get_convert_pool() -> Optional[ConvertPool]:
+    """
+    Get the pool of Encoda processes for this worker process.
+
+    The pool is created lazily so that each forked Celery worker
+    process gets its own. Returns `None` if the pool is disabled.
+    """
+    global pool
+    if ENCODA_POOL_SIZE <= 0:
+        return None
+    if pool is None:
+        pool = ConvertPool()
+        atexit.register(pool.close)
+    return pool
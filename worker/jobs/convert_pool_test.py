@@ -0,0 +1,108 @@
+import sys
+import time
+
+import pytest
+
+from .convert_pool import ConvertPool, ConvertPoolError, EncodaProcess
+
+# A fake Encoda server which echos back the params of requests
+# (and exits, or sleeps, if asked to)
+SERVER = """
+import json, sys, time
+for line in sys.stdin:
+    request = json.loads(line)
+    params = request["params"]
+    if params.get("exit"):
+        sys.exit(1)
+    if params.get("sleep"):
+        time.sleep(params["sleep"])
+    print("Not a response", flush=True)
+    if params.get("error"):
+        response = dict(id=request["id"], error=dict(message=params["error"]))
+    elif request["method"] == "ping":
+        response = dict(id=request["id"], result=True)
+    else:
+        response = dict(id=request["id"], result=params, log=[dict(level=2, message="Hi")])
+    print(json.dumps(response), flush=True)
+"""
+
+ARGS = [sys.executable, "-c", SERVER]
+
+
+def test_process():
+    process = EncodaProcess(ARGS)
+    assert process.alive()
+    assert process.ping()
+
+    response = process.call("convert", {"input": "a.md"}, timeout=5)
+    assert response["result"] == {"input": "a.md"}
+    assert response["log"] == [{"level": 2, "message": "Hi"}]
+
+    with pytest.raises(ConvertPoolError, match="Bad things"):
+        process.call("convert", {"error": "Bad things"}, timeout=5)
+    assert process.alive()
+
+    with pytest.raises(ConvertPoolError, match="timed out"):
+        process.call("convert", {"sleep": 2}, timeout=0.1)
+    assert not process.alive()
+
+
+def test_process_exits():
+    process = EncodaProcess(ARGS)
+    with pytest.raises(ConvertPoolError, match="exited"):
+        process.call("convert", {"exit": True}, timeout=5)
+
+
+def test_process_no_executable():
+    with pytest.raises(ConvertPoolError, match="Unable to start"):
+        EncodaProcess(["this-executable-does-not-exist"])
+
+
+def test_pool_reuses_processes():
+    pool = ConvertPool(size=1, max_requests=3, args=ARGS)
+
+    with pool.process() as first:
+        first.call("convert", {}, timeout=5)
+    with pool.process() as second:
+        second.call("convert", {}, timeout=5)
+    assert second is first
+
+    # Replaced after max requests
+    with pool.process() as third:
+        third.call("convert", {}, timeout=5)
+    assert third is first
+    assert not first.alive()
+    with pool.process() as fourth:
+        fourth.call("convert", {}, timeout=5)
+    assert fourth is not first
+
+    # Replaced after an error
+    with pytest.raises(ConvertPoolError):
+        pool.convert({"exit": True})
+    assert not fourth.alive()
+    assert pool.convert({"input": "a.md"})["result"] == {"input": "a.md"}
+
+    # Replaced if it has died while idle
+    process = pool.idle[0]
+    process.close()
+    with pool.process() as fifth:
+        assert fifth is not process
+        assert fifth.alive()
+
+    pool.close()
+    assert not fifth.alive()
+    assert pool.idle == []
+
+
+def test_pool_health_check(monkeypatch):
+    pool = ConvertPool(size=1, args=ARGS)
+    pool.convert({})
+    process = pool.idle[0]
+
+    # Long idle processes are pinged before being reused
+    process.used = time.monotonic() - 3600
+    with pool.process() as reused:
+        assert reused is process
+        assert reused.id == 2
+
+    pool.close()
@@ -0,0 +1,88 @@
+/**
+ * A long-lived Encoda conversion server.
+ *
+ * Reads line-delimited JSON-RPC 2.0 requests from stdin and writes responses
+ * to stdout. Used by `ConvertPool` (see `convert_pool.py`) to avoid the
+ * cost of starting Node.js and loading Encoda's codecs for each conversion.
+ *
+ * Methods:
+ *
+ * - `ping`: returns `true` (used for health checks)
+ * - `convert`: converts `input` (a path, or `content` if `input` is "-")
+ *   to `outputs` with `options` (the same options as passed to the
+ *   Encoda CLI), within the `cwd` directory. Returns the converted
+ *   content if the only output is "-", `null` otherwise.
+ *
+ * Log entries emitted during a request are returned in the response's
+ * `log` property so that they can be added to the job's log.
+ */
+
+const readline = require('readline')
+const { convert } = require('@stencila/encoda')
+const logga = require('@stencila/logga')
+
+let entries = []
+logga.replaceHandlers((data) => {
+  entries.push({ level: data.level, message: data.message })
+})
+
+const methods = {
+  ping: async () => true,
+  convert: async ({ cwd, input, content, outputs, options }) => {
+    if (cwd) process.chdir(cwd)
+
+    const { from, to, standalone, bundle, ...rest } = options || {}
+    const encodeOptions = { ...rest }
+    if (standalone !== undefined) encodeOptions.isStandalone = standalone
+    if (bundle !== undefined) encodeOptions.isBundle = bundle
+
+    const result = await convert(
+      input === '-' ? content : input,
+      outputs.length === 1 && outputs[0] === '-' ? undefined : outputs,
+      { from, to, encodeOptions }
+    )
+    return typeof result === 'string' && outputs[0] === '-' ? result : null
+  },
+}
+
+const lines = readline.createInterface({ input: process.stdin })
+let queue = Promise.resolve()
+lines.on('line', (line) => {
+  // Requests are handled one at a time, in order
+  queue = queue.then(() => handle(line))
+})
+lines.on('close', () => queue.then(() => process.exit(0)))
+
+async function handle(line) {
+  let request
+  try {
+    request = JSON.parse(line)
+  } catch (error) {
+    return respond({ id: null, error: { code: -32700, message: 'Parse error' } })
+  }
+
+  const { id, method, params } = request
+  const func = methods[method]
+  if (func === undefined) {
+    return respond({
+      id,
+      error: { code: -32601, message: `Method not found: ${method}` },
+    })
+  }
+
+  entries = []
+  try {
+    const result = await func(params || {})
+    respond({ id, result, log: entries })
+  } catch (error) {
+    respond({
+      id,
+      error: { code: -32603, message: error.message || String(error) },
+      log: entries,
+    })
+  }
+}
+
+function respond(response) {
+  process.stdout.write(JSON.stringify({ jsonrpc: '2.0', ...response }) + '\n')
+}
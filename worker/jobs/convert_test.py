@@ -1,10 +1,14 @@
 import sys
+from unittest import mock
 
 import pytest
 
 from util.working_directory import working_directory
 
+from .base.subprocess_job import SubprocessJob
 from .convert import Convert
+from .convert_pool import ConvertPool
+from .convert_pool_test import ARGS
 
 
 def test_bad_args():
@@ -71,3 +75,43 @@ def test_to_gdoc(tempdir):
 
     tempdir.compare(["input.md", "output.gdoc"])
     assert result["output.gdoc"]["mimetype"] == "application/vnd.google-apps.document"
+
+
+def test_pooled(monkeypatch):
+    """Conversions are done by a pooled process if possible."""
+    pool = ConvertPool(size=1, args=ARGS)
+    monkeypatch.setattr("jobs.convert.get_convert_pool", lambda: pool)
+
+    job = Convert()
+    result = job.do(b"Some markdown", "-", {"from": "md", "standalone": False})
+    assert result["input"] == "-"
+    assert result["content"] == "Some markdown"
+    assert result["outputs"] == ["-"]
+    assert result["options"] == {"from": "md", "standalone": False}
+    assert job.log_entries[0]["message"] == "Hi"
+    assert job.process is None
+
+    pool.close()
+
+
+def test_pooled_fallback(monkeypatch):
+    """If the pooled process fails then falls back to the Encoda CLI."""
+    pool = ConvertPool(size=1, args=["this-executable-does-not-exist"])
+    monkeypatch.setattr("jobs.convert.get_convert_pool", lambda: pool)
+
+    with mock.patch.object(SubprocessJob, "do", return_value="Converted") as do:
+        assert Convert().do("input.md", "-", {"theme": "wilmore"}) == "Converted"
+    assert do.call_args[0][0][-1] == "--theme=wilmore"
+
+    pool.close()
+
+
+def test_pooled_binary(monkeypatch):
+    """Binary content is converted using the Encoda CLI."""
+    pool = mock.Mock()
+    monkeypatch.setattr("jobs.convert.get_convert_pool", lambda: pool)
+
+    with mock.patch.object(SubprocessJob, "do", return_value="Converted") as do:
+        assert Convert().do(b"PK\x03\x04\xff", "-", {"from": "docx"}) == "Converted"
+    assert do.call_args[1]["input"] == b"PK\x03\x04\xff"
+    pool.process.assert_not_called()
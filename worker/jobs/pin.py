@@ -1,14 +1,33 @@
+import json
 import logging
 import os
 import re
-from typing import Dict, List, Optional, Tuple, cast
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, cast
 
+import redis
 from dxf import DXF
 
 from jobs.base.job import Job
 
 logger = logging.getLogger(__name__)
 
+# URL of the Redis instance used to cache the digests of container images
+# (shared by all workers and the manager). Set to an empty string to disable.
+PIN_CACHE_URL = os.getenv("PIN_CACHE_URL", os.getenv("CACHE_URL", ""))
+
+# Seconds that a cached digest is used for without checking the registry
+PIN_CACHE_TTL = int(os.getenv("PIN_CACHE_TTL", 300))
+
+# Seconds, after `PIN_CACHE_TTL`, that a cached digest is still used for
+# while it is being revalidated in the background
+PIN_CACHE_STALE = int(os.getenv("PIN_CACHE_STALE", 3600))
+
+# Seconds to wait for another worker that is already resolving
+# the same digest before resolving it anyway
+PIN_CACHE_WAIT = float(os.getenv("PIN_CACHE_WAIT", 10))
+
 # Regex for parsing a container image identifier
 # Based on answers at https://stackoverflow.com/questions/39671641/regex-to-parse-docker-tag
 # Playground at https://regex101.com/r/hP8bK1/42
@@ -51,11 +70,18 @@ class Pin(Job):
             alias = "latest"
 
         try:
-            dxf = DXF(host, repo, self.authenticate)
-            # Get the "Docker-Content-Digest" for the alias. This is the SHA256 hash
-            # that can be used with `docker run` and is on the Docker Hub for an image tag,
-            # not the one returned by ``.get_digest()`.
-            digest = dxf._get_dcd(alias)
+            cache = get_digest_cache()
+            if cache:
+                digest = cache.get(
+                    host,
+                    repo,
+                    alias,
+                    lambda: self.resolve(
+                        cast(str, host), cast(str, repo), cast(str, alias)
+                    ),
+                )
+            else:
+                digest = self.resolve(host, repo, alias)
         except MissingCredentialsError as exc:
             # If no credentials were available for the container registry
             # then log a warning and return an unpinned container image.
@@ -66,6 +92,16 @@ class Pin(Job):
         else:
             return self.deparse(host, repo, cast(str, digest))
 
+    def resolve(self, host: str, repo: str, alias: str) -> str:
+        """
+        Get the digest for an alias from the container registry.
+        """
+        dxf = DXF(host, repo, self.authenticate)
+        # Get the "Docker-Content-Digest" for the alias. This is the SHA256 hash
+        # that can be used with `docker run` and is on the Docker Hub for an image tag,
+        # not the one returned by ``.get_digest()`.
+        return dxf._get_dcd(alias)
+
     @staticmethod
     def parse(
         container_image: Optional[str] = None,
@@ -122,3 +158,154 @@ class Pin(Job):
 
         username, password = credentials.split(":")
         dxf.authenticate(username, password, response=response)
+
+
+class DigestCache:
+    """
+    A cache of the digests of container images, shared by workers using Redis.
+
+    Entries are keyed by registry host, repository and alias and include the time
+    that the digest was resolved. Entries younger than `ttl` seconds are used as is.
+    Older entries (up to `stale` seconds older) are used while being revalidated
+    in the background. Only one worker resolves a digest at a time: others wait
+    for it to be cached (up to `wait` seconds).
+
+    The pinned image identifier, and the time that the entry should be revalidated
+    after, are also stored so that the manager can use fresh entries without
+    contacting the registry.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        ttl: int = PIN_CACHE_TTL,
+        stale: int = PIN_CACHE_STALE,
+        wait: float = PIN_CACHE_WAIT,
+    ):
+        self.client = client
+        self.ttl = ttl
+        self.stale = stale
+        self.wait = wait
+
+    @staticmethod
+    def key(host: str, repo: str, alias: str) -> str:
+        """
+        Get the key for the cache entry for an image.
+        """
+        return f"pin:digest:{host}/{repo}:{alias}"
+
+    def get(self, host: str, repo: str, alias: str, resolve: Callable[[], str]) -> str:
+        """
+        Get the digest for an image, using `resolve` to get it if necessary.
+
+        If Redis is unavailable, the digest is resolved without caching.
+        """
+        key = self.key(host, repo, alias)
+        try:
+            entry = self.read(key)
+            if entry:
+                age = time.time() - entry["time"]
+                if age < self.ttl:
+                    return entry["digest"]
+
+                # Stale: use it but revalidate it in the background
+                # (unless another worker is already doing so)
+                if self.lock(key):
+                    threading.Thread(
+                        target=self.revalidate,
+                        args=(key, host, repo, resolve),
+                        daemon=True,
+                    ).start()
+                return entry["digest"]
+
+            if not self.lock(key):
+                # Another worker is resolving the digest so wait for it
+                deadline = time.monotonic() + self.wait
+                while time.monotonic() < deadline:
+                    time.sleep(0.1)
+                    entry = self.read(key)
+                    if entry:
+                        return entry["digest"]
+                return resolve()
+        except redis.RedisError as exc:
+            logger.warning(f"Unable to use digest cache: {exc}")
+            return resolve()
+
+        try:
+            digest = resolve()
+            self.write(key, host, repo, digest)
+            return digest
+        finally:
+            self.unlock(key)
+
+    def revalidate(self, key: str, host: str, repo: str, resolve: Callable[[], str]):
+        """
+        Resolve the digest for an image and update its cache entry.
+        """
+        try:
+            self.write(key, host, repo, resolve())
+        except Exception as exc:
+            logger.warning(f"Unable to revalidate digest for {key}: {exc}")
+        finally:
+            self.unlock(key)
+
+    def read(self, key: str) -> Optional[Dict]:
+        """
+        Read a cache entry.
+        """
+        data = self.client.get(key)
+        return json.loads(data) if data else None
+
+    def write(self, key: str, host: str, repo: str, digest: str) -> None:
+        """
+        Write a cache entry.
+
+        The entry expires from Redis once it is too stale to be used.
+        """
+        now = time.time()
+        data = dict(
+            digest=digest,
+            image=Pin.deparse(host, repo, digest),
+            time=now,
+            expires=now + self.ttl,
+        )
+        try:
+            self.client.set(key, json.dumps(data), ex=self.ttl + self.stale)
+        except redis.RedisError as exc:
+            logger.warning(f"Unable to write to digest cache: {exc}")
+
+    def lock(self, key: str) -> bool:
+        """
+        Try to acquire the lock for resolving the digest for an image.
+
+        The lock expires in case the worker holding it dies.
+        """
+        return bool(self.client.set(key + ":lock", "1", nx=True, ex=60))
+
+    def unlock(self, key: str) -> None:
+        """
+        Release the lock for resolving the digest for an image.
+        """
+        try:
+            self.client.delete(key + ":lock")
+        except redis.RedisError:
+            pass
+
+
+digest_cache: Optional[DigestCache] = None
+
+
+def get_digest_cache() -> Optional[DigestCache]:
+    """
+    Get the digest cache for this worker process.
+
+    Returns `None` if the cache is disabled.
+    """
+    global digest_cache
+    if not PIN_CACHE_URL:
+        return None
+    if digest_cache is None:
+        digest_cache = DigestCache(
+            redis.Redis.from_url(PIN_CACHE_URL, socket_timeout=5)
+        )
+    return digest_cache
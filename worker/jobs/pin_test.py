@@ -1,6 +1,11 @@
+import threading
+import time
+from unittest import mock
+
 import pytest
+import redis
 
-from .pin import Pin
+from .pin import DigestCache, Pin
 
 # These tests use a `pytest-recording` "casette" to record resposes from
 # Docker registry to API requests. That casette has had any sensitive data redacted from it.
@@ -73,3 +78,75 @@ def test_run():
         job.do("stencila/executa-midi:20201004.1")
         == "docker.io/stencila/executa-midi@sha256:ba8dfd7bbd91cc704baa9fa1b9e6100d70a4a0b153ea97d37ca0eef0fc5dea57"
     )
+
+
+class FakeRedis:
+    """
+    A fake Redis client implementing the methods used by `DigestCache`.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def test_digest_cache():
+    cache = DigestCache(FakeRedis(), ttl=60, stale=600, wait=0.2)
+    resolve = mock.Mock(return_value="sha256:1")
+
+    # Miss, then hit
+    assert (
+        cache.get("registry-1.docker.io", "org/name", "latest", resolve) == "sha256:1"
+    )
+    assert (
+        cache.get("registry-1.docker.io", "org/name", "latest", resolve) == "sha256:1"
+    )
+    assert resolve.call_count == 1
+
+    entry = cache.read(cache.key("registry-1.docker.io", "org/name", "latest"))
+    assert entry["image"] == "docker.io/org/name@sha256:1"
+
+    # Stale, so the stale digest is returned while it is revalidated
+    resolve.return_value = "sha256:2"
+    with mock.patch("jobs.pin.time.time", return_value=time.time() + 120):
+        assert (
+            cache.get("registry-1.docker.io", "org/name", "latest", resolve)
+            == "sha256:1"
+        )
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and thread.daemon:
+            thread.join(timeout=1)
+    assert resolve.call_count == 2
+    assert (
+        cache.get("registry-1.docker.io", "org/name", "latest", resolve) == "sha256:2"
+    )
+
+
+def test_digest_cache_single_flight():
+    cache = DigestCache(FakeRedis(), wait=1)
+    key = cache.key("host", "repo", "alias")
+
+    # Another worker holds the lock and caches the digest while this one waits
+    assert cache.lock(key)
+    threading.Timer(0.2, lambda: cache.write(key, "host", "repo", "sha256:1")).start()
+    resolve = mock.Mock(return_value="sha256:2")
+    assert cache.get("host", "repo", "alias", resolve) == "sha256:1"
+    resolve.assert_not_called()
+
+
+def test_digest_cache_unavailable():
+    client = mock.Mock()
+    client.get.side_effect = redis.ConnectionError("Connection refused")
+    cache = DigestCache(client)
+    assert cache.get("host", "repo", "alias", lambda: "sha256:1") == "sha256:1"
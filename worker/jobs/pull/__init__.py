@@ -1,18 +1,19 @@
 import os
 from collections import OrderedDict
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional
 
 import config
 from jobs.base.job import Job
-from util.files import Files, assert_within
-
-from .elife import pull_elife
-from .gdoc import pull_gdoc
-from .gdrive import pull_gdrive
-from .github import pull_github
-from .gsheet import pull_gsheet
-from .http import pull_http
-from .plos import pull_plos
+from util.files import Files, assert_within, file_fingerprint
+from util.manifest import Manifest
+
+from .elife import pull_elife, revision_elife
+from .gdoc import pull_gdoc, revision_gdoc
+from .gdrive import pull_gdrive, revision_gdrive
+from .github import pull_github, revision_github
+from .gsheet import pull_gsheet, revision_gsheet
+from .http import pull_http, revision_http
+from .plos import pull_plos, revision_plos
 from .upload import pull_upload
 
 # Functions for pulling individual source types
@@ -28,6 +29,33 @@ PULL_FUNCS: Dict[str, Callable[..., Files]] = {
     "url": pull_http,  # URL is used as an alias for HTTP e.g `UrlSource`
 }
 
+# Functions for getting the current revision of individual source types.
+# Each returns an opaque string which changes whenever the source does
+# (or `None` if that can not be determined).
+REVISION_FUNCS: Dict[str, Callable[..., Optional[str]]] = {
+    "elife": revision_elife,
+    "github": revision_github,
+    "googledocs": revision_gdoc,
+    "googlesheets": revision_gsheet,
+    "googledrive": revision_gdrive,
+    "http": revision_http,
+    "plos": revision_plos,
+    "url": revision_http,
+}
+
+# Source types whose pull functions return file paths relative to
+# the pull `path` (rather than to the project)
+RELATIVE_PATHS = {"github"}
+
+# Source types whose pull functions can make conditional requests
+# given the `revision` and `files` of the last pull
+CONDITIONAL_PULLS = {"http", "url"}
+
+# Version of the shape of the result returned by the `Pull` job, so that
+# the `manager` can tell it apart from the results of older workers
+# (which returned only the dictionary of files pulled)
+PULL_RESULT_VERSION = 2
+
 
 class Pull(Job):
     """
@@ -41,17 +69,35 @@ class Pull(Job):
 
     name = "pull"
 
-    def do(self, source: dict, path: str, secrets: Dict = {}, **kwargs):  # type: ignore
+    def do(  # type: ignore
+        self,
+        source: dict,
+        path: str,
+        secrets: Dict = {},
+        revision: Optional[str] = None,
+        files: Optional[Files] = None,
+        **kwargs,
+    ):
         """
         Pull `source` to `path` within `project`.
 
+        If the source's current revision is the same as `revision`, and the `files`
+        from the previous pull are still on disk, unchanged, then the source is
+        not pulled again. Otherwise, after pulling, any of the `files` from the
+        previous pull that are no longer in the source are removed.
+
         :param source:  A dictionary with `type` and any other keys required to
                         pull the source (e.g. urls, authentication tokens).
         :param path:    The path, within the project, to pull the source to;
                         could be the path of a directory or file; may not yet exist.
         :param secrets: Authentication credentials, API keys and other secrets needed
                         to pull the source. Secrets are not displayed in job listings.
-        :returns:       A list of paths, with the project, created by the pull.
+        :param revision: The revision of the source when it was last pulled.
+        :param files:   The files, within the project, created by the last pull.
+        :returns:       A dictionary with `files` (the files, within the project,
+                        created by the pull), the `revision` of the source
+                        pulled, whether the source was `unchanged`, and the
+                        `version` of the shape of this result.
         """
         assert isinstance(source, dict), "source must be a dictionary"
         assert "type" in source, "source must have a type"
@@ -65,8 +111,94 @@ class Pull(Job):
             raise ValueError("Unknown source type: {}".format(typ))
         pull_func = PULL_FUNCS[typ]
 
-        # Call the function to get a dictionary of files
-        files = pull_func(source=source, path=path, secrets=secrets)
+        # Get the current revision of the source, if possible
+        current = None
+        revision_func = REVISION_FUNCS.get(typ)
+        if revision_func:
+            try:
+                current = revision_func(source=source, secrets=secrets)
+            except Exception as exc:
+                self.warn(f"Unable to get revision of source: {exc}")
+
+        # The directory that file paths are relative to
+        base = (path or ".") if typ in RELATIVE_PATHS else "."
+
+        same_revision = bool(current) and current == revision
+        on_disk = (
+            bool(files)
+            and (same_revision or typ in CONDITIONAL_PULLS)
+            and files_unchanged(files, base)  # type: ignore
+        )
+        if on_disk and same_revision:
+            self.info("Source is unchanged since it was last pulled")
+            return dict(
+                files=OrderedDict(sorted(files.items())),  # type: ignore
+                revision=current,
+                unchanged=True,
+                version=PULL_RESULT_VERSION,
+            )
+
+        # Call the function to get a dictionary of files. If the files from the
+        # last pull are unchanged on disk, the function may use the previous revision
+        # to only pull the source if it has changed (e.g. with a conditional request)
+        if on_disk and typ in CONDITIONAL_PULLS:
+            pulled = pull_func(
+                source=source,
+                path=path,
+                secrets=secrets,
+                revision=revision,
+                files=files,
+            )
+        else:
+            pulled = pull_func(source=source, path=path, secrets=secrets)
+
+        if files:
+            remove_files(files, pulled, base)
 
         # Sort the dictionary by file path
-        return OrderedDict(sorted(files.items()))
+        return dict(
+            files=OrderedDict(sorted(pulled.items())),
+            revision=current,
+            unchanged=bool(files) and pulled == files,
+            version=PULL_RESULT_VERSION,
+        )
+
+
+def files_unchanged(files: Files, base: str = ".") -> bool:
+    """
+    Check that files are on disk and have the same size and fingerprint as recorded.
+
+    Uses the manifest for the directory so that unchanged files
+    do not need to be read to be fingerprinted.
+    """
+    manifest = Manifest.load(".")
+    for path, info in files.items():
+        full_path = os.path.join(base, path)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != info.get("size"):
+            return False
+        entry = manifest.get(full_path, stat)
+        fingerprint = entry["fingerprint"] if entry else file_fingerprint(full_path)
+        if fingerprint != info.get("fingerprint"):
+            return False
+    return True
+
+
+def remove_files(previous: Files, current: Files, base: str = ".") -> None:
+    """
+    Remove files from a previous pull that are not in the current pull.
+
+    Files that have been modified since they were pulled (e.g. by another
+    job) are left in place.
+    """
+    for path, info in previous.items():
+        if path in current:
+            continue
+        full_path = os.path.join(base, path)
+        if os.path.isfile(full_path) and file_fingerprint(full_path) == info.get(
+            "fingerprint"
+        ):
+            os.unlink(full_path)
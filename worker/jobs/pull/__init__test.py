@@ -1,6 +1,11 @@
+import os
+
 import pytest
 
-from . import Pull
+from util.files import file_info
+from util.working_directory import working_directory
+
+from . import PULL_RESULT_VERSION, Pull
 
 
 def test_missing_type():
@@ -15,3 +20,72 @@ def test_unknown_type():
     with pytest.raises(ValueError) as excinfo:
         pull.do({"type": "foo"}, "path")
     assert "Unknown source type: foo" in str(excinfo.value)
+
+
+@pytest.fixture
+def pull_funcs(tmp_path, monkeypatch):
+    """
+    Replace the pull and revision functions for a test source type.
+
+    The pull function writes the files in `source["files"]` and the revision
+    function returns `source["revision"]`.
+    """
+    from . import PULL_FUNCS, REVISION_FUNCS
+
+    calls = []
+
+    def pull_test(source, path, **kwargs):
+        calls.append(source)
+        files = {}
+        for name, content in source["files"].items():
+            with open(name, "w") as file:
+                file.write(content)
+            files[name] = file_info(name)
+        return files
+
+    monkeypatch.setitem(PULL_FUNCS, "test", pull_test)
+    monkeypatch.setitem(
+        REVISION_FUNCS, "test", lambda source, **kwargs: source["revision"]
+    )
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+    return calls
+
+
+def test_revision_unchanged(tempdir, pull_funcs):
+    with working_directory(tempdir.path):
+        source = dict(type="test", revision="1", files={"a.txt": "a"})
+        first = Pull().do(source, "")
+        assert first["version"] == PULL_RESULT_VERSION
+        assert first["revision"] == "1"
+        assert first["unchanged"] is False
+        assert list(first["files"].keys()) == ["a.txt"]
+        assert len(pull_funcs) == 1
+
+        # Same revision and files on disk so not pulled again
+        second = Pull().do(source, "", revision="1", files=first["files"])
+        assert second["version"] == PULL_RESULT_VERSION
+        assert second["unchanged"] is True
+        assert second["files"] == first["files"]
+        assert len(pull_funcs) == 1
+
+        # File modified on disk so pulled again
+        open("a.txt", "w").write("aa")
+        third = Pull().do(source, "", revision="1", files=first["files"])
+        assert third["unchanged"] is False
+        assert len(pull_funcs) == 2
+        assert open("a.txt").read() == "a"
+
+
+def test_revision_changed(tempdir, pull_funcs):
+    with working_directory(tempdir.path):
+        source = dict(type="test", revision="1", files={"a.txt": "a", "b.txt": "b"})
+        first = Pull().do(source, "")
+
+        # Files no longer in the source are removed, unless they were modified
+        open("b.txt", "w").write("bb")
+        source = dict(type="test", revision="2", files={"c.txt": "c"})
+        second = Pull().do(source, "", revision="1", files=first["files"])
+        assert second["revision"] == "2"
+        assert second["unchanged"] is False
+        assert list(second["files"].keys()) == ["c.txt"]
+        assert sorted(os.listdir()) == ["b.txt", "c.txt"]
@@ -9,7 +9,7 @@ from typing import List, Optional
 from lxml import etree
 
 from util.files import Files, ensure_dir, file_info
-from util.http import HttpSession
+from util.http import get_http_session
 
 
 def pull_elife(source: dict, path: Optional[str] = None, **kwargs) -> Files:
@@ -30,7 +30,7 @@ def pull_elife(source: dict, path: Optional[str] = None, **kwargs) -> Files:
     ensure_dir(folder)
 
     files = {}
-    session = HttpSession()
+    session = get_http_session()
 
     # Get the article JATS XML
     url = f"https://elifesciences.org/articles/{article}.xml"
@@ -73,3 +73,17 @@ def pull_elife(source: dict, path: Optional[str] = None, **kwargs) -> Files:
     files[path] = file_info(path, mimetype="application/jats+xml")
 
     return files
+
+
+def revision_elife(source: dict, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of an eLife article.
+
+    The article's XML URL redirects to the URL of the latest version
+    so the revision includes the article's version number.
+    """
+    article = source.get("article")
+    assert article, "eLife source must have an article number"
+    return get_http_session().fetch_revision(
+        f"https://elifesciences.org/articles/{article}.xml"
+    )
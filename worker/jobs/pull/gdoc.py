@@ -7,7 +7,7 @@ from googleapiclient.discovery import build
 from oauth2client.client import GoogleCredentials
 
 from util.files import Files, ensure_parent, file_info
-from util.gapis import gdocs_service
+from util.gapis import gdocs_service, gdrive_service
 
 
 def pull_gdoc(
@@ -30,3 +30,26 @@ def pull_gdoc(
         file.write(json.dumps(gdoc, indent=2).encode("utf-8"))
 
     return {path: file_info(path, mimetype="application/vnd.google-apps.document")}
+
+
+def revision_gdoc(source: dict, secrets: dict = {}, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of a Google Doc (its version number in Google Drive).
+    """
+    doc_id = source.get("doc_id")
+    assert doc_id, "A Google Doc id is required"
+
+    return drive_version(secrets, doc_id)
+
+
+def drive_version(secrets: dict, file_id: str) -> Optional[str]:
+    """
+    Get the version number of a file in Google Drive.
+
+    The version is incremented on every change to the file (including
+    to its content, name and permissions).
+    """
+    file = (
+        gdrive_service(secrets).files().get(fileId=file_id, fields="version").execute()
+    )
+    return file.get("version")
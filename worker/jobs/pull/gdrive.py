@@ -1,13 +1,36 @@
+import hashlib
+import json
+import logging
 import os
 import shutil
+import threading
 import typing
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISREG
+from typing import List, Optional, Tuple
 
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 
-from util.files import Files, file_info
-from util.gapis import gdrive_service
+from util.files import FileInfo, Files, ensure_parent, fingerprinted_info
+from util.gapis import gdrive_service, google_http
+from util.manifest import Manifest
+
+logger = logging.getLogger(__name__)
+
+# Number of threads used to download the files in a Google Drive folder
+GDRIVE_PULL_WORKERS = int(os.getenv("GDRIVE_PULL_WORKERS", 8))
+
+# Number of files to list in each request (the Drive API's maximum is 1000)
+GDRIVE_PAGE_SIZE = int(os.getenv("GDRIVE_PAGE_SIZE", 1000))
+
+# The fields of each file needed to pull a folder
+GDRIVE_FOLDER_FIELDS = "nextPageToken, files(id, name, mimeType, md5Checksum, size)"
+
+# Size of the chunks that files are read in when checksumming them
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+FOLDER_MIMETYPE = "application/vnd.google-apps.folder"
 
 
 def pull_gdrive(
@@ -29,7 +52,45 @@ def pull_gdrive(
     if kind == "file":
         return pull_file(files_resource, google_id, path or "google-" + google_id)
     else:
-        return pull_folder(files_resource, google_id, path or "")
+        return pull_folder(files_resource, google_id, path or "", secrets)
+
+
+def revision_gdrive(source: dict, secrets: dict = {}, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of a Google Drive file or folder.
+
+    For a file, this is its version number. For a folder, it is a hash
+    of the id, name, MD5 checksum and version of each of the files within it
+    (recursively) so that adding, removing, renaming or changing any of
+    them changes the revision.
+    """
+    assert source.get("kind") in (
+        "file",
+        "folder",
+    ), "Kind is required and must be file or folder"
+    assert source.get("google_id"), "A Google id is required"
+
+    files_resource = gdrive_service(secrets).files()
+    if source["kind"] == "file":
+        file = files_resource.get(
+            fileId=source["google_id"], fields="version"
+        ).execute()
+        return file.get("version")
+
+    hash = hashlib.sha256()
+    folders = [source["google_id"]]
+    while folders:
+        folder_id = folders.pop()
+        children = list_folder(
+            files_resource,
+            folder_id,
+            fields="nextPageToken, files(id, name, mimeType, md5Checksum, version)",
+        )
+        for child in sorted(children, key=lambda child: child["id"]):
+            if child["mimeType"] == "application/vnd.google-apps.folder":
+                folders.append(child["id"])
+            hash.update(json.dumps(child, sort_keys=True).encode())
+    return hash.hexdigest()
 
 
 def pull_file(files_resource, file_id: str, path: str) -> Files:
@@ -39,49 +100,194 @@ def pull_file(files_resource, file_id: str, path: str) -> Files:
     if os.path.exists(path) and os.path.isdir(path):
         shutil.rmtree(path)
 
-    with open(path, "wb") as file:
-        request = files_resource.get_media(fileId=file_id)
-        downloader = MediaIoBaseDownload(file, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-
-    return {path: file_info(path)}
+    fingerprint, md5 = download_file(files_resource.get_media(fileId=file_id), path)
+    return {path: fingerprinted_info(path, fingerprint)}
 
 
-def pull_folder(files_resource, folder_id: str, path: str) -> Files:
+def pull_folder(
+    files_resource,
+    folder_id: str,
+    path: str,
+    secrets: dict = {},
+    workers: Optional[int] = None,
+) -> Files:
     """
     Pull a folder from Google Drive.
+
+    The folder is listed (recursively) and then the files in it are downloaded in
+    parallel using `workers` threads (defaults to `GDRIVE_PULL_WORKERS`). Files
+    that are already on disk, with the same size and MD5 checksum as in Google Drive,
+    are not downloaded again (their MD5 is obtained from the manifest for `path`,
+    if they have not changed since being recorded, or by reading the file).
     """
-    if path:
-        if os.path.exists(path):
-            if not os.path.isdir(path):
-                os.unlink(path)
-        else:
-            os.makedirs(path, exist_ok=True)
+    if workers is None:
+        workers = GDRIVE_PULL_WORKERS
+    children = list_tree(files_resource, folder_id, path)
+    parallel = workers > 1 and len(children) > 1
 
-    files = {}
-    for child in list_folder(files_resource, folder_id):
-        child_path = os.path.join(path, child["name"])
-        if child["mimeType"] == "application/vnd.google-apps.folder":
-            files.update(pull_folder(files_resource, child["id"], child_path))
-        else:
-            if child["mimeType"].startswith("application/vnd.google-apps."):
-                continue
-            files.update(pull_file(files_resource, child["id"], child_path))
+    manifest = Manifest.load(path or ".")
+    local = threading.local()
+
+    def pull(item: Tuple[dict, str]) -> FileInfo:
+        child, child_path = item
+        request = files_resource.get_media(fileId=child["id"])
+        if parallel:
+            # The HTTP client of the service is not thread safe
+            # so use one for each thread
+            if not hasattr(local, "http"):
+                local.http = google_http(secrets)
+            request.http = local.http
+        return pull_child(request, child, child_path, manifest)
+
+    if not parallel:
+        infos = list(map(pull, children))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            infos = list(executor.map(pull, children))
+
+    manifest.save(merge=True)
+    return dict(
+        (child_path, info) for (child, child_path), info in zip(children, infos)
+    )
+
+
+def list_tree(files_resource, folder_id: str, path: str) -> List[Tuple[dict, str]]:
+    """
+    List the files within a Google Drive folder, and its sub-folders.
+
+    Creates the directories for the folder, and sub-folders, at `path`.
+    Google Docs, Sheets etc are skipped because they can not be downloaded
+    directly. Returns a list of the files and the paths that they should be
+    pulled to.
+    """
+    files = []
+    folders = [(folder_id, path)]
+    while folders:
+        folder_id, folder_path = folders.pop(0)
+        if folder_path:
+            if os.path.exists(folder_path):
+                if not os.path.isdir(folder_path):
+                    os.unlink(folder_path)
+            else:
+                os.makedirs(folder_path, exist_ok=True)
+
+        for child in list_folder(files_resource, folder_id, GDRIVE_FOLDER_FIELDS):
+            child_path = os.path.join(folder_path, child["name"])
+            if child["mimeType"] == FOLDER_MIMETYPE:
+                folders.append((child["id"], child_path))
+            elif not child["mimeType"].startswith("application/vnd.google-apps."):
+                files.append((child, child_path))
     return files
 
 
-def list_folder(files_resource, folder_id: str):
+def pull_child(request, child: dict, path: str, manifest: Manifest) -> FileInfo:
+    """
+    Pull a file within a Google Drive folder, unless it is unchanged.
+    """
+    try:
+        stat: Optional[os.stat_result] = os.stat(path)
+    except FileNotFoundError:
+        stat = None
+
+    md5 = child.get("md5Checksum")
+    entry = None
+    fingerprint = None
+    if (
+        md5
+        and stat
+        and S_ISREG(stat.st_mode)
+        and str(stat.st_size) == str(child.get("size"))
+    ):
+        entry = manifest.get(path, stat)
+        if entry and entry.get("md5") == md5:
+            fingerprint = entry["fingerprint"]
+        else:
+            entry = None
+            existing, existing_md5 = file_checksums(path)
+            if existing_md5 == md5:
+                fingerprint = existing
+
+    if fingerprint is None:
+        if stat and not S_ISREG(stat.st_mode):
+            shutil.rmtree(path)
+        fingerprint, downloaded = download_file(request, path)
+        if md5 and downloaded != md5:
+            logger.warning(f"MD5 checksum mismatch for downloaded file {path}")
+        md5 = downloaded
+
+    if entry:
+        assert stat is not None
+        info = {
+            "size": stat.st_size,
+            "mimetype": entry["mimetype"],
+            "encoding": entry["encoding"],
+            "modified": stat.st_mtime,
+            "fingerprint": fingerprint,
+        }
+    else:
+        info = fingerprinted_info(path, fingerprint)
+        stat = os.stat(path)
+    manifest.set(path, stat, {**info, "md5": md5})
+    return info
+
+
+class ChecksummedFile:
+    """
+    A writable file which calculates the SHA256 and MD5 of the bytes written to it.
+    """
+
+    def __init__(self, file: typing.BinaryIO):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        self.md5.update(data)
+        return self.file.write(data)
+
+
+def download_file(request, path: str) -> Tuple[str, str]:
+    """
+    Download a file, returning its SHA256 fingerprint and MD5 checksum.
+    """
+    with open(ensure_parent(path), "wb") as file:
+        checksummed = ChecksummedFile(file)
+        downloader = MediaIoBaseDownload(checksummed, request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+    return checksummed.sha256.hexdigest(), checksummed.md5.hexdigest()
+
+
+def file_checksums(path: str) -> Tuple[str, str]:
+    """
+    Get the SHA256 fingerprint and MD5 checksum of a file in a single pass.
+    """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def list_folder(files_resource, folder_id: str, fields: Optional[str] = None):
     """
     List the files or sub-folders within a Google Drive folder.
+
+    Use `fields` to specify which fields of each file to get
+    (defaults to the default fields of the Google Drive API).
     """
     next_page_token = None
     files: typing.List[dict] = []
     query = "'{}' in parents".format(folder_id)
 
     while True:
-        resp = files_resource.list(q=query, pageToken=next_page_token).execute()
+        resp = files_resource.list(
+            q=query, pageToken=next_page_token, pageSize=GDRIVE_PAGE_SIZE, fields=fields
+        ).execute()
         files += list(resp["files"])
         next_page_token = resp.get("nextPageToken")
 
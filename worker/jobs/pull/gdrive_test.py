@@ -1,8 +1,11 @@
+import hashlib
 import os
+from unittest import mock
 
 import pytest
 
-from .gdrive import pull_gdrive
+from . import gdrive
+from .gdrive import file_checksums, pull_folder, pull_gdrive
 
 # The following access token is expired, but was valid when this test
 # was recorded. To re-record this test, get a new google token, and
@@ -17,7 +20,10 @@ GOOGLE_TOKEN = (
 
 
 @pytest.mark.vcr
-def test_folder(tempdir):
+def test_folder(tempdir, monkeypatch):
+    # VCR's patching of `httplib2` is not thread safe so download files sequentially
+    monkeypatch.setattr(gdrive, "GDRIVE_PULL_WORKERS", 1)
+
     pull_gdrive(
         source=dict(kind="folder", google_id="14SEW9vSYDfgCvuyTjwQI6-x-RF3B_s4z"),
         path=tempdir.path,
@@ -29,3 +35,75 @@ def test_folder(tempdir):
         "sub/test-2.txt",
     ):
         assert os.path.exists(os.path.join(tempdir.path, expected))
+
+
+class FakeFiles:
+    """
+    A fake Google Drive `files` resource with a folder containing a file and a sub-folder.
+    """
+
+    def __init__(self, contents):
+        self.contents = contents
+
+    def list(self, q, **kwargs):
+        folder = q.split("'")[1]
+        children = {
+            "root": [
+                dict(id="a", name="a.txt", mimeType="text/plain"),
+                dict(
+                    id="sub", name="sub", mimeType="application/vnd.google-apps.folder"
+                ),
+                dict(
+                    id="doc",
+                    name="doc",
+                    mimeType="application/vnd.google-apps.document",
+                ),
+            ],
+            "sub": [dict(id="b", name="b.txt", mimeType="text/plain")],
+        }[folder]
+        for child in children:
+            content = self.contents.get(child["id"])
+            if content is not None:
+                child.update(
+                    md5Checksum=hashlib.md5(content).hexdigest(), size=str(len(content))
+                )
+        return mock.Mock(execute=lambda: dict(files=children))
+
+    def get_media(self, fileId):
+        return fileId
+
+
+def test_folder_unchanged(tempdir, tmp_path, monkeypatch):
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+    contents = {"a": b"a", "b": b"b"}
+    downloaded = []
+
+    def download_file(file_id, path):
+        downloaded.append(file_id)
+        with open(path, "wb") as file:
+            file.write(contents[file_id])
+        return file_checksums(path)
+
+    monkeypatch.setattr(gdrive, "download_file", download_file)
+    files_resource = FakeFiles(contents)
+
+    files = pull_folder(files_resource, "root", tempdir.path, workers=1)
+    assert sorted(downloaded) == ["a", "b"]
+    assert sorted(files.keys()) == [
+        os.path.join(tempdir.path, "a.txt"),
+        os.path.join(tempdir.path, "sub", "b.txt"),
+    ]
+
+    # Unchanged files are not downloaded again
+    downloaded.clear()
+    assert pull_folder(files_resource, "root", tempdir.path, workers=1) == files
+    assert downloaded == []
+
+    # Changed in Google Drive, or locally, files are
+    contents["a"] = b"A"
+    with open(os.path.join(tempdir.path, "sub", "b.txt"), "w") as file:
+        file.write("c")
+    pull_folder(files_resource, "root", tempdir.path, workers=1)
+    assert sorted(downloaded) == ["a", "b"]
+    assert open(os.path.join(tempdir.path, "a.txt")).read() == "A"
+    assert open(os.path.join(tempdir.path, "sub", "b.txt")).read() == "b"
@@ -1,21 +1,54 @@
+import hashlib
+import logging
 import os
+import re
+import shutil
+import subprocess
 import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional
+from stat import S_ISREG
+from typing import Iterable, List, Optional, Tuple
 from zipfile import ZipFile, ZipInfo
 
 import httpx
+from github import GithubException
 
+from config import get_files_workers
 from util.files import (
+    FileInfo,
     Files,
     bytes_fingerprint,
     ensure_parent,
     file_fingerprint,
     file_info,
     file_mimetype,
+    files_info,
+    fingerprinted_info,
+    write_chunks,
 )
 from util.github_api import github_client
+from util.manifest import Manifest
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks read from zip members and written to files
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+# Repositories up to this size (in KiB, as reported by the GitHub API)
+# are always pulled by downloading a zipball of the whole repository.
+# Larger repositories, with a `subpath`, are pulled using the API or Git.
+GITHUB_ZIPBALL_MAX_SIZE = int(os.getenv("GITHUB_ZIPBALL_MAX_SIZE", 50 * 1024))
+
+# Maximum number of files in a `subpath` to fetch individually using
+# the API. Subpaths with more files are fetched using a sparse Git clone.
+GITHUB_API_MAX_FILES = int(os.getenv("GITHUB_API_MAX_FILES", 50))
+
+# Base URLs for the GitHub API and for cloning repositories
+GITHUB_API_URL = "https://api.github.com/"
+GITHUB_GIT_URL = "https://github.com/"
 
 
 def pull_github(
@@ -26,6 +59,11 @@ def pull_github(
 
     If a user token is provided in `secrets` it will be used to authenticate
     as that user.
+
+    For small repositories, or if there is no `subpath`, a zipball of the repository
+    is downloaded. Otherwise, to avoid downloading the entire repository, the files
+    in the `subpath` are fetched using the API (if there are only a few of them)
+    or using a shallow, sparse, Git clone.
     """
     assert source.get("repo"), "GitHub source must have a repo"
 
@@ -35,10 +73,21 @@ def pull_github(
 
     path = path or "."
 
+    token = secrets.get("token")
+    client = github_client(token)
+    repo_resource = client.get_repo(source["repo"])
+
+    if subpath and (repo_resource.size or 0) > GITHUB_ZIPBALL_MAX_SIZE:
+        ref = repo_resource.default_branch
+        blobs = subpath_blobs(repo_resource, subpath, ref)
+        if blobs is not None and len(blobs) <= GITHUB_API_MAX_FILES:
+            logger.info(f"Pulling {len(blobs)} files using the API")
+            return pull_blobs(source["repo"], blobs, subpath, path, token)
+        logger.info("Pulling files using sparse clone")
+        return pull_git(source["repo"], subpath, path, token, ref)
+
     # Get the possibly token protected link for the repo archive
     # See https://developer.github.com/v3/repos/contents/#download-a-repository-archive
-    client = github_client(secrets.get("token"))
-    repo_resource = client.get_repo(source["repo"])
     archive_link = repo_resource.get_archive_link("zipball")
 
     # Get the archive. To avoid it filling up memory, stream directly to file,
@@ -52,8 +101,25 @@ def pull_github(
     return pull_zip(zip_file.name, subpath=subpath, path=path)
 
 
+def revision_github(source: dict, secrets: dict = {}, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of a GitHub repo (the SHA of the default branch's head commit).
+
+    This is the revision of the whole repository, not just the `subpath`, so a
+    commit that does not touch the `subpath` will still cause it to be pulled.
+    """
+    assert source.get("repo"), "GitHub source must have a repo"
+
+    repo_resource = github_client(secrets.get("token")).get_repo(source["repo"])
+    return repo_resource.get_branch(repo_resource.default_branch).commit.sha
+
+
 def pull_zip(
-    zip_file: str, subpath: str = "", path: str = ".", strip: int = 1
+    zip_file: str,
+    subpath: str = "",
+    path: str = ".",
+    strip: int = 1,
+    workers: Optional[int] = None,
 ) -> Files:
     """
     Pull files from a Zip file.
@@ -63,8 +129,10 @@ def pull_zip(
     :param path: The destination path
     :param strip: Number of leading components from filenames to ignore.
                   Similar to `tar`'s `--strip-components` option.
+    :param workers: Number of threads to extract files with.
+                    Defaults to the configured number of workers for files.
     """
-    files = {}
+    members = {}
 
     with ZipFile(zip_file, "r") as zip_archive:
         for zip_info in zip_archive.infolist():
@@ -78,26 +146,283 @@ def pull_zip(
             inner_path = os.path.join(*(zip_path.split("/")[strip:]))
 
             # Save if in the subpath
-            remainder_path = None
-            if subpath == "":
-                remainder_path = inner_path
-            elif inner_path.startswith(subpath + "/"):
-                chars = len(subpath) + 1
-                remainder_path = inner_path[chars:]
-            elif inner_path == subpath:
-                remainder_path = inner_path
-
+            remainder_path = subpath_remainder(inner_path, subpath)
             if remainder_path:
-                dest_path = os.path.join(path, remainder_path)
+                # Skip any paths that would be outside of the destination
+                # (`ZipFile.extract` used to sanitize these)
+                if os.path.isabs(remainder_path) or ".." in remainder_path.split("/"):
+                    logger.warning(f"Skipping unsafe path in zip file: {zip_path}")
+                    continue
+
+                members[remainder_path] = zip_info
+
+        # Extract the files, fingerprinting them as they are written, in parallel
+        manifest = Manifest.load(path)
+
+        def extract(item: Tuple[str, ZipInfo]) -> FileInfo:
+            remainder_path, zip_info = item
+            return extract_member(
+                zip_archive, zip_info, os.path.join(path, remainder_path), manifest
+            )
+
+        if workers is None:
+            workers = get_files_workers()
+        if workers <= 1 or len(members) <= 1:
+            infos = list(map(extract, members.items()))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                infos = list(executor.map(extract, members.items()))
+
+    manifest.save(merge=True)
+    return dict(zip(members.keys(), infos))
+
+
+def subpath_remainder(inner_path: str, subpath: str) -> Optional[str]:
+    """
+    Get the path of a file in a repository relative to the `subpath` being pulled.
+
+    Returns `None` if the file is not within the subpath. If the subpath
+    is the file itself, then the whole path is returned.
+    """
+    if subpath == "":
+        return inner_path
+    elif inner_path.startswith(subpath + "/"):
+        chars = len(subpath) + 1
+        return inner_path[chars:]
+    elif inner_path == subpath:
+        return inner_path
+    return None
+
+
+def subpath_blobs(repo, subpath: str, ref: str) -> Optional[List[Tuple[str, str, int]]]:
+    """
+    Get the path, SHA and size of each of the files in a subpath of a repository.
+
+    Uses the Git trees API to get the tree for the subpath (or the
+    contents API if the subpath is a file). Returns `None` if the list of files
+    could not be obtained (e.g. the tree was truncated because it is too large).
+    """
+    try:
+        tree = repo.get_git_tree(f"{ref}:{subpath}", recursive=True)
+    except GithubException:
+        # The subpath may be a file rather than a directory
+        try:
+            content = repo.get_contents(subpath, ref=ref)
+        except GithubException:
+            return None
+        if isinstance(content, list):
+            return None
+        return [(subpath, content.sha, content.size)]
+
+    if tree.raw_data.get("truncated"):
+        return None
+    return [
+        (f"{subpath}/{element.path}", element.sha, element.size)
+        for element in tree.tree
+        if element.type == "blob"
+    ]
+
 
-                # Using `extract` is much much faster than reading bytes
-                # and then writing them to file. Also it maintains other file info
-                # such as modified time in the file written to disk. This speed up
-                # is much more important for real world zips than any speed advantage
-                # due to not reading bytes twice for fingerprint generation.
-                zip_info.filename = dest_path
-                zip_archive.extract(zip_info)
+def pull_blobs(
+    repo: str,
+    blobs: List[Tuple[str, str, int]],
+    subpath: str,
+    path: str,
+    token: Optional[str] = None,
+) -> Files:
+    """
+    Pull files from a repository using the Git blobs API.
+
+    Files are fetched in parallel and fingerprinted as they are written.
+    Files in the working copy that have the same Git SHA are not fetched.
+    """
+    headers = {"Accept": "application/vnd.github.v3.raw"}
+    if token:
+        headers["Authorization"] = f"token {token}"
+
+    paths = {}
+    for inner_path, sha, size in blobs:
+        remainder_path = subpath_remainder(inner_path, subpath)
+        if remainder_path:
+            paths[remainder_path] = (os.path.join(path, remainder_path), sha, size)
+
+    def fetch(item: Tuple[str, str, int]) -> FileInfo:
+        dest_path, sha, size = item
+        if (
+            os.path.isfile(dest_path)
+            and os.path.getsize(dest_path) == size
+            and git_blob_sha(dest_path) == sha
+        ):
+            return file_info(dest_path)
+
+        url = f"{GITHUB_API_URL}repos/{repo}/git/blobs/{sha}"
+        with client.stream("GET", url) as response:
+            response.raise_for_status()
+            fingerprint = write_chunks(
+                response.iter_bytes(EXTRACT_CHUNK_SIZE), dest_path
+            )
+        return fingerprinted_info(dest_path, fingerprint)
+
+    with httpx.Client(headers=headers, timeout=60) as client, ThreadPoolExecutor(
+        max_workers=get_files_workers()
+    ) as executor:
+        infos = list(executor.map(fetch, paths.values()))
+
+    return dict(zip(paths.keys(), infos))
+
+
+def pull_git(
+    repo: str,
+    subpath: str,
+    path: str,
+    token: Optional[str] = None,
+    ref: Optional[str] = None,
+) -> Files:
+    """
+    Pull files from a repository using a shallow, sparse, Git clone.
+
+    Only the latest commit, and the tree objects for it, are fetched
+    (`--depth 1 --filter=blob:none`). The sparse checkout of `subpath` then
+    fetches only the blobs for files within it.
+
+    The token is passed to Git in an environment variable, read by a credential
+    helper, so that it is not on the command line (where it would be visible
+    in the process list, and in the message of a `CalledProcessError`).
+    `GIT_CONFIG_COUNT` is not used because it requires Git 2.31.
+    """
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    auth = []
+    if token:
+        env["GIT_PULL_TOKEN"] = token
+        auth = [
+            "-c",
+            "credential.helper=",
+            "-c",
+            'credential.helper=!f() { test "$1" = get && '
+            "echo username=x-access-token && "
+            'echo "password=$GIT_PULL_TOKEN"; }; f',
+        ]
+
+    def git(*args: str) -> None:
+        try:
+            subprocess.run(
+                ["git", *auth, *args], env=env, check=True, capture_output=True,
+            )
+        except subprocess.CalledProcessError as exc:
+            # Raise without the command (or its environment)
+            stderr = exc.stderr.decode(errors="replace").strip()
+            raise RuntimeError(f"Unable to pull using Git: {stderr}") from None
+
+    with tempfile.TemporaryDirectory() as temp:
+        git(
+            "clone",
+            "--quiet",
+            "--depth=1",
+            "--filter=blob:none",
+            "--no-checkout",
+            *([f"--branch={ref}"] if ref else []),
+            f"{GITHUB_GIT_URL}{repo}.git",
+            temp,
+        )
+        git("-C", temp, "config", "core.sparseCheckout", "true")
+        with open(os.path.join(temp, ".git", "info", "sparse-checkout"), "w") as file:
+            # Escape any characters that have special meaning in patterns
+            file.write("/" + re.sub(r"([*?\[\\!#])", r"\\\1", subpath) + "\n")
+        git("-C", temp, "read-tree", "-mu", "HEAD")
 
-                files[remainder_path] = file_info(dest_path)
+        paths = {}
+        for dirpath, dirnames, filenames in os.walk(temp):
+            if ".git" in dirnames:
+                dirnames.remove(".git")
+            for filename in filenames:
+                inner_path = os.path.relpath(os.path.join(dirpath, filename), temp)
+                remainder_path = subpath_remainder(inner_path, subpath)
+                if remainder_path:
+                    dest_path = os.path.join(path, remainder_path)
+                    shutil.move(
+                        os.path.join(dirpath, filename), ensure_parent(dest_path)
+                    )
+                    paths[remainder_path] = dest_path
 
-    return files
+    return files_info(paths)
+
+
+def git_blob_sha(path: str) -> str:
+    """
+    Get the Git SHA-1 of a file (the hash of its content as a Git blob).
+    """
+    h = hashlib.sha1()
+    h.update(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(EXTRACT_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extract_member(
+    zip_archive: ZipFile,
+    zip_info: ZipInfo,
+    dest_path: str,
+    manifest: Optional[Manifest] = None,
+) -> FileInfo:
+    """
+    Extract a member of a Zip file and get info on it.
+
+    The file is fingerprinted while it is being written, rather than being read
+    again afterwards. If there is already a file at `dest_path` with the same size and
+    CRC as the member then it is not rewritten (its CRC is obtained from the `manifest`,
+    if the file has not changed since it was recorded, or by reading the file).
+    """
+    try:
+        stat: Optional[os.stat_result] = os.stat(dest_path)
+    except FileNotFoundError:
+        stat = None
+
+    entry = None
+    fingerprint = None
+    if stat and S_ISREG(stat.st_mode) and stat.st_size == zip_info.file_size:
+        entry = manifest.get(dest_path, stat) if manifest else None
+        if entry and entry.get("crc") == zip_info.CRC:
+            fingerprint = entry["fingerprint"]
+        else:
+            entry = None
+            crc, existing = file_crc_fingerprint(dest_path)
+            if crc == zip_info.CRC:
+                fingerprint = existing
+
+    if fingerprint is None:
+        with zip_archive.open(zip_info) as source:
+            fingerprint = write_chunks(
+                iter(lambda: source.read(EXTRACT_CHUNK_SIZE), b""), dest_path
+            )
+        stat = os.stat(dest_path)
+
+    assert stat is not None
+    if entry:
+        mimetype, encoding = entry["mimetype"], entry["encoding"]
+    else:
+        mimetype, encoding = file_mimetype(dest_path)
+
+    info = {
+        "size": stat.st_size,
+        "mimetype": mimetype,
+        "encoding": encoding,
+        "modified": stat.st_mtime,
+        "fingerprint": fingerprint,
+    }
+    if manifest:
+        manifest.set(dest_path, stat, {**info, "crc": zip_info.CRC})
+    return info
+
+
+def file_crc_fingerprint(path: str) -> Tuple[int, str]:
+    """
+    Get the CRC-32 and SHA256 fingerprint of a file in a single pass.
+    """
+    crc = 0
+    h = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(EXTRACT_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            h.update(chunk)
+    return crc, h.hexdigest()
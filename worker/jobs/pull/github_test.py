@@ -1,12 +1,23 @@
+import hashlib
 import os
+import subprocess
 from contextlib import ContextDecorator
 from unittest import mock
+from zipfile import ZipFile
 
+import httpx
 import pytest
 
 from util.working_directory import working_directory
 
-from .github import pull_github, pull_zip
+from .github import (
+    file_crc_fingerprint,
+    git_blob_sha,
+    pull_blobs,
+    pull_git,
+    pull_github,
+    pull_zip,
+)
 
 
 class MockedHttpxStreamResponse(ContextDecorator):
@@ -123,3 +134,191 @@ def test_huge_zip(tempdir):
 
     with working_directory(tempdir.path):
         pull_zip(zip_file)
+
+
+def make_zip(path, files):
+    with ZipFile(path, "w") as zip_file:
+        for name, content in files.items():
+            zip_file.writestr(name, content)
+    return str(path)
+
+
+@pytest.fixture
+def manifests(tmp_path, monkeypatch):
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+
+
+def test_pull_zip_fingerprints(tmp_path, manifests):
+    zip_file = make_zip(
+        tmp_path / "test.zip",
+        {"repo/a.txt": "A", "repo/b/c.txt": "C" * 100000, "repo/../evil.txt": "E"},
+    )
+    dest = tmp_path / "dest"
+
+    sequential = pull_zip(zip_file, path=str(dest / "1"), workers=1)
+    parallel = pull_zip(zip_file, path=str(dest / "2"), workers=4)
+
+    assert sorted(sequential.keys()) == ["a.txt", "b/c.txt"]
+    for name, info in parallel.items():
+        content = (dest / "2" / name).read_bytes()
+        assert info["fingerprint"] == hashlib.sha256(content).hexdigest()
+        assert info["size"] == len(content)
+        assert info["fingerprint"] == sequential[name]["fingerprint"]
+    assert not (tmp_path / "evil.txt").exists()
+
+
+def test_pull_zip_unchanged(tmp_path, manifests):
+    dest = tmp_path / "dest"
+    first = pull_zip(
+        make_zip(tmp_path / "1.zip", {"repo/a.txt": "A", "repo/b.txt": "B"}),
+        path=str(dest),
+    )
+    stats = dict((name, os.stat(dest / name)) for name in first)
+
+    # Files with the same CRC and size are not rewritten, others are
+    with mock.patch("util.manifest.RACY_NANOSECONDS", 0):
+        second = pull_zip(
+            make_zip(tmp_path / "2.zip", {"repo/a.txt": "A", "repo/b.txt": "X"}),
+            path=str(dest),
+        )
+    assert os.stat(dest / "a.txt").st_mtime_ns == stats["a.txt"].st_mtime_ns
+    assert second["a.txt"] == first["a.txt"]
+    assert (dest / "b.txt").read_text() == "X"
+    assert second["b.txt"]["fingerprint"] == hashlib.sha256(b"X").hexdigest()
+
+    # CRCs are recorded in the manifest so unchanged files do not need to be read
+    # (`b.txt` was modified after the manifest was created so it is not trusted)
+    with mock.patch("util.manifest.RACY_NANOSECONDS", 0), mock.patch(
+        "jobs.pull.github.file_crc_fingerprint", wraps=file_crc_fingerprint
+    ) as wrapped:
+        pull_zip(
+            make_zip(tmp_path / "3.zip", {"repo/a.txt": "A", "repo/b.txt": "X"}),
+            path=str(dest),
+        )
+    assert [call.args[0] for call in wrapped.call_args_list] == [str(dest / "b.txt")]
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A local Git repository that can be cloned using `GITHUB_GIT_URL`."""
+    repo = tmp_path / "remote" / "org" / "repo.git"
+    (repo / "sub" / "dir").mkdir(parents=True)
+    (repo / "sub" / "a.txt").write_text("A")
+    (repo / "sub" / "dir" / "b.txt").write_text("B")
+    (repo / "other.txt").write_text("Other")
+
+    def git(*args):
+        subprocess.run(["git", *args], cwd=repo, check=True, capture_output=True)
+
+    git("init", "--quiet", "--initial-branch=main")
+    git("add", ".")
+    git(
+        "-c", "user.name=Test", "-c", "user.email=test@example.org", "commit", "-m", "."
+    )
+    git("config", "uploadpack.allowFilter", "true")
+
+    with mock.patch(
+        "jobs.pull.github.GITHUB_GIT_URL", f"file://{tmp_path / 'remote'}/"
+    ):
+        yield repo
+
+
+def test_pull_git(tmp_path, repo):
+    dest = tmp_path / "dest"
+
+    files = pull_git("org/repo", "sub", str(dest), ref="main")
+    assert sorted(files.keys()) == ["a.txt", "dir/b.txt"]
+    assert files["a.txt"]["fingerprint"] == hashlib.sha256(b"A").hexdigest()
+    assert (dest / "dir" / "b.txt").read_text() == "B"
+    assert not (dest / "other.txt").exists()
+
+    # A single file
+    files = pull_git("org/repo", "sub/dir/b.txt", str(dest / "single"))
+    assert list(files.keys()) == ["sub/dir/b.txt"]
+
+
+def test_pull_blobs(tmp_path):
+    blobs = {"A": "sha-a", "B": "sha-b"}
+    (tmp_path / "b.txt").write_text("B")
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.path)
+        content = {"sha-a": b"A", "sha-b": b"B"}[request.url.path.split("/")[-1]]
+        return httpx.Response(200, content=content)
+
+    Client = httpx.Client
+    with mock.patch(
+        "httpx.Client",
+        lambda **kwargs: Client(transport=httpx.MockTransport(handler), **kwargs),
+    ), mock.patch("jobs.pull.github.git_blob_sha", return_value=blobs["B"]):
+        files = pull_blobs(
+            "org/repo",
+            [("sub/a.txt", blobs["A"], 1), ("sub/b.txt", blobs["B"], 1)],
+            "sub",
+            str(tmp_path),
+        )
+
+    # The file with the same SHA is not fetched
+    assert requested == ["/repos/org/repo/git/blobs/sha-a"]
+    assert (tmp_path / "a.txt").read_text() == "A"
+    assert files["a.txt"]["fingerprint"] == hashlib.sha256(b"A").hexdigest()
+    assert files["b.txt"]["fingerprint"] == hashlib.sha256(b"B").hexdigest()
+
+
+def test_git_blob_sha(tmp_path, repo):
+    output = subprocess.run(
+        ["git", "hash-object", "sub/a.txt"], cwd=repo, capture_output=True, text=True
+    )
+    assert git_blob_sha(str(repo / "sub" / "a.txt")) == output.stdout.strip()
+
+
+@pytest.mark.parametrize(
+    "size,blobs,strategy",
+    [
+        (1000, None, "zip"),
+        (10 ** 6, [("sub/a.txt", "sha", 1)], "blobs"),
+        (10 ** 6, [("sub/a.txt", "sha", 1)] * 100, "git"),
+        (10 ** 6, None, "git"),
+    ],
+)
+def test_pull_github_strategy(size, blobs, strategy):
+    client = mock.MagicMock()
+    client.get_repo.return_value.size = size
+    with mock.patch("jobs.pull.github.github_client", return_value=client), mock.patch(
+        "jobs.pull.github.subpath_blobs", return_value=blobs
+    ), mock.patch("jobs.pull.github.pull_blobs") as blobs_, mock.patch(
+        "jobs.pull.github.pull_git"
+    ) as git_, mock.patch(
+        "jobs.pull.github.httpx.stream"
+    ), mock.patch(
+        "jobs.pull.github.pull_zip"
+    ) as zip_:
+        pull_github(dict(repo="org/repo", subpath="sub"))
+
+    assert [blobs_.called, git_.called, zip_.called] == [
+        strategy == "blobs",
+        strategy == "git",
+        strategy == "zip",
+    ]
+
+
+def test_pull_git_token(tmp_path, repo):
+    """
+    The token is neither on the command line nor in the error of a failed clone.
+    """
+    run = subprocess.run
+    commands = []
+
+    def spy(command, **kwargs):
+        commands.append(command)
+        assert kwargs["env"]["GIT_PULL_TOKEN"] == "secret-token"
+        return run(command, **kwargs)
+
+    with mock.patch("subprocess.run", side_effect=spy), pytest.raises(
+        RuntimeError
+    ) as exc:
+        pull_git("org/missing", "sub", str(tmp_path / "dest"), token="secret-token")
+
+    assert "secret-token" not in str(exc.value)
+    assert all("secret-token" not in " ".join(command) for command in commands)
@@ -9,6 +9,8 @@ from oauth2client.client import GoogleCredentials
 from util.files import Files, ensure_parent, file_info
 from util.gapis import gsheets_service
 
+from .gdoc import drive_version
+
 
 def pull_gsheet(
     source: dict, path: Optional[str] = None, secrets: dict = {}, **kwargs
@@ -35,3 +37,13 @@ def pull_gsheet(
         file.write(json.dumps(gsheet, indent=2).encode("utf-8"))
 
     return {path: file_info(path, mimetype="application/vnd.google-apps.spreadsheet")}
+
+
+def revision_gsheet(source: dict, secrets: dict = {}, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of a Google Sheet (its version number in Google Drive).
+    """
+    doc_id = source.get("doc_id")
+    assert doc_id, "A Google Sheet id is required"
+
+    return drive_version(secrets, doc_id)
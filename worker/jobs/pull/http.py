@@ -1,48 +1,192 @@
+import fcntl
+import hashlib
+import json
+import logging
 import mimetypes
 import os
 import shutil
-from typing import Optional
+import tempfile
+from typing import Dict, Optional, Tuple
 
 import httpx
 
 from util.files import Files, ensure_parent, file_ext, file_info, remove_if_dir
+from util.http import (
+    HTTP_CHUNK_SIZE,
+    HTTP_PULL_RETRIES,
+    content_range_start,
+    get_http_client,
+    get_http_session,
+    resume_validator,
+)
+
+logger = logging.getLogger(__name__)
 
 GIGABYTE = 1073741824.0
 MAX_SIZE = 1  # Maximum file size in Gigabytes
 
+# Directory on the worker's local disk to keep partial downloads in so that
+# they can be resumed (including by a later job, if a job is interrupted)
+HTTP_PARTIALS_ROOT = os.getenv(
+    "HTTP_PARTIALS_ROOT", os.path.join(tempfile.gettempdir(), "http-partials")
+)
+
 
 def pull_http(
-    source: dict, path: Optional[str] = None, secrets: dict = {}, **kwargs
+    source: dict,
+    path: Optional[str] = None,
+    secrets: dict = {},
+    revision: Optional[str] = None,
+    files: Optional[Files] = None,
+    **kwargs,
 ) -> Files:
     """
     Pull a file from a HTTP source.
+
+    If the `revision` and `files` of the last pull are provided (i.e. the file
+    is still on disk, unchanged) then a conditional request is made and the file is
+    only downloaded if it has changed since. Downloads are resumed, using `Range`
+    requests, if they are interrupted. The content is requested without any
+    encoding (e.g. gzip) so that the size of a partial download is the offset
+    in the resource to resume from. If a range request fails, the partial
+    download is discarded and the file downloaded again from the start.
     """
     url = source.get("url")
     assert url, "Source must have a URL"
 
-    with httpx.stream("GET", url) as response:
-        if response.status_code != 200:
-            raise RuntimeError(f"Error when fetching {url}: {response.status_code}")
-
-        size = int(response.headers.get("Content-Length", 0)) / GIGABYTE
-        if size > MAX_SIZE:
-            RuntimeError(f"Size of file is greater than {MAX_SIZE}GB maximum: {size}GB")
-
-        if not path:
-            path = str(os.path.basename(url))
-        if not file_ext(path):
-            content_type = response.headers.get("Content-Type", "text/html").split(";")[
-                0
-            ]
-            ext = mimetypes.guess_extension(content_type, strict=False)
-            path += ext or ".txt"
+    headers = conditional_headers(revision) if files else {}
+
+    partial = partial_path(url)
+    os.makedirs(HTTP_PARTIALS_ROOT, exist_ok=True)
+    with open(partial + ".lock", "w") as lock:
+        # Prevent other processes from writing to the same partial download
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        attempt = 0
+        while True:
+            request_headers = dict(headers, **{"Accept-Encoding": "identity"})
+            offset, validator = partial_state(partial)
+            if offset and validator:
+                request_headers.update(
+                    {"Range": f"bytes={offset}-", "If-Range": validator}
+                )
+
+            try:
+                with get_http_client().stream(
+                    "GET", url, headers=request_headers
+                ) as response:
+                    if response.status_code == 304 and files:
+                        return dict(files)
+
+                    if response.status_code == 206 and offset:
+                        if content_range_start(response.headers) != offset:
+                            # Not resumed from the end of the partial download
+                            # so discard it and start again
+                            remove_partial(partial)
+                            continue
+                        mode = "ab"
+                    elif response.status_code == 200:
+                        mode, offset = "wb", 0
+                    elif "Range" in request_headers:
+                        # The range request failed (e.g. a `416` because a previous
+                        # job was interrupted after the download was complete but
+                        # before it was moved) so discard it and start again
+                        remove_partial(partial)
+                        continue
+                    else:
+                        raise RuntimeError(
+                            f"Error when fetching {url}: {response.status_code}"
+                        )
+
+                    size = (
+                        offset + int(response.headers.get("Content-Length", 0))
+                    ) / GIGABYTE
+                    if size > MAX_SIZE:
+                        raise RuntimeError(
+                            f"Size of file is greater than {MAX_SIZE}GB maximum: {size}GB"
+                        )
+
+                    if not path:
+                        path = str(os.path.basename(url))
+                    if not file_ext(path):
+                        content_type = response.headers.get(
+                            "Content-Type", "text/html"
+                        ).split(";")[0]
+                        ext = mimetypes.guess_extension(content_type, strict=False)
+                        path += ext or ".txt"
+
+                    with open(partial + ".json", "w") as info:
+                        json.dump(
+                            dict(validator=resume_validator(response.headers)), info
+                        )
+                    with open(partial, mode) as file:
+                        for data in response.iter_bytes(HTTP_CHUNK_SIZE):
+                            file.write(data)
+                break
+            except httpx.TransportError as exc:
+                if attempt >= HTTP_PULL_RETRIES:
+                    raise
+                attempt += 1
+                logger.warning(f"Resuming interrupted download of {url}: {exc}")
+
+        assert path
         ensure_parent(path)
         remove_if_dir(path)
+        shutil.move(partial, path)
+        os.remove(partial + ".json")
+
+    return {path: file_info(path)}
+
+
+def conditional_headers(revision: Optional[str]) -> Dict[str, str]:
+    """
+    Get the headers for a conditional request given the revision of the last pull.
+
+    The revision is the final URL and validator from `HttpSession.fetch_revision`.
+    """
+    if not revision or " " not in revision:
+        return {}
+    tag = revision.split(" ", 1)[1]
+    if tag.startswith('"') or tag.startswith("W/"):
+        return {"If-None-Match": tag}
+    return {"If-Modified-Since": tag}
+
+
+def partial_path(url: str) -> str:
+    """
+    Get the path to keep a partial download of a URL at.
+    """
+    return os.path.join(HTTP_PARTIALS_ROOT, hashlib.sha256(url.encode()).hexdigest())
+
+
+def partial_state(partial: str) -> Tuple[int, Optional[str]]:
+    """
+    Get the size of a partial download and the validator to use to resume it.
+    """
+    try:
+        size = os.path.getsize(partial)
+        with open(partial + ".json") as file:
+            validator = json.load(file).get("validator")
+    except (OSError, ValueError):
+        return 0, None
+    return size, validator
+
 
-        with open(path, "wb") as file:
-            for data in response.iter_bytes():
-                file.write(data)
+def remove_partial(partial: str) -> None:
+    """
+    Remove a partial download and the validator used to resume it.
+    """
+    for path in (partial, partial + ".json"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
-        return {path: file_info(path)}
 
-    return {}
+def revision_http(source: dict, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of a HTTP source (its `ETag` or `Last-Modified` header).
+    """
+    url = source.get("url")
+    assert url, "Source must have a URL"
+    return get_http_session().fetch_revision(url)
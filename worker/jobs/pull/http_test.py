@@ -1,12 +1,15 @@
+import os
 from contextlib import ContextDecorator
 from unittest import mock
 
 import httpx
 import pytest
 
+from util.http import HTTP_CHUNK_SIZE
 from util.working_directory import working_directory
 
-from .http import pull_http
+from . import http
+from .http import partial_path, pull_http
 
 
 class MockedHttpxStreamResponse(ContextDecorator):
@@ -28,7 +31,10 @@ class MockedHttpxStreamResponse(ContextDecorator):
 
 
 @pytest.mark.vcr
-@mock.patch("httpx.stream", MockedHttpxStreamResponse)
+@mock.patch(
+    "jobs.pull.http.get_http_client",
+    lambda: mock.Mock(stream=MockedHttpxStreamResponse),
+)
 def test_extension_from_mimetype(tempdir):
     with working_directory(tempdir.path):
         files = pull_http({"url": "https://httpbin.org/get"})
@@ -51,3 +57,174 @@ def test_status_codes(tempdir):
     assert "Error when fetching https://httpbin.org/status/404: 404" in str(
         excinfo.value
     )
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """
+    Use a mock transport for the HTTP client.
+
+    Set `client.handler` to a function that returns a response for each request
+    (the requests are recorded in `client.requests`).
+    """
+    monkeypatch.setattr(http, "HTTP_PARTIALS_ROOT", str(tmp_path / "partials"))
+
+    client = mock.Mock(requests=[])
+
+    def handle(request):
+        client.requests.append(request)
+        return client.handler(request)
+
+    monkeypatch.setattr(
+        http,
+        "get_http_client",
+        lambda: httpx.Client(transport=httpx.MockTransport(handle)),
+    )
+    return client
+
+
+def test_conditional(tempdir, client):
+    url = "https://example.org/a.txt"
+    client.handler = lambda request: (
+        httpx.Response(304)
+        if request.headers.get("If-None-Match") == '"1"'
+        else httpx.Response(200, content=b"a", headers={"ETag": '"2"'})
+    )
+    with working_directory(tempdir.path):
+        files = pull_http({"url": url})
+        assert list(files.keys()) == ["a.txt"]
+        assert "If-None-Match" not in client.requests[0].headers
+
+        # Not modified so the previous files are returned
+        previous = {"a.txt": {"fingerprint": "x"}}
+        assert (
+            pull_http({"url": url}, revision=f'{url} "1"', files=previous) == previous
+        )
+        assert client.requests[1].headers["If-None-Match"] == '"1"'
+
+        # Modified, so downloaded
+        files = pull_http({"url": url}, revision=f'{url} "0"', files=previous)
+        assert files["a.txt"]["size"] == 1
+
+        # Last-Modified validators use If-Modified-Since
+        pull_http(
+            {"url": url},
+            revision=f"{url} Wed, 21 Oct 2015 07:28:00 GMT",
+            files=previous,
+        )
+        assert (
+            client.requests[3].headers["If-Modified-Since"]
+            == "Wed, 21 Oct 2015 07:28:00 GMT"
+        )
+
+
+def test_resume(tempdir, client):
+    url = "https://example.org/a.txt"
+    content = bytes(range(256)) * 1024
+    split = 2 * HTTP_CHUNK_SIZE
+
+    def interrupted():
+        yield content[:split]
+        raise httpx.ReadError("Connection reset")
+
+    def handler(request):
+        range = request.headers.get("Range")
+        if range:
+            assert range == f"bytes={split}-"
+            assert request.headers["If-Range"] == '"1"'
+            return httpx.Response(
+                206,
+                content=content[split:],
+                headers={
+                    "ETag": '"1"',
+                    "Content-Range": f"bytes {split}-{len(content) - 1}/{len(content)}",
+                },
+            )
+        return httpx.Response(200, content=interrupted(), headers={"ETag": '"1"'})
+
+    client.handler = handler
+    with working_directory(tempdir.path):
+        files = pull_http({"url": url})
+        assert open("a.txt", "rb").read() == content
+        assert files["a.txt"]["size"] == len(content)
+        assert len(client.requests) == 2
+        assert not os.path.exists(partial_path(url))
+
+
+def test_resume_changed(tempdir, client):
+    url = "https://example.org/a.txt"
+
+    # A partial download from a previous, interrupted, job
+    os.makedirs(http.HTTP_PARTIALS_ROOT)
+    with open(partial_path(url), "wb") as file:
+        file.write(b"old")
+    with open(partial_path(url) + ".json", "w") as file:
+        file.write('{"validator": "\\"1\\""}')
+
+    # The file has changed so the server ignores the range
+    client.handler = lambda request: httpx.Response(
+        200, content=b"new content", headers={"ETag": '"2"'}
+    )
+    with working_directory(tempdir.path):
+        pull_http({"url": url})
+        assert client.requests[0].headers["Range"] == "bytes=3-"
+        assert open("a.txt", "rb").read() == b"new content"
+
+
+def test_resume_mismatched_range(tempdir, client):
+    url = "https://example.org/a.txt"
+
+    # A partial download from a previous, interrupted, job
+    os.makedirs(http.HTTP_PARTIALS_ROOT)
+    with open(partial_path(url), "wb") as file:
+        file.write(b"con")
+    with open(partial_path(url) + ".json", "w") as file:
+        file.write('{"validator": "\\"1\\""}')
+
+    # The server responds with a different range than was requested
+    # so the download is restarted without a range
+    def handler(request):
+        assert request.headers["Accept-Encoding"] == "identity"
+        if request.headers.get("Range"):
+            return httpx.Response(
+                206,
+                content=b"ontent",
+                headers={"ETag": '"1"', "Content-Range": "bytes 1-6/7"},
+            )
+        return httpx.Response(200, content=b"content", headers={"ETag": '"1"'})
+
+    client.handler = handler
+    with working_directory(tempdir.path):
+        pull_http({"url": url})
+        assert len(client.requests) == 2
+        assert "Range" not in client.requests[1].headers
+        assert open("a.txt", "rb").read() == b"content"
+
+
+def test_resume_complete(tempdir, client):
+    url = "https://example.org/a.txt"
+
+    # A complete download from a previous job that was interrupted before it was moved
+    os.makedirs(http.HTTP_PARTIALS_ROOT)
+    with open(partial_path(url), "wb") as file:
+        file.write(b"content")
+    with open(partial_path(url) + ".json", "w") as file:
+        file.write('{"validator": "\\"1\\""}')
+
+    # The range is not satisfiable so the download is restarted without a range
+    client.handler = lambda request: (
+        httpx.Response(416, headers={"Content-Range": "bytes */7"})
+        if request.headers.get("Range")
+        else httpx.Response(200, content=b"content", headers={"ETag": '"1"'})
+    )
+    with working_directory(tempdir.path):
+        pull_http({"url": url})
+        assert len(client.requests) == 2
+        assert "Range" not in client.requests[1].headers
+        assert open("a.txt", "rb").read() == b"content"
+        assert not os.path.exists(partial_path(url) + ".json")
+
+    # Other errors are still raised
+    client.handler = lambda request: httpx.Response(404)
+    with working_directory(tempdir.path), pytest.raises(RuntimeError, match="404"):
+        pull_http({"url": url})
@@ -3,12 +3,12 @@ import os
 import re
 import shutil
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from lxml import etree
 
 from util.files import Files, ensure_dir, file_info
-from util.http import HttpSession
+from util.http import get_http_session
 
 
 def pull_plos(source: dict, path: Optional[str] = None, **kwargs) -> Files:
@@ -21,29 +21,16 @@ def pull_plos(source: dict, path: Optional[str] = None, **kwargs) -> Files:
     doi = source.get("article")
     assert doi, "PLOS source must have an article DOI"
 
-    match = re.match(r"^10\.1371\/journal\.([a-z]+)\.(\d+)$", doi or "")
-    assert match is not None, "unknown PLOS article format"
-
-    journals = dict(
-        pbio="plosbiology",
-        pcbi="ploscompbiol",
-        pgen="plosgenetics",
-        pmed="plosmedicine",
-        pntd="plosntds",
-        pone="plosone",
-        ppat="plospathogens",
-    )
-    journal = journals.get(match.group(1))
-    assert journal, "unknown PLOS journal: {}".format(match.group(1))
+    journal, number = plos_journal(doi)
 
     if not path:
-        path = f"{journal}-{match.group(2)}.xml"
+        path = f"{journal}-{number}.xml"
 
     folder, file = os.path.split(path)
     ensure_dir(folder)
 
     files = {}
-    session = HttpSession()
+    session = get_http_session()
 
     # Get the article JATS XML
     response = session.fetch_url(
@@ -84,3 +71,36 @@ def pull_plos(source: dict, path: Optional[str] = None, **kwargs) -> Files:
     files[path] = file_info(path, mimetype="application/jats+xml")
 
     return files
+
+
+def plos_journal(doi: str) -> Tuple[str, str]:
+    """
+    Get the name of the journal, and the article number, from a PLOS article DOI.
+    """
+    match = re.match(r"^10\.1371\/journal\.([a-z]+)\.(\d+)$", doi or "")
+    assert match is not None, "unknown PLOS article format"
+
+    journals = dict(
+        pbio="plosbiology",
+        pcbi="ploscompbiol",
+        pgen="plosgenetics",
+        pmed="plosmedicine",
+        pntd="plosntds",
+        pone="plosone",
+        ppat="plospathogens",
+    )
+    journal = journals.get(match.group(1))
+    assert journal, "unknown PLOS journal: {}".format(match.group(1))
+    return journal, match.group(2)
+
+
+def revision_plos(source: dict, **kwargs) -> Optional[str]:
+    """
+    Get the current revision of a PLOS article (from its XML's HTTP headers).
+    """
+    doi = source.get("article")
+    assert doi, "PLOS source must have an article DOI"
+    journal, number = plos_journal(doi)
+    return get_http_session().fetch_revision(
+        f"https://journals.plos.org/{journal}/article/file?id={doi}&type=manuscript"
+    )
@@ -3,7 +3,7 @@ import shutil
 from typing import Optional
 
 from util.files import Files, ensure_parent, list_files, move_files, temp_dir
-from util.http import HttpSession
+from util.http import get_http_session
 
 
 def pull_upload(source: dict, path: Optional[str] = None, **kwargs) -> Files:
@@ -28,7 +28,7 @@ def pull_upload(source: dict, path: Optional[str] = None, **kwargs) -> Files:
     if "path" in source:
         shutil.copyfile(source["path"], dest_path)
     elif "url" in source:
-        HttpSession().pull(source["url"], dest_path)
+        get_http_session().pull(source["url"], dest_path)
     else:
         raise ValueError("Upload source must have a `path` or a `url`.")
 
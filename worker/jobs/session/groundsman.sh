@@ -1,15 +1,160 @@
 #!/bin/sh
 
-# If a snapshot directory does not exist in the `/snapshots`
-# folder then fetch it and unzip it.
-# Uses `flock` to avoid race condition.
+# If a snapshot directory does not exist in the node's snapshot cache
+# (the `/snapshots` folder) then fetch it and unzip it.
+#
+# Usage: groundsman.sh SNAPSHOT_ID SNAPSHOT_URL SNAPSHOT_FINGERPRINT [BLOBS_URL]
+#
+# The file at `SNAPSHOT_URL` (the zip archive, or manifest) is verified against
+# its SHA256 `SNAPSHOT_FINGERPRINT` (`-` if it is not known, e.g. for snapshots
+# created before fingerprints were recorded).
+#
+# If a `BLOBS_URL` is supplied, then the `SNAPSHOT_URL` is the URL of the
+# snapshot's manifest (a JSON object mapping each file path to its fingerprint)
+# and the snapshot directory is materialized by fetching each file from
+# the content-addressed blob store at `$BLOBS_URL<fingerprint[:2]>/<fingerprint>`.
+#
+# Fetches are single-flight: a per-snapshot `flock` means that when several pods
+# on the same node need the same snapshot, it is fetched once and the others wait for it.
+# Snapshots are fetched into a temporary directory, verified (the zip archive or manifest,
+# and files fetched from the blob store, against their SHA256 fingerprint), and only
+# then moved into place so that a partial or corrupt snapshot is never used.
+#
+# The modification time of each snapshot directory records when it was last used.
+# After a fetch, the least recently used snapshots are evicted until the cache
+# is within `SNAPSHOT_CACHE_SIZE` megabytes and the filesystem is less than
+# `SNAPSHOT_CACHE_USAGE` percent full. Snapshots used within the last
+# `SNAPSHOT_CACHE_MIN_AGE` seconds are never evicted because they may
+# be mounted by a running session (so this should be longer than the maximum
+# session time limit).
+#
+# Counts of hits, misses, failures, evictions and bytes fetched are kept in
+# `.metrics/groundsman.prom` (in the format read by the Prometheus node exporter's
+# textfile collector).
 
 SNAPSHOT_ID=$1
 SNAPSHOT_URL=$2
+SNAPSHOT_FINGERPRINT=$3
+BLOBS_URL=$4
 
-if [ ! -d "/snapshots/$SNAPSHOT_ID" ]; then
-    flock "/snapshots/$SNAPSHOT_ID.lock" \
-      curl -sL $SNAPSHOT_URL > "/tmp/$SNAPSHOT_ID.zip" && \
-      unzip -q -o "/tmp/$SNAPSHOT_ID.zip" -d "/snapshots/$SNAPSHOT_ID" && \
-      rm "/tmp/$SNAPSHOT_ID.zip"
+SNAPSHOT_CACHE_DIR=${SNAPSHOT_CACHE_DIR:-/snapshots}
+SNAPSHOT_CACHE_SIZE=${SNAPSHOT_CACHE_SIZE:-10240}
+SNAPSHOT_CACHE_USAGE=${SNAPSHOT_CACHE_USAGE:-80}
+SNAPSHOT_CACHE_MIN_AGE=${SNAPSHOT_CACHE_MIN_AGE:-7200}
+
+SNAPSHOT="$SNAPSHOT_CACHE_DIR/$SNAPSHOT_ID"
+TEMP="$SNAPSHOT_CACHE_DIR/.$SNAPSHOT_ID.tmp"
+METRICS="$SNAPSHOT_CACHE_DIR/.metrics/groundsman.prom"
+
+# Increment one of the counters in the metrics file
+count() {
+    mkdir -p "$SNAPSHOT_CACHE_DIR/.metrics"
+    (
+        flock 8
+        touch "$METRICS"
+        awk -v name="groundsman_snapshot_$1_total" -v value="${2:-1}" '
+            $1 == name { $2 = $2 + value; found = 1 }
+            { print }
+            END { if (!found) print name, value }
+        ' "$METRICS" > "$METRICS.tmp" && \
+          mv "$METRICS.tmp" "$METRICS"
+    ) 8>"$SNAPSHOT_CACHE_DIR/.metrics.lock"
+}
+
+# Verify a fetched file against the snapshot's fingerprint (if known)
+verify() {
+    [ "$SNAPSHOT_FINGERPRINT" = "-" ] || \
+      echo "$SNAPSHOT_FINGERPRINT  $1" | sha256sum -c - > /dev/null 2>&1
+}
+
+fetch_zip() {
+    curl -sfL "$SNAPSHOT_URL" > "$TEMP.zip" && \
+      verify "$TEMP.zip" && \
+      unzip -q -o "$TEMP.zip" -d "$TEMP" && \
+      wc -c < "$TEMP.zip" > "$TEMP.bytes"
+}
+
+fetch_blobs() {
+    curl -sfL "$SNAPSHOT_URL" > "$TEMP.json" && \
+      verify "$TEMP.json" && \
+      jq -r --arg blobs "$BLOBS_URL" '.files | to_entries[] | select(.value != null) |
+        "url = \(($blobs + .value[0:2] + "/" + .value) | @json)\noutput = \(.key | @json)"' \
+      "$TEMP.json" > "$TEMP.curl" && \
+      jq -r '.files | to_entries[] | select(.value != null) | "\(.value)  \(.key)"' \
+      "$TEMP.json" > "$TEMP.sha256" && \
+      (cd "$TEMP" && curl -sfL --no-progress-meter --parallel --create-dirs --config "$TEMP.curl" \
+        --write-out '%{size_download}\n') > "$TEMP.sizes" && \
+      (cd "$TEMP" && sha256sum -c "$TEMP.sha256" > /dev/null 2>&1) && \
+      awk '{ sum += $1 } END { print sum + 0 }' "$TEMP.sizes" > "$TEMP.bytes"
+}
+
+# Evict least recently used snapshots (only one process does this at a time)
+evict() {
+    (
+        flock -n 7 || exit 0
+        now=$(date +%s)
+        size=$(du -sm "$SNAPSHOT_CACHE_DIR" | cut -f1)
+        for name in $(ls -1tr "$SNAPSHOT_CACHE_DIR"); do
+            entry="$SNAPSHOT_CACHE_DIR/$name"
+            [ -d "$entry" ] && [ "$name" != "$SNAPSHOT_ID" ] || continue
+
+            usage=$(df -P "$SNAPSHOT_CACHE_DIR" | awk 'NR == 2 { sub("%", "", $5); print $5 }')
+            if [ "$size" -le "$SNAPSHOT_CACHE_SIZE" ] && [ "$usage" -lt "$SNAPSHOT_CACHE_USAGE" ]; then
+                break
+            fi
+            # Entries are in order of last use, so all remaining ones are more recent
+            if [ $((now - $(stat -c %Y "$entry"))) -lt "$SNAPSHOT_CACHE_MIN_AGE" ]; then
+                break
+            fi
+
+            (
+                flock -n 9 || exit 1
+                # Check again in case the snapshot was used while getting the lock
+                [ $((now - $(stat -c %Y "$entry"))) -ge "$SNAPSHOT_CACHE_MIN_AGE" ] || exit 1
+                entry_size=$(du -sm "$entry" | cut -f1)
+                rm -rf "$entry" && echo "$entry_size"
+            ) 9>"$entry.lock" > "$TEMP.evicted" && \
+              size=$((size - $(cat "$TEMP.evicted"))) && \
+              count evictions
+        done
+        rm -f "$TEMP.evicted"
+    ) 7>"$SNAPSHOT_CACHE_DIR/.evict.lock"
+}
+
+mkdir -p "$SNAPSHOT_CACHE_DIR"
+(
+    flock 9
+    if [ -d "$SNAPSHOT" ]; then
+        # Record the use of the snapshot for eviction
+        touch "$SNAPSHOT"
+        count hits
+        exit 100
+    fi
+
+    count misses
+    rm -rf "$TEMP" && mkdir -p "$TEMP"
+    if [ -z "$BLOBS_URL" ]; then
+        fetch_zip
+    else
+        fetch_blobs
+    fi
+    status=$?
+    if [ $status -eq 0 ]; then
+        count fetched_bytes "$(cat "$TEMP.bytes")"
+        mv "$TEMP" "$SNAPSHOT"
+    else
+        echo "Failed to fetch snapshot $SNAPSHOT_ID" >&2
+        count failures
+        rm -rf "$TEMP"
+    fi
+    rm -f "$TEMP.zip" "$TEMP.json" "$TEMP.curl" "$TEMP.sha256" "$TEMP.sizes" "$TEMP.bytes"
+    [ $status -eq 0 ]
+) 9>"$SNAPSHOT.lock"
+status=$?
+
+# Only evict after fetching a snapshot (status 100 is a cache hit)
+if [ $status -eq 0 ]; then
+    evict
+elif [ $status -ne 100 ]; then
+    exit 1
 fi
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import zipfile
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "groundsman.sh")
+
+pytestmark = pytest.mark.skipif(
+    not all(
+        shutil.which(tool) for tool in ("curl", "flock", "jq", "sha256sum", "unzip")
+    ),
+    reason="groundsman tools are not available",
+)
+
+
+def groundsman(cache, *args, **env):
+    return subprocess.run(
+        ["sh", SCRIPT] + list(args),
+        env=dict(os.environ, SNAPSHOT_CACHE_DIR=str(cache), **env),
+        capture_output=True,
+    )
+
+
+def metrics(cache):
+    with open(cache / ".metrics" / "groundsman.prom") as file:
+        return dict(
+            (name.replace("groundsman_snapshot_", "").replace("_total", ""), int(value))
+            for name, value in (line.split() for line in file)
+        )
+
+
+def digest(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_zip(tmp_path):
+    """
+    A zipped snapshot is fetched once and then reused.
+    """
+    archive = tmp_path / "snapshot.zip"
+    with zipfile.ZipFile(archive, "w") as zip:
+        zip.writestr("file.txt", "Hello")
+    cache = tmp_path / "cache"
+
+    args = (f"file://{archive}", digest(archive))
+    assert groundsman(cache, "a", *args).returncode == 0
+    assert (cache / "a" / "file.txt").read_text() == "Hello"
+    assert groundsman(cache, "a", *args).returncode == 0
+    assert metrics(cache) == dict(
+        misses=1, hits=1, fetched_bytes=archive.stat().st_size
+    )
+
+    # An archive that does not match its fingerprint is not used
+    with zipfile.ZipFile(archive, "w") as zip:
+        zip.writestr("file.txt", "Goodbye")
+    assert groundsman(cache, "b", *args).returncode != 0
+    assert not (cache / "b").exists()
+    assert metrics(cache)["failures"] == 1
+
+    # Without a fingerprint, a corrupt archive is still not used
+    archive.write_bytes(b"Not a zip archive")
+    assert groundsman(cache, "c", f"file://{archive}", "-").returncode != 0
+    assert not (cache / "c").exists()
+
+
+def test_blobs(tmp_path):
+    """
+    Blobs are verified against their fingerprints.
+    """
+    blobs = tmp_path / "blobs"
+    files = {}
+    for path, content in (("a.txt", b"A"), ("dir/b.txt", b"B")):
+        fingerprint = hashlib.sha256(content).hexdigest()
+        blob = blobs / fingerprint[:2] / fingerprint
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        blob.write_bytes(content)
+        files[path] = fingerprint
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(dict(files=files)))
+    cache = tmp_path / "cache"
+
+    args = (f"file://{manifest}", digest(manifest), f"file://{blobs}/")
+    assert groundsman(cache, "a", *args).returncode == 0
+    assert (cache / "a" / "dir" / "b.txt").read_bytes() == b"B"
+    assert metrics(cache)["fetched_bytes"] == 2
+
+    # A blob that does not match its fingerprint fails verification
+    (blobs / files["a.txt"][:2] / files["a.txt"]).write_bytes(b"Z")
+    assert groundsman(cache, "b", *args).returncode != 0
+    assert not (cache / "b").exists()
+
+    # As does a manifest that does not match its fingerprint
+    manifest.write_text(json.dumps(dict(files={})))
+    assert groundsman(cache, "c", *args).returncode != 0
+    assert not (cache / "c").exists()
+
+
+def test_evict(tmp_path):
+    """
+    Least recently used snapshots are evicted when the cache is too large.
+    """
+    cache = tmp_path / "cache"
+    for name, age in (("a", 300), ("b", 200), ("c", 5)):
+        (cache / name).mkdir(parents=True)
+        (cache / name / "file").write_bytes(b"x" * 1024 ** 2)
+        used = time.time() - age
+        os.utime(cache / name, (used, used))
+
+    archive = tmp_path / "snapshot.zip"
+    with zipfile.ZipFile(archive, "w") as zip:
+        zip.writestr("file.txt", "Hello")
+
+    # Cache is limited to 1MB but snapshots used in the last 100s are kept
+    assert (
+        groundsman(
+            cache,
+            "d",
+            f"file://{archive}",
+            digest(archive),
+            SNAPSHOT_CACHE_SIZE="1",
+            SNAPSHOT_CACHE_MIN_AGE="100",
+        ).returncode
+        == 0
+    )
+    assert sorted(path.name for path in cache.iterdir() if path.is_dir()) == [
+        ".metrics",
+        "c",
+        "d",
+    ]
+    assert metrics(cache)["evictions"] == 2
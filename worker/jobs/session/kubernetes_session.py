@@ -1,10 +1,14 @@
+import atexit
 import logging
 import os
 import random
 import secrets
 import subprocess
 import sys
+import threading
 import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
 
 import kubernetes
 from celery.exceptions import Ignore, SoftTimeLimitExceeded
@@ -12,6 +16,9 @@ from celery.exceptions import Ignore, SoftTimeLimitExceeded
 from config import get_snapshot_dir, get_working_dir
 from jobs.base.job import Job
 
+from .pod_pool import REQUESTED_ANNOTATION, SESSION_POOL_SIZE, PodPool, pod_ports
+from .pod_watcher import SESSION_POD_WATCH_TIMEOUT, PodWatcher
+
 # Kubernetes namespace to put job pods in
 namespace = "jobs"
 
@@ -65,6 +72,196 @@ else:
         except FileNotFoundError:
             logger.warning("Could not find Minikube. Is it installed?")
 
+watcher: Optional[PodWatcher] = None
+
+
+def get_pod_watcher() -> PodWatcher:
+    """
+    Get the session pod watcher for this worker process.
+
+    The watcher is created lazily so that each forked Celery worker
+    process gets its own watch. If watching is disabled, the watcher
+    is not started and sessions poll for the state of their pod.
+    """
+    global watcher
+    if watcher is None:
+        watcher = PodWatcher(api_instance, namespace)
+        if SESSION_POD_WATCH_TIMEOUT > 0:
+            watcher.start()
+            atexit.register(watcher.stop)
+    return watcher
+
+
+pool: Optional[PodPool] = None
+
+
+def get_pod_pool() -> Optional[PodPool]:
+    """
+    Get the pool of pre-started session pods.
+
+    Returns `None` if the pool is disabled.
+    """
+    global pool
+    if SESSION_POOL_SIZE <= 0 or api_instance is None:
+        return None
+    if pool is None:
+        pool = PodPool(api_instance, namespace)
+    return pool
+
+
+def default_resources() -> Dict[str, Any]:
+    """
+    Get the default resources and network policy for sessions.
+
+    Pre-started pods in the pool are created with these.
+    """
+    return dict(
+        # Session CPU and memory requests and limits
+        cpu_request=os.getenv(
+            "SESSION_CPU_REQUEST_DEFAULT", 0.1  # 10% of a vCPU / core
+        ),
+        cpu_limit=os.getenv("SESSION_CPU_LIMIT_DEFAULT", 1),  # 100% of a vCPU / core
+        mem_request=os.getenv("SESSION_MEM_REQUEST_DEFAULT", 600),  # 600MiB
+        mem_limit=os.getenv("SESSION_MEM_LIMIT_DEFAULT", 600),  # 600MiB
+        # Network policy applied to sessions
+        network_policy=os.getenv(
+            "SESSION_NETWORK_POLICY_DEFAULT", "jobs-network-policy-1"
+        ),
+    )
+
+
+def same_resources(requested: Dict[str, Any], pooled: Dict[str, Any]) -> bool:
+    """
+    Are the resources requested for a session the same as those of pooled pods?
+
+    Numbers are compared by value because they may be strings (e.g. from
+    environment variables) or numbers (e.g. from the project's settings).
+    """
+
+    def normalize(value: Any) -> Any:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return str(value)
+
+    return all(
+        normalize(requested.get(name)) == normalize(value)
+        for name, value in pooled.items()
+    )
+
+
+# Environment variables passed on to `groundsman.sh` to configure
+# the node's snapshot cache (see that script for details)
+GROUNDSMAN_ENV = (
+    "SNAPSHOT_CACHE_SIZE",
+    "SNAPSHOT_CACHE_USAGE",
+    "SNAPSHOT_CACHE_MIN_AGE",
+)
+
+
+def groundsman_env() -> List[Dict[str, str]]:
+    """
+    Get the environment variables for containers that run `groundsman.sh`.
+    """
+    return [
+        {"name": name, "value": os.environ[name]}
+        for name in GROUNDSMAN_ENV
+        if name in os.environ
+    ]
+
+
+def pod_ready(pod: Any) -> bool:
+    """
+    Check whether the pod's session container is running and ready.
+
+    The Python API `V1ContainerStatus` does not expose `started`
+    so we use `ready` and a `readinessProbe`.
+    """
+    return (
+        pod.status.phase == "Running"
+        and bool(pod.status.container_statuses)
+        and pod.status.container_statuses[0].ready
+    )
+
+
+def pod_stopped(pod: Any) -> bool:
+    """
+    Check whether the pod has been deleted or has finished running.
+    """
+    return pod is None or pod.status.phase in ("Succeeded", "Failed")
+
+
+# Phases of a session's start up, in order. See `startup_phases`.
+STARTUP_PHASES = (
+    "requested",
+    "created",
+    "scheduled",
+    "initialized",
+    "started",
+    "ready",
+    "published",
+)
+
+
+def startup_phases(pod: Any, requested: float, published: float) -> Dict[str, float]:
+    """
+    Get the times at which a session passed through each phase of its start up.
+
+    The phases are when the session was `requested`, its pod was `created`
+    and `scheduled` on a node, its init containers finished (`initialized`, which
+    includes fetching the snapshot), the session container `started` (i.e. the
+    image was pulled), the readiness probe passed (`ready`) and the session's
+    URLs were `published`. These are taken from the pod's metadata, conditions and
+    container statuses (which only have a resolution of one second).
+
+    Returns a dictionary of Unix timestamps. Phases that the pod has no time for
+    are omitted. For pods claimed from the pool, phases that happened before the
+    request are given the time of the request.
+    """
+    conditions = dict(
+        (condition.type, condition.last_transition_time)
+        for condition in pod.status.conditions or []
+        if condition.status == "True"
+    )
+    started = None
+    for status in pod.status.container_statuses or []:
+        if status.name == "session" and status.state and status.state.running:
+            started = status.state.running.started_at
+    times = dict(
+        requested=requested,
+        created=pod.metadata.creation_timestamp,
+        scheduled=conditions.get("PodScheduled"),
+        initialized=conditions.get("Initialized"),
+        started=started,
+        ready=conditions.get("Ready"),
+        published=published,
+    )
+
+    phases: Dict[str, float] = {}
+    for phase in STARTUP_PHASES:
+        timestamp = times[phase]
+        if timestamp is None:
+            continue
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        phases[phase] = max(timestamp, requested)
+    return phases
+
+
+def phase_durations(phases: Dict[str, float]) -> Dict[str, float]:
+    """
+    Get the seconds spent getting to each phase from the previous one.
+    """
+    durations: Dict[str, float] = {}
+    previous = None
+    for phase in STARTUP_PHASES:
+        if phase not in phases:
+            continue
+        if previous is not None:
+            durations[phase] = round(max(phases[phase] - previous, 0), 3)
+        previous = phases[phase]
+    return durations
+
 
 class KubernetesSession(Job):
     """
@@ -96,6 +293,14 @@ class KubernetesSession(Job):
             snapshot and not snapshot_url
         ), "A snapshot_url is required for snapshots"
 
+        # SHA256 fingerprint of the file at `snapshot_url` (if known) used
+        # to verify it when it is fetched
+        snapshot_fingerprint = kwargs.get("snapshot_fingerprint") or "-"
+
+        # URL of the blob store (if the snapshot is in the `blobs` format,
+        # in which case `snapshot_url` is the URL of the snapshot's manifest)
+        blobs_url = kwargs.get("blobs_url")
+
         # Key to control access to the session
         key = kwargs.get("key")
         assert key is not None, "A job key is required for a session"
@@ -118,29 +323,171 @@ class KubernetesSession(Job):
             "SESSION_NODE_POOL_DEFAULT", "sessions"
         )
 
-        # Session CPU and memory requests and limits
-        cpu_request = kwargs.get("cpu_request") or os.getenv(
-            "SESSION_CPU_REQUEST_DEFAULT", 0.1  # 10% of a vCPU / core
+        # Session CPU and memory requests and limits, and network policy
+        defaults = default_resources()
+        resources = dict(
+            (name, kwargs.get(name) or default) for name, default in defaults.items()
         )
-        cpu_limit = kwargs.get("cpu_limit") or os.getenv(
-            "SESSION_CPU_LIMIT_DEFAULT", 1  # 100% of a vCPU / core
+        cpu_request = resources["cpu_request"]
+        cpu_limit = resources["cpu_limit"]
+        mem_request = resources["mem_request"]
+        mem_limit = resources["mem_limit"]
+        network_policy = resources["network_policy"]
+
+        # Update the job with a custom state to indicate
+        # that we are waiting for the pod to start.
+        self.notify(state="LAUNCHING")
+
+        # Sessions for snapshots which use the same resources and network
+        # policy as pre-started pods can be started by claiming one from the pool
+        # (projects often pass the defaults explicitly, so values are compared)
+        requested = time.time()
+        pod_pool = (
+            get_pod_pool() if snapshot and same_resources(resources, defaults) else None
         )
-        mem_request = kwargs.get("mem_request") or os.getenv(
-            "SESSION_MEM_REQUEST_DEFAULT", 600  # 600MiB
+        pool_key = PodPool.key(container_image, node_pool) if pod_pool else None
+
+        def cold_start():
+            return self.create(
+                project,
+                snapshot,
+                snapshot_url,
+                snapshot_fingerprint,
+                blobs_url,
+                key,
+                container_image,
+                timeout,
+                timelimit,
+                node_pool,
+                cpu_request,
+                cpu_limit,
+                mem_request,
+                mem_limit,
+                network_policy,
+                pool_key,
+            )
+
+        ports = (
+            self.claim(
+                pod_pool,
+                pool_key,
+                key,
+                timeout,
+                timelimit,
+                snapshot,
+                snapshot_url,
+                snapshot_fingerprint,
+                blobs_url,
+            )
+            if pod_pool
+            else None
         )
-        mem_limit = kwargs.get("mem_limit") or os.getenv(
-            "SESSION_MEM_LIMIT_DEFAULT", 600  # 600MiB
+        method = "claimed" if ports else "cold"
+        if ports is None:
+            ports = cold_start()
+        if pod_pool:
+            # Top up the pool in the background, rather than delaying the session
+            threading.Thread(
+                target=pod_pool.replenish,
+                args=(pool_key,),
+                kwargs=dict(
+                    container_image=container_image,
+                    node_pool=node_pool,
+                    env=groundsman_env(),
+                    **defaults,
+                ),
+                daemon=True,
+            ).start()
+
+        # Wait for pod to be ready so that we can get its IP address
+        self.logger.debug("Waiting for pod")
+        pod = get_pod_watcher().wait(
+            self.pod_name, lambda pod: pod_stopped(pod) or pod_ready(pod), 0.25
         )
+        if pod_stopped(pod) and method == "claimed":
+            # The claimed pod failed to start the session (e.g. its snapshot
+            # could not be fetched) so fall back to cold starting a pod
+            self.logger.warning("Claimed pod stopped before it was ready")
+            pod_pool.delete(self.pod_name)
+            get_pod_watcher().forget(self.pod_name)
+            method = "cold"
+            ports = cold_start()
+            pod = get_pod_watcher().wait(
+                self.pod_name, lambda pod: pod_stopped(pod) or pod_ready(pod), 0.25
+            )
+        if pod_stopped(pod):
+            self.completed()
+            raise RuntimeError("Session pod stopped before it was ready")
+        ip = pod.status.pod_ip
 
-        # Network policy applied to sessions
-        network_policy = kwargs.get("network_policy") or os.getenv(
-            "SESSION_NETWORK_POLICY_DEFAULT", "jobs-network-policy-1"
+        # Update the job state with the internal URLs of the pod
+        urls = dict(
+            (protocol, f"{protocol}://{ip}:{port}") for protocol, port in ports.items()
+        )
+        phases = startup_phases(pod, requested, time.time())
+        seconds = phases["published"] - requested
+        startup = dict(
+            method=method,
+            container_image=container_image,
+            node_pool=node_pool,
+            seconds=round(seconds, 3),
+            phases=dict(
+                (phase, datetime.fromtimestamp(timestamp, timezone.utc).isoformat())
+                for phase, timestamp in phases.items()
+            ),
+            durations=phase_durations(phases),
         )
+        self.notify(state="RUNNING", urls=urls, session_start=startup)
+        if pod_pool:
+            pod_pool.observe(method, seconds)
 
-        # Update the job with a custom state to indicate
-        # that we are waiting for the pod to start.
-        self.notify(state="LAUNCHING")
+        self.logger.debug("Started pod")
 
+        # The start up phases are included in the result of the job
+        result = dict(startup=startup)
+        try:
+            self.poll()
+        except (SoftTimeLimitExceeded, KeyboardInterrupt):
+            self.terminated()
+            return result
+        except kubernetes.client.rest.ApiException as exc:
+            # Log the exception if it is not an expected
+            # SoftTimeLimitExceeded exception (used for cancelling
+            # / terminating jobs)
+            if "SoftTimeLimitExceeded" not in exc.reason:
+                logger.exception(exc)
+            # Always terminate the pod if there has been an exception
+            self.terminated()
+            return result
+
+        self.logger.info("Pod finished")
+        self.completed()
+        return result
+
+    def create(
+        self,
+        project,
+        snapshot,
+        snapshot_url,
+        snapshot_fingerprint,
+        blobs_url,
+        key,
+        container_image,
+        timeout,
+        timelimit,
+        node_pool,
+        cpu_request,
+        cpu_limit,
+        mem_request,
+        mem_limit,
+        network_policy,
+        pool_key,
+    ):
+        """
+        Create a pod for the session.
+
+        Returns the ports that the session will listen on.
+        """
         # Create a session name which we can use to terminate the pod
         # (use `pod_name` to avoid clash with `Job.name`)
         self.pod_name = "session-" + (self.task_id or secrets.token_hex(16))
@@ -184,7 +531,14 @@ class KubernetesSession(Job):
                     "image": "stencila/hub-groundsman",
                     "imagePullPolicy": "IfNotPresent",
                     "command": ["sh"],
-                    "args": ["groundsman.sh", snapshot, snapshot_url],
+                    "args": [
+                        "groundsman.sh",
+                        snapshot,
+                        snapshot_url,
+                        snapshot_fingerprint,
+                    ]
+                    + ([blobs_url] if blobs_url else []),
+                    "env": groundsman_env(),
                     "volumeMounts": [{"name": "snapshots", "mountPath": "/snapshots"}],
                 }
             ]
@@ -333,6 +687,11 @@ class KubernetesSession(Job):
             },
         }
 
+        if pool_key:
+            # Record the request so that it is counted when sizing the pool
+            pod["metadata"]["labels"].update(pool=pool_key, state="cold")
+            pod["metadata"]["annotations"] = {REQUESTED_ANNOTATION: str(time.time())}
+
         # Try to create the pod, but it it already exists then ignore
         # the job (do not record any state from here but remove it from the queue).
         # See https://docs.celeryproject.org/en/latest/userguide/tasks.html#ignore
@@ -347,50 +706,52 @@ class KubernetesSession(Job):
             else:
                 raise exc
 
-        # Wait for pod to be ready so that we can get its IP address
-        self.logger.debug("Waiting for pod")
-        while True:
-            pod = api_instance.read_namespaced_pod(
-                name=self.pod_name, namespace=namespace
-            )
-            # Check readiness of the container
-            # The Python API `V1ContainerStatus` does not expose `started`
-            # so we use `ready` and a `readinessProbe` (above).
-            phase = pod.status.phase
-            ready = (
-                pod.status.container_statuses
-                and len(pod.status.container_statuses)
-                and pod.status.container_statuses[0].ready
-                or False
-            )
-            if phase == "Running" and ready:
-                break
-            time.sleep(0.25)
-        ip = pod.status.pod_ip
-
-        # Update the job state with the internal URLs of the pod
-        urls = dict(
-            (protocol, f"{protocol}://{ip}:{port}") for protocol, port in ports.items()
-        )
-        self.notify(state="RUNNING", urls=urls)
-
-        self.logger.debug("Started pod")
+        return ports
+
+    def claim(
+        self,
+        pool,
+        pool_key,
+        key,
+        timeout,
+        timelimit,
+        snapshot,
+        snapshot_url,
+        snapshot_fingerprint,
+        blobs_url,
+    ):
+        """
+        Claim a pre-started pod from the pool for the session.
 
+        Returns the ports that the session will listen on, or `None`
+        if no pod could be claimed (in which case the caller should
+        create one).
+        """
         try:
-            self.poll()
-        except (SoftTimeLimitExceeded, KeyboardInterrupt):
-            return self.terminated()
+            pod = pool.claim(pool_key)
         except kubernetes.client.rest.ApiException as exc:
-            # Log the exception if it is not an expected
-            # SoftTimeLimitExceeded exception (used for cancelling
-            # / terminating jobs)
-            if "SoftTimeLimitExceeded" not in exc.reason:
-                logger.exception(exc)
-            # Always terminate the pod if there has been an exception
-            return self.terminated()
+            logger.warning(f"Unable to claim pod from pool: {exc}")
+            return None
+        if pod is None:
+            return None
 
-        self.logger.info("Pod finished")
-        return self.completed()
+        self.pod_name = pod.metadata.name
+        self.logger = logging.LoggerAdapter(logger, {"pod_name": self.pod_name})
+        try:
+            self.logger.debug("Binding pod")
+            pool.bind(
+                self.pod_name,
+                f"--key={key} --timeout={timeout} --timelimit={timelimit}",
+                snapshot,
+                snapshot_url,
+                snapshot_fingerprint,
+                blobs_url,
+            )
+        except Exception as exc:
+            self.logger.warning(f"Unable to bind pod: {exc}")
+            self.terminated()
+            return None
+        return pod_ports(pod)
 
     def attach(self):
         """
@@ -418,15 +779,11 @@ class KubernetesSession(Job):
 
     def poll(self):
         """
-        Poll the session until it stops running.
+        Wait for the session to stop running.
         """
-        while True:
-            pod = api_instance.read_namespaced_pod(
-                name=self.pod_name, namespace=namespace
-            )
-            if pod.status.phase != "Running":
-                return
-            time.sleep(3)
+        get_pod_watcher().wait(
+            self.pod_name, lambda pod: pod is None or pod.status.phase != "Running", 3
+        )
 
     def terminated(self):
         """
@@ -435,6 +792,7 @@ class KubernetesSession(Job):
         if self.pod_name:
             self.logger.info("Terminating pod")
             api_instance.delete_namespaced_pod(name=self.pod_name, namespace=namespace)
+            get_pod_watcher().forget(self.pod_name)
             self.pod_name = None
 
     def completed(self):
@@ -447,6 +805,7 @@ class KubernetesSession(Job):
         if self.pod_name:
             self.logger.info("Deleting pod")
             api_instance.delete_namespaced_pod(name=self.pod_name, namespace=namespace)
+            get_pod_watcher().forget(self.pod_name)
             self.pod_name = None
 
 
@@ -470,7 +829,19 @@ if __name__ == "__main__":
         "--snapshot-url",
         default=None,
         type=str,
-        help="The URL of the snapshot zip archive (if any)",
+        help="The URL of the snapshot zip archive, or manifest (if any)",
+    )
+    parser.add_argument(
+        "--snapshot-fingerprint",
+        default=None,
+        type=str,
+        help="The SHA256 fingerprint of the snapshot zip archive, or manifest (if known)",
+    )
+    parser.add_argument(
+        "--blobs-url",
+        default=None,
+        type=str,
+        help="The URL of the blob store (if the snapshot is in the blobs format)",
     )
     parser.add_argument(
         "--timeout",
@@ -496,6 +867,8 @@ if __name__ == "__main__":
         project=args.project,
         snapshot=args.snapshot,
         snapshot_url=args.snapshot_url,
+        snapshot_fingerprint=args.snapshot_fingerprint,
+        blobs_url=args.blobs_url,
         key=secrets.token_urlsafe(8),
         timeout=args.timeout,
         timelimit=args.timelimit,
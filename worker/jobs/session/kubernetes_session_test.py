@@ -1,7 +1,17 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
 import pytest
 from celery.exceptions import SoftTimeLimitExceeded
 
-from .kubernetes_session import KubernetesSession, api_instance
+from .kubernetes_session import (
+    KubernetesSession,
+    api_instance,
+    default_resources,
+    phase_durations,
+    same_resources,
+    startup_phases,
+)
 
 
 @pytest.mark.skipif(api_instance is None, reason="can only run if K8s is available")
@@ -29,3 +39,91 @@ def test_k8s_session():
     assert session.name is None
     session.do(key="some-job-key")
     assert session.name is None
+
+
+def test_startup_phases():
+    """
+    Test getting start up phases from the pod's status.
+    """
+
+    def at(seconds):
+        return datetime.fromtimestamp(1000 + seconds, timezone.utc)
+
+    def condition(type, seconds, status="True"):
+        return SimpleNamespace(
+            type=type, status=status, last_transition_time=at(seconds)
+        )
+
+    pod = SimpleNamespace(
+        metadata=SimpleNamespace(creation_timestamp=at(1)),
+        status=SimpleNamespace(
+            conditions=[
+                condition("PodScheduled", 2),
+                condition("Initialized", 12),
+                condition("ContainersReady", 20),
+                condition("Ready", 20),
+            ],
+            container_statuses=[
+                SimpleNamespace(
+                    name="sidecar",
+                    state=SimpleNamespace(running=SimpleNamespace(started_at=at(13))),
+                ),
+                SimpleNamespace(
+                    name="session",
+                    state=SimpleNamespace(running=SimpleNamespace(started_at=at(17))),
+                ),
+            ],
+        ),
+    )
+
+    phases = startup_phases(pod, 1000.5, 1020.25)
+    assert phases == dict(
+        requested=1000.5,
+        created=1001,
+        scheduled=1002,
+        initialized=1012,
+        started=1017,
+        ready=1020,
+        published=1020.25,
+    )
+    assert phase_durations(phases) == dict(
+        created=0.5, scheduled=1, initialized=10, started=5, ready=3, published=0.25
+    )
+
+    # Pod claimed from the pool at 1015 so earlier phases are at the time of the request
+    phases = startup_phases(pod, 1015, 1020.25)
+    assert phases["created"] == phases["initialized"] == 1015
+    assert phase_durations(phases)["started"] == 2
+
+    # Phases that have not happened are omitted
+    pod.status.conditions = [
+        condition("PodScheduled", 2),
+        condition("Ready", 5, "False"),
+    ]
+    pod.status.container_statuses = None
+    assert list(startup_phases(pod, 1000, 1001)) == [
+        "requested",
+        "created",
+        "scheduled",
+        "published",
+    ]
+
+
+def test_same_resources(monkeypatch):
+    """
+    Test that pooled pods are only used for sessions with the same resources.
+    """
+    monkeypatch.setenv("SESSION_MEM_LIMIT_DEFAULT", "1000")
+    defaults = default_resources()
+    assert same_resources(defaults, defaults)
+
+    # Values passed explicitly (e.g. by the manager) that are the same as the defaults
+    assert same_resources(
+        dict(defaults, cpu_request="0.1", mem_request=600, mem_limit=1000.0), defaults
+    )
+
+    assert not same_resources(dict(defaults, mem_limit=600), defaults)
+    assert not same_resources(dict(defaults, cpu_limit="2"), defaults)
+    assert not same_resources(
+        dict(defaults, network_policy="jobs-network-policy-2"), defaults
+    )
@@ -0,0 +1,418 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import secrets
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import kubernetes
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of pre-started pods to keep for each container image
+# and node pool. Set to zero to disable the pool.
+SESSION_POOL_SIZE = int(os.getenv("SESSION_POOL_SIZE", 0))
+
+# Minimum number of pre-started pods to keep for each container image
+# and node pool (once a session has been requested for it)
+SESSION_POOL_MIN = int(os.getenv("SESSION_POOL_MIN", 1))
+
+# Seconds over which to measure the rate of session requests
+SESSION_POOL_WINDOW = float(os.getenv("SESSION_POOL_WINDOW", 600))
+
+# Initial estimate of the seconds taken to cold start a session
+# (updated as sessions are cold started)
+SESSION_POOL_COLD_START = float(os.getenv("SESSION_POOL_COLD_START", 30))
+
+# Seconds that a pre-started pod waits to be claimed before exiting
+SESSION_POOL_IDLE_TIMEOUT = int(os.getenv("SESSION_POOL_IDLE_TIMEOUT", 3600))
+
+# Annotations on pods
+PORTS_ANNOTATION = "stencila.io/ports"
+REQUESTED_ANNOTATION = "stencila.io/requested"
+
+
+class PodPool:
+    """
+    A pool of pre-started session pods.
+
+    Pods are started for a particular container image and node pool (the pool's
+    `key`, recorded in the pod's `pool` label) with the default resources
+    and network policy, and wait until they are claimed by a session. A session
+    claims a pod by changing its `state` label from `idle` to `claimed`
+    (using its resource version as a precondition so that a pod can only be claimed
+    once, across all workers) and then writing the session's snapshot and
+    arguments to the pod's semaphores directory.
+
+    After each session request, the pool is topped up to a target size based
+    on the recent rate of requests and the time taken to cold start a session
+    (i.e. enough pods to meet requests made while replacements are starting).
+    """
+
+    def __init__(
+        self,
+        api: Any,
+        namespace: str,
+        size: int = SESSION_POOL_SIZE,
+        min_size: int = SESSION_POOL_MIN,
+        window: float = SESSION_POOL_WINDOW,
+        cold_start: float = SESSION_POOL_COLD_START,
+    ):
+        self.api = api
+        self.namespace = namespace
+        self.size = size
+        self.min_size = min(min_size, size)
+        self.window = window
+        self.cold_start = cold_start
+        self.starts: Dict[str, List[float]] = {"claimed": [0, 0.0], "cold": [0, 0.0]}
+        self.lock = threading.Lock()
+        self.replenishing = threading.Lock()
+
+    @staticmethod
+    def key(container_image: str, node_pool: str) -> str:
+        """
+        Get the key for a container image and node pool (used as a label value).
+        """
+        return hashlib.sha256(f"{container_image} {node_pool}".encode()).hexdigest()[
+            :16
+        ]
+
+    def claim(self, key: str) -> Optional[Any]:
+        """
+        Claim an idle pod from the pool.
+
+        Running pods are preferred over those that are still pending.
+        Returns `None` if there are no idle pods.
+        """
+        pods = self.api.list_namespaced_pod(
+            namespace=self.namespace,
+            label_selector=f"method=session,pool={key},state=idle",
+        )
+        for pod in sorted(pods.items, key=lambda pod: pod.status.phase != "Running"):
+            if pod.status.phase not in ("Pending", "Running"):
+                continue
+            try:
+                return self.api.patch_namespaced_pod(
+                    name=pod.metadata.name,
+                    namespace=self.namespace,
+                    body={
+                        "metadata": {
+                            "resourceVersion": pod.metadata.resource_version,
+                            "labels": {"state": "claimed"},
+                            "annotations": {REQUESTED_ANNOTATION: str(time.time())},
+                        }
+                    },
+                )
+            except kubernetes.client.rest.ApiException as exc:
+                # Claimed by another session first, so try the next one
+                if exc.status == 409:
+                    continue
+                raise exc
+        return None
+
+    def bind(
+        self,
+        name: str,
+        args: str,
+        snapshot: str,
+        snapshot_url: str,
+        snapshot_fingerprint: str,
+        blobs_url: str,
+    ) -> None:
+        """
+        Bind a claimed pod to a session.
+
+        Writes the snapshot to mount, and the arguments for `executa serve`,
+        to the pod's semaphores directory. Files are written to a temporary
+        name and then moved so that the pod never reads a partially written file.
+        """
+        output = kubernetes.stream.stream(
+            self.api.connect_get_namespaced_pod_exec,
+            name=name,
+            namespace=self.namespace,
+            container="session",
+            command=[
+                "/bin/sh",
+                "-c",
+                'printf "%s" "$1" > /semaphores/.snapshot '
+                "&& mv /semaphores/.snapshot /semaphores/snapshot "
+                '&& printf "%s" "$2" > /semaphores/.claim '
+                "&& mv /semaphores/.claim /semaphores/claim "
+                "&& echo bound",
+                "sh",
+                " ".join(
+                    [snapshot, snapshot_url, snapshot_fingerprint]
+                    + ([blobs_url] if blobs_url else [])
+                ),
+                args,
+            ],
+            stderr=True,
+            stdin=False,
+            stdout=True,
+            tty=False,
+        )
+        if "bound" not in output:
+            raise RuntimeError(f"Unable to bind session to pod: {output}")
+
+    def observe(self, method: str, seconds: float) -> None:
+        """
+        Record the time taken to start a session by claiming a pod, or cold starting one.
+
+        Cold start times are used (as an exponentially weighted moving average)
+        when calculating the target size of the pool.
+        """
+        with self.lock:
+            count, total = self.starts[method]
+            self.starts[method] = [count + 1, total + seconds]
+            if method == "cold":
+                self.cold_start = 0.8 * self.cold_start + 0.2 * seconds
+        logger.debug(f"Session pool metrics: {self.metrics()}")
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get metrics on the number of sessions started and their mean start time.
+        """
+        return dict(
+            (
+                method,
+                dict(count=count, seconds=round(total / count, 3) if count else None),
+            )
+            for method, (count, total) in self.starts.items()
+        )
+
+    def target(self, pods: List[Any]) -> int:
+        """
+        Calculate the number of idle pods to keep.
+
+        Uses the pods requested (claimed or cold started) within the last
+        `window` seconds, which may underestimate the rate of requests
+        since pods for sessions that have ended are not counted.
+        """
+        since = time.time() - self.window
+        requested = 0
+        for pod in pods:
+            annotations = pod.metadata.annotations or {}
+            if float(annotations.get(REQUESTED_ANNOTATION, 0)) > since:
+                requested += 1
+        rate = requested / self.window
+        return min(self.size, max(self.min_size, math.ceil(rate * self.cold_start)))
+
+    def replenish(self, key: str, **params) -> None:
+        """
+        Start, or stop, idle pods to meet the target size of the pool.
+
+        Idle pods that have exited (i.e. were not claimed before the
+        `SESSION_POOL_IDLE_TIMEOUT`) are deleted. `params` are passed on to
+        `pool_pod_manifest`. Only one replenishment is done at a time in each
+        worker process.
+        """
+        if not self.replenishing.acquire(blocking=False):
+            return
+        try:
+            pods = self.api.list_namespaced_pod(
+                namespace=self.namespace, label_selector=f"method=session,pool={key}"
+            ).items
+            idle = []
+            for pod in pods:
+                if pod.metadata.labels.get("state") != "idle":
+                    continue
+                if pod.status.phase in ("Pending", "Running"):
+                    idle.append(pod)
+                else:
+                    self.delete(pod.metadata.name)
+
+            target = self.target(pods)
+            if len(idle) > target:
+                idle.sort(key=lambda pod: pod.metadata.creation_timestamp)
+                for pod in idle[: len(idle) - target]:
+                    self.delete(pod.metadata.name)
+            for index in range(target - len(idle)):
+                self.api.create_namespaced_pod(
+                    namespace=self.namespace,
+                    body=pool_pod_manifest(
+                        "session-pool-" + secrets.token_hex(8), key, **params
+                    ),
+                )
+        except Exception as exc:
+            logger.warning(f"Unable to replenish session pool: {exc}")
+        finally:
+            self.replenishing.release()
+
+    def delete(self, name: str) -> None:
+        """
+        Delete a pod, ignoring it if it has already been deleted.
+        """
+        try:
+            self.api.delete_namespaced_pod(name=name, namespace=self.namespace)
+        except kubernetes.client.rest.ApiException as exc:
+            if exc.status != 404:
+                raise exc
+
+
+def pool_pod_manifest(
+    name: str,
+    key: str,
+    container_image: str,
+    node_pool: str,
+    cpu_request: Any,
+    cpu_limit: Any,
+    mem_request: Any,
+    mem_limit: Any,
+    network_policy: str,
+    env: List[Dict[str, str]] = [],
+) -> Dict[str, Any]:
+    """
+    Create the manifest for a pre-started session pod.
+
+    Similar to the manifest for a cold started snapshot session, but the
+    snapshot is fetched (using `groundsman.sh`) and mounted by the sidecar
+    after the pod is claimed, and the session container waits for its
+    arguments before running `executa serve`. If the snapshot can not be fetched
+    or mounted, both containers exit with an error so that the pod fails
+    (as a cold started pod does when its init container fails).
+    """
+    ports = {
+        "ws": random.randint(10000, 65535),
+        "http": random.randint(10000, 65535),
+    }
+    listen = " ".join(
+        f"--{protocol}=0.0.0.0:{port}" for protocol, port in ports.items()
+    )
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {
+            "name": name,
+            "labels": {
+                "method": "session",
+                "networkPolicy": network_policy,
+                "pool": key,
+                "state": "idle",
+            },
+            "annotations": {PORTS_ANNOTATION: json.dumps(ports)},
+        },
+        "spec": {
+            "nodeSelector": {"cloud.google.com/gke-nodepool": node_pool},
+            "containers": [
+                {
+                    "name": "sidecar",
+                    "image": "stencila/hub-groundsman",
+                    "imagePullPolicy": "IfNotPresent",
+                    "securityContext": {"privileged": True},
+                    "env": env,
+                    "command": ["/bin/sh", "-c", "--"],
+                    "args": [
+                        """
+                    while [ ! -f /semaphores/snapshot ]
+                    do
+                        [ -f /semaphores/finished ] && exit 0
+                        sleep 0.1
+                    done
+                    set -- $(cat /semaphores/snapshot)
+                    sh /groundsman.sh "$@" && \
+                        mkdir -p /overlay/upper /overlay/work && \
+                        mount -t overlay overlay \
+                            -o lowerdir=/snapshots/$1,upperdir=/overlay/upper,workdir=/overlay/work \
+                            /work && \
+                        chown 1000:1000 /work
+                    if [ $? -ne 0 ]
+                    then
+                        touch /semaphores/failed
+                        exit 1
+                    fi
+
+                    touch /semaphores/ready
+                    while [ ! -f /semaphores/finished ]
+                    do
+                        sleep 1
+                    done
+                    """
+                    ],
+                    "lifecycle": {
+                        "preStop": {"exec": {"command": ["umount", "/work"]}}
+                    },
+                    "volumeMounts": [
+                        {"name": "snapshots", "mountPath": "/snapshots"},
+                        {"name": "overlay", "mountPath": "/overlay"},
+                        {
+                            "name": "work",
+                            "mountPath": "/work",
+                            "mountPropagation": "Bidirectional",
+                        },
+                        {"name": "semaphores", "mountPath": "/semaphores"},
+                    ],
+                },
+                {
+                    "name": "session",
+                    "image": container_image,
+                    "command": [
+                        "/bin/bash",
+                        "-c",
+                        "--",
+                        f"""
+                        SECONDS=0
+                        until [ -f /semaphores/claim ] && [ -f /semaphores/ready ]
+                        do
+                            [ -f /semaphores/failed ] && exit 1
+                            if [ ! -f /semaphores/claim ] && \
+                               [ $SECONDS -ge {SESSION_POOL_IDLE_TIMEOUT} ]
+                            then
+                                touch /semaphores/finished
+                                exit 0
+                            fi
+                            sleep 0.1
+                        done
+                        touch /semaphores/started
+                        executa serve $(cat /semaphores/claim) {listen}
+                        touch /semaphores/finished
+                        """,
+                    ],
+                    "securityContext": {"runAsUser": 1000, "runAsGroup": 1000},
+                    "ports": [{"containerPort": port} for port in ports.values()],
+                    "readinessProbe": {
+                        "tcpSocket": {"port": ports["ws"]},
+                        "initialDelaySeconds": 2,
+                        "periodSeconds": 1,
+                        "failureThreshold": 60,
+                    },
+                    "volumeMounts": [
+                        {"name": "work", "mountPath": "/work"},
+                        {"name": "semaphores", "mountPath": "/semaphores"},
+                    ],
+                    "workingDir": "/work",
+                    "resources": {
+                        "requests": {
+                            "cpu": cpu_request,
+                            "memory": "{}Mi".format(mem_request),
+                        },
+                        "limits": {
+                            "cpu": cpu_limit,
+                            "memory": "{}Mi".format(mem_limit),
+                        },
+                    },
+                },
+            ],
+            "volumes": [
+                {
+                    "name": "snapshots",
+                    "hostPath": {"path": "/var/lib/stencila/hub/snapshots"},
+                },
+                {"name": "overlay", "emptyDir": {}},
+                {"name": "work", "emptyDir": {}},
+                {"name": "semaphores", "emptyDir": {}},
+            ],
+            "restartPolicy": "Never",
+            "automountServiceAccountToken": False,
+        },
+    }
+
+
+def pod_ports(pod: Any) -> Dict[str, int]:
+    """
+    Get the ports that a pre-started pod's session will listen on.
+    """
+    return json.loads(pod.metadata.annotations[PORTS_ANNOTATION])
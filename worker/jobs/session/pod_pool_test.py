@@ -0,0 +1,180 @@
+import subprocess
+import time
+from types import SimpleNamespace
+
+import kubernetes
+
+from .pod_pool import REQUESTED_ANNOTATION, PodPool, pod_ports, pool_pod_manifest
+
+
+def make_pod(name, state, phase="Running", requested=None, version="1"):
+    annotations = {REQUESTED_ANNOTATION: str(requested)} if requested else {}
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name=name,
+            labels={"state": state},
+            annotations=annotations,
+            resource_version=version,
+            creation_timestamp=name,
+        ),
+        status=SimpleNamespace(phase=phase),
+    )
+
+
+class FakeApi:
+    """
+    A fake K8s API with just enough behaviour to test the pool.
+    """
+
+    def __init__(self, pods):
+        self.pods = dict((pod.metadata.name, pod) for pod in pods)
+        self.created = []
+        self.deleted = []
+
+    def list_namespaced_pod(self, namespace, label_selector):
+        items = list(self.pods.values())
+        if "state=idle" in label_selector:
+            items = [pod for pod in items if pod.metadata.labels["state"] == "idle"]
+        return SimpleNamespace(items=items)
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        pod = self.pods[name]
+        if body["metadata"]["resourceVersion"] != pod.metadata.resource_version:
+            raise kubernetes.client.rest.ApiException(status=409)
+        pod.metadata.labels.update(body["metadata"]["labels"])
+        pod.metadata.annotations.update(body["metadata"]["annotations"])
+        return pod
+
+    def create_namespaced_pod(self, namespace, body):
+        self.created.append(body)
+
+    def delete_namespaced_pod(self, name, namespace):
+        self.deleted.append(name)
+
+
+def test_claim():
+    """
+    Running pods are claimed first, and pods claimed by others are skipped.
+    """
+    api = FakeApi(
+        [
+            make_pod("a", "idle", "Pending"),
+            make_pod("b", "idle", "Running", version="1"),
+            make_pod("c", "idle", "Succeeded"),
+            make_pod("d", "claimed"),
+        ]
+    )
+    pool = PodPool(api, "jobs", size=5)
+
+    pod = pool.claim("key")
+    assert pod.metadata.name == "b"
+    assert pod.metadata.labels["state"] == "claimed"
+    assert REQUESTED_ANNOTATION in pod.metadata.annotations
+
+    # Simulate another worker claiming `a` after it was listed
+    api.pods["a"].metadata.resource_version = "2"
+    listed = api.list_namespaced_pod
+    api.list_namespaced_pod = lambda **kwargs: SimpleNamespace(
+        items=[make_pod("a", "idle", "Pending", version="1")]
+    )
+    assert pool.claim("key") is None
+    api.list_namespaced_pod = listed
+
+
+def test_replenish():
+    """
+    The pool is sized based on recent requests and the cold start time.
+    """
+    now = time.time()
+    pods = [
+        make_pod("a", "claimed", requested=now - 10),
+        make_pod("b", "cold", requested=now - 20),
+        make_pod("c", "cold", requested=now - 1000),
+        make_pod("d", "idle", "Succeeded"),
+    ]
+    params = dict(
+        container_image="image",
+        node_pool="sessions",
+        cpu_request=0.1,
+        cpu_limit=1,
+        mem_request=600,
+        mem_limit=600,
+        network_policy="policy",
+    )
+
+    # Two requests in last 60s, takes 90s to start a pod, so need 3
+    api = FakeApi(pods)
+    pool = PodPool(api, "jobs", size=5, min_size=1, window=60, cold_start=90)
+    pool.replenish("key", **params)
+    assert api.deleted == ["d"]
+    assert len(api.created) == 3
+    manifest = api.created[0]
+    assert manifest["metadata"]["labels"]["pool"] == "key"
+    assert manifest["metadata"]["labels"]["state"] == "idle"
+    assert set(
+        pod_ports(SimpleNamespace(metadata=SimpleNamespace(**manifest["metadata"])))
+    ) == {"ws", "http"}
+
+    # Limited to the maximum size
+    api = FakeApi(pods)
+    pool = PodPool(api, "jobs", size=2, window=60, cold_start=90)
+    pool.replenish("key", **params)
+    assert len(api.created) == 2
+
+    # Surplus idle pods are deleted, oldest first
+    api = FakeApi([make_pod("e", "idle"), make_pod("f", "idle")])
+    pool = PodPool(api, "jobs", size=5, min_size=1)
+    pool.replenish("key", **params)
+    assert api.created == []
+    assert api.deleted == ["e"]
+
+
+def test_observe():
+    pool = PodPool(None, "jobs", size=1, cold_start=30)
+    pool.observe("claimed", 2)
+    pool.observe("cold", 40)
+    assert pool.cold_start == 32
+    assert pool.metrics() == dict(
+        claimed=dict(count=1, seconds=2), cold=dict(count=1, seconds=40)
+    )
+
+
+def test_manifest():
+    manifest = pool_pod_manifest(
+        "name", "key", "image", "sessions", 0.1, 1, 600, 600, "policy"
+    )
+    session = manifest["spec"]["containers"][1]
+    assert session["image"] == "image"
+    assert "executa serve $(cat /semaphores/claim)" in session["command"][3]
+
+
+def test_manifest_fetch_failed(tmp_path):
+    """
+    If the snapshot can not be fetched, both containers exit with an error.
+    """
+    manifest = pool_pod_manifest(
+        "name", "key", "image", "sessions", 0.1, 1, 600, 600, "policy"
+    )
+    sidecar, session = manifest["spec"]["containers"]
+
+    semaphores = tmp_path / "semaphores"
+    semaphores.mkdir()
+    groundsman = tmp_path / "groundsman.sh"
+    groundsman.write_text("exit 1")
+
+    def run(command):
+        script = (
+            command[-1]
+            .replace("/semaphores", str(semaphores))
+            .replace("/groundsman.sh", str(groundsman))
+        )
+        return subprocess.run(command[:-1] + [script], timeout=10).returncode
+
+    (semaphores / "snapshot").write_text("snapshot-id https://example.org/snapshot -")
+    assert run(sidecar["command"] + sidecar["args"]) == 1
+    assert (semaphores / "failed").exists()
+    assert not (semaphores / "ready").exists()
+
+    (semaphores / "claim").write_text("--key=key")
+    assert run(session["command"]) == 1
+    assert not (semaphores / "started").exists()
@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Set
+
+import kubernetes
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which the API server ends a watch (it is then resumed from
+# the last event received). Set to zero to disable watching and always
+# poll the API server for the state of each session's pod.
+SESSION_POD_WATCH_TIMEOUT = int(os.getenv("SESSION_POD_WATCH_TIMEOUT", 300))
+
+# Maximum seconds to rely on the watch before reading a pod directly
+# (guards against any missed events)
+SESSION_POD_RESYNC = float(os.getenv("SESSION_POD_RESYNC", 60))
+
+# Seconds to wait before restarting a failed watch
+SESSION_POD_WATCH_BACKOFF = float(os.getenv("SESSION_POD_WATCH_BACKOFF", 5))
+
+
+class PodWatcher:
+    """
+    Watches session pods and dispatches changes in their state to waiting sessions.
+
+    Rather than each session polling the API server for the state of its pod,
+    a single watch on the session pods in the namespace is shared by all the
+    sessions in the worker process. Sessions `wait` for their pod to meet a
+    condition and are woken when an event for it is received.
+
+    If the watch fails it is restarted (after listing the pods to get their
+    current state). While the watch is down, or if it has not been started,
+    waiting sessions fall back to polling.
+    """
+
+    def __init__(
+        self,
+        api: Any,
+        namespace: str,
+        label_selector: str = "method=session",
+        timeout: int = SESSION_POD_WATCH_TIMEOUT,
+        resync: float = SESSION_POD_RESYNC,
+        backoff: float = SESSION_POD_WATCH_BACKOFF,
+    ):
+        self.api = api
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.timeout = timeout
+        self.resync = resync
+        self.backoff = backoff
+
+        # Latest state of pods being waited on (`None` if deleted)
+        self.pods: Dict[str, Any] = {}
+        self.registered: Set[str] = set()
+        self.condition = threading.Condition()
+
+        self.watching = False
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.watch: Optional[kubernetes.watch.Watch] = None
+
+    def start(self) -> None:
+        """
+        Start watching pods in a background thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="pod-watcher", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop watching pods.
+        """
+        self.stopped.set()
+        if self.watch:
+            self.watch.stop()
+        self.set_watching(False)
+
+    def run(self) -> None:
+        """
+        Watch pods, restarting the watch if it fails.
+        """
+        resource_version = None
+        while not self.stopped.is_set():
+            try:
+                if resource_version is None:
+                    resource_version = self.sync()
+                    self.set_watching(True)
+                for event in self.events(resource_version):
+                    resource_version = self.dispatch(event)
+                    if self.stopped.is_set():
+                        break
+            except Exception as exc:
+                self.set_watching(False)
+                resource_version = None
+                if self.stopped.is_set():
+                    break
+                logger.warning(f"Pod watch failed, falling back to polling: {exc}")
+                self.stopped.wait(self.backoff)
+
+    def sync(self) -> str:
+        """
+        List pods to update the state of those being waited on.
+
+        Returns the resource version of the list, from which to start watching.
+        """
+        pods = self.api.list_namespaced_pod(
+            namespace=self.namespace, label_selector=self.label_selector
+        )
+        current = dict((pod.metadata.name, pod) for pod in pods.items)
+        with self.condition:
+            for name in self.registered:
+                self.pods[name] = current.get(name)
+            self.condition.notify_all()
+        return pods.metadata.resource_version
+
+    def events(self, resource_version: str) -> Iterator[Dict[str, Any]]:
+        """
+        Stream pod events starting from `resource_version`.
+        """
+        self.watch = kubernetes.watch.Watch()
+        return self.watch.stream(
+            self.api.list_namespaced_pod,
+            namespace=self.namespace,
+            label_selector=self.label_selector,
+            resource_version=resource_version,
+            timeout_seconds=self.timeout,
+            _request_timeout=self.timeout + 30,
+        )
+
+    def dispatch(self, event: Dict[str, Any]) -> str:
+        """
+        Update the state of a pod and wake any sessions waiting on it.
+
+        Returns the resource version of the event.
+        """
+        pod = event["object"]
+        name = pod.metadata.name
+        with self.condition:
+            if name in self.registered:
+                self.pods[name] = None if event["type"] == "DELETED" else pod
+                self.condition.notify_all()
+        return pod.metadata.resource_version
+
+    def set_watching(self, watching: bool) -> None:
+        """
+        Record whether the watch is up, waking sessions so they can start polling.
+        """
+        with self.condition:
+            self.watching = watching
+            self.condition.notify_all()
+
+    def read(self, name: str) -> Any:
+        """
+        Read a pod from the API server.
+
+        Returns `None` if the pod does not exist.
+        """
+        try:
+            return self.api.read_namespaced_pod(name=name, namespace=self.namespace)
+        except kubernetes.client.rest.ApiException as exc:
+            if exc.status == 404:
+                return None
+            raise exc
+
+    def wait(self, name: str, predicate: Callable[[Any], bool], interval: float) -> Any:
+        """
+        Wait for a pod to meet a condition.
+
+        `predicate` is called with the latest state of the pod (or `None` if it
+        has been deleted) and the pod is returned once it returns `True`.
+        The pod is read directly when it is first waited on, at least every
+        `resync` seconds while the watch is up, and every `interval` seconds
+        while it is down.
+        """
+        with self.condition:
+            self.registered.add(name)
+
+        checked: Optional[float] = None
+        while True:
+            with self.condition:
+                elapsed = (
+                    time.monotonic() - checked if checked is not None else self.resync
+                )
+                if self.watching and name in self.pods and elapsed < self.resync:
+                    pod = self.pods[name]
+                    if predicate(pod):
+                        return pod
+                    self.condition.wait(self.resync - elapsed)
+                    continue
+
+            pod = self.read(name)
+            checked = time.monotonic()
+            with self.condition:
+                self.pods[name] = pod
+            if predicate(pod):
+                return pod
+            with self.condition:
+                if not self.watching:
+                    # Wait to poll again (or for the watch to restart)
+                    self.condition.wait(interval)
+
+    def forget(self, name: str) -> None:
+        """
+        Stop tracking a pod (e.g. once its session has ended).
+        """
+        with self.condition:
+            self.registered.discard(name)
+            self.pods.pop(name, None)
@@ -0,0 +1,113 @@
+import queue
+import threading
+from types import SimpleNamespace
+
+import kubernetes
+
+from .pod_watcher import PodWatcher
+
+
+def make_pod(name, phase, version):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, resource_version=version),
+        status=SimpleNamespace(phase=phase),
+    )
+
+
+class FakeApi:
+    """
+    A fake K8s API which counts the number of times pods are read.
+    """
+
+    def __init__(self):
+        self.pods = {}
+        self.reads = 0
+
+    def list_namespaced_pod(self, namespace, label_selector):
+        return SimpleNamespace(
+            metadata=SimpleNamespace(resource_version="1"),
+            items=list(self.pods.values()),
+        )
+
+    def read_namespaced_pod(self, name, namespace):
+        self.reads += 1
+        if name not in self.pods:
+            raise kubernetes.client.rest.ApiException(status=404)
+        return self.pods[name]
+
+
+class FakeWatcher(PodWatcher):
+    """
+    A pod watcher which gets events from a queue rather than the API.
+    """
+
+    def __init__(self, api, **kwargs):
+        super().__init__(api, "jobs", **kwargs)
+        self.queue = queue.Queue()
+        self.watches = 0
+
+    def events(self, resource_version):
+        self.watches += 1
+        while True:
+            event = self.queue.get()
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+
+def test_wait_for_events():
+    """
+    Once a pod has been read, sessions are woken by events rather than polling.
+    """
+    api = FakeApi()
+    api.pods["a"] = make_pod("a", "Pending", "2")
+    watcher = FakeWatcher(api)
+    watcher.start()
+
+    def events():
+        watcher.queue.put(dict(type="MODIFIED", object=make_pod("b", "Running", "3")))
+        watcher.queue.put(dict(type="MODIFIED", object=make_pod("a", "Running", "4")))
+
+    threading.Timer(0.2, events).start()
+    pod = watcher.wait("a", lambda pod: pod.status.phase == "Running", 60)
+    assert pod.status.phase == "Running"
+    assert api.reads == 1
+    assert "b" not in watcher.pods
+
+    threading.Timer(
+        0.2,
+        lambda: watcher.queue.put(
+            dict(type="DELETED", object=make_pod("a", "Running", "5"))
+        ),
+    ).start()
+    assert watcher.wait("a", lambda pod: pod is None, 60) is None
+    assert api.reads == 2
+
+    watcher.forget("a")
+    assert watcher.pods == {}
+    watcher.stop()
+
+
+def test_wait_fallback():
+    """
+    When the watch is down, or not started, sessions poll for the pod's state.
+    """
+    api = FakeApi()
+    api.pods["a"] = make_pod("a", "Pending", "2")
+    watcher = FakeWatcher(api, backoff=60)
+    threading.Timer(
+        0.2, lambda: api.pods.update(a=make_pod("a", "Running", "3"))
+    ).start()
+    pod = watcher.wait("a", lambda pod: pod.status.phase == "Running", 0.05)
+    assert pod.status.phase == "Running"
+    assert api.reads > 2
+
+    # Watch fails after the pod is first read, so falls back to polling
+    api.reads = 0
+    watcher.start()
+    threading.Timer(0.2, lambda: watcher.queue.put(Exception("Gone"))).start()
+    threading.Timer(0.4, lambda: api.pods.pop("a")).start()
+    assert watcher.wait("a", lambda pod: pod is None, 0.05) is None
+    assert api.reads > 2
+    assert watcher.watches == 1
+    watcher.stop()
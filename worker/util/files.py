@@ -1,16 +1,33 @@
 import hashlib
+import logging
 import mimetypes
+import mmap
 import os
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
 
 import filetype
 
+from config import get_files_workers, get_manifests_verify
+from util.manifest import Manifest
+
+logger = logging.getLogger(__name__)
+
 FileInfo = Dict[str, Any]
 Files = Dict[str, FileInfo]
 
+# Size of the buffer used when reading files to fingerprint them
+FINGERPRINT_BUFFER_SIZE = 1024 * 1024
+
+# Files larger than this are memory mapped when fingerprinting them
+FINGERPRINT_MMAP_SIZE = 16 * 1024 * 1024
+
+# The `ioctl` request code for cloning a file on Linux (`FICLONE` in `linux/fs.h`)
+FICLONE = 0x40049409
+
 # Add mapping between mimetypes and extensions
 # See https://docs.python.org/3/library/mimetypes.html#mimetypes.add_type
 # "When the extension is already known, the new type will replace the old
@@ -28,37 +45,122 @@ for mimetype, ext in [
     mimetypes.add_type(mimetype, ext)
 
 
-def list_files(directory: str = ".") -> Files:
+def list_files(
+    directory: str = ".",
+    manifest: bool = False,
+    verify: Optional[bool] = None,
+    workers: Optional[int] = None,
+) -> Files:
     """
     List, and provide information on, all files in a directory.
 
     Includes all subdirectories and all files.
+
+    If `manifest` is true, the persistent manifest for the directory is used
+    to avoid fingerprinting, and sniffing the mimetype of, files that have not changed
+    since the directory was last listed. Use this for directories that persist
+    between jobs (e.g. a project's working directory) rather than temporary ones.
+    If `verify` is true (defaults to the `MANIFESTS_VERIFY` setting) then information
+    from the manifest is checked against freshly generated fingerprints.
+
+    See `files_info` for the `workers` option.
     """
-    files = {}
+    directory_manifest = Manifest.load(directory) if manifest else None
+    if verify is None:
+        verify = get_manifests_verify()
+
+    paths = {}
     for (dirpath, dirnames, filenames) in os.walk(directory):
+        relative_dir = os.path.relpath(dirpath, directory)
         for filename in filenames:
             absolute_path = os.path.join(dirpath, filename)
-            relative_path = os.path.relpath(absolute_path, directory)
-            files[relative_path] = file_info(absolute_path)
+            relative_path = os.path.normpath(os.path.join(relative_dir, filename))
+            paths[relative_path] = absolute_path
+
+    files = files_info(
+        paths, manifest=directory_manifest, verify=verify, workers=workers
+    )
+
+    if directory_manifest:
+        directory_manifest.save()
+
     return files
 
 
-def file_info(path: str, mimetype: Optional[str] = None) -> FileInfo:
+def files_info(
+    paths: Dict[str, str],
+    manifest: Optional[Manifest] = None,
+    verify: bool = False,
+    workers: Optional[int] = None,
+) -> Files:
+    """
+    Get info on several files.
+
+    The `paths` dictionary maps the names of files to their paths
+    on disk (e.g. relative paths within a project to absolute paths).
+    Files are fingerprinted in parallel using a pool of `workers` threads
+    (defaults to the `FILES_WORKERS` setting).
+    """
+    if workers is None:
+        workers = get_files_workers()
+
+    if workers <= 1 or len(paths) <= 1:
+        return {
+            name: file_info(path, manifest=manifest, verify=verify)
+            for name, path in paths.items()
+        }
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        infos = executor.map(
+            lambda path: file_info(path, manifest=manifest, verify=verify),
+            paths.values(),
+        )
+        return dict(zip(paths.keys(), infos))
+
+
+def file_info(
+    path: str,
+    mimetype: Optional[str] = None,
+    manifest: Optional[Manifest] = None,
+    verify: bool = False,
+) -> FileInfo:
     """
     Get info on a file.
+
+    If a `manifest` is supplied, and the file has not changed since
+    it was recorded in it, then the recorded fingerprint and mimetype are used.
     """
-    if mimetype:
-        encoding = None
+    stat = os.stat(path)
+
+    entry = manifest.get(path, stat) if manifest else None
+    if entry and not verify:
+        fingerprint = entry["fingerprint"]
+        if not mimetype:
+            mimetype, encoding = entry["mimetype"], entry["encoding"]
+        else:
+            encoding = None
     else:
-        mimetype, encoding = file_mimetype(path)
-
-    return {
-        "size": os.path.getsize(path),
+        fingerprint = file_fingerprint(path)
+        if mimetype:
+            encoding = None
+        else:
+            mimetype, encoding = file_mimetype(path)
+
+        if entry and entry["fingerprint"] != fingerprint:
+            logger.warning(f"Manifest has incorrect fingerprint for {path}")
+            if manifest:
+                manifest.mismatches += 1
+
+    info = {
+        "size": stat.st_size,
         "mimetype": mimetype,
         "encoding": encoding,
-        "modified": os.path.getmtime(path),
-        "fingerprint": file_fingerprint(path),
+        "modified": stat.st_mtime,
+        "fingerprint": fingerprint,
     }
+    if manifest:
+        manifest.set(path, stat, info)
+    return info
 
 
 def file_ext(path: str) -> Optional[str]:
@@ -83,13 +185,20 @@ def file_mimetype(path: str) -> Tuple[Optional[str], Optional[str]]:
 def file_fingerprint(path: str) -> str:
     """
     Generate a SHA256 fingerprint of the contents of a file.
+
+    Large files are memory mapped and hashed in one call (during
+    which `hashlib` releases the GIL), other files are read into a reusable buffer.
     """
     h = hashlib.sha256()
-    b = bytearray(128 * 1024)
-    mv = memoryview(b)
     with open(path, "rb", buffering=0) as f:
-        for n in iter(lambda: f.readinto(mv), 0):  # type: ignore
-            h.update(mv[:n])
+        if os.fstat(f.fileno()).st_size >= FINGERPRINT_MMAP_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        else:
+            b = bytearray(FINGERPRINT_BUFFER_SIZE)
+            mv = memoryview(b)
+            for n in iter(lambda: f.readinto(mv), 0):  # type: ignore
+                h.update(mv[:n])
     return h.hexdigest()
 
 
@@ -108,6 +217,33 @@ def bytes_fingerprint(data: bytes) -> str:
     return h.hexdigest()
 
 
+def write_chunks(chunks: Iterable[bytes], dest_path: str) -> str:
+    """
+    Write chunks of bytes to a file, returning the SHA256 fingerprint of them.
+    """
+    h = hashlib.sha256()
+    with open(ensure_parent(dest_path), "wb") as dest:
+        for chunk in chunks:
+            h.update(chunk)
+            dest.write(chunk)
+    return h.hexdigest()
+
+
+def fingerprinted_info(path: str, fingerprint: str) -> FileInfo:
+    """
+    Get info on a file that has already been fingerprinted.
+    """
+    stat = os.stat(path)
+    mimetype, encoding = file_mimetype(path)
+    return {
+        "size": stat.st_size,
+        "mimetype": mimetype,
+        "encoding": encoding,
+        "modified": stat.st_mtime,
+        "fingerprint": fingerprint,
+    }
+
+
 def is_within(parent, child) -> bool:
     """
     Check that a path is within another.
@@ -168,7 +304,16 @@ def move_files(source: str, dest: str = ".", cleanup: bool = True) -> None:
 
     With overwrite of existing files, directory merging and (optional) cleanup
     of the source.
+
+    Avoids copying the content of files where possible. If the source and
+    destination are on the same filesystem, files are renamed (if the source is
+    to be cleaned up), or cloned. Files are only copied when on different
+    filesystems (where renaming fails, see #1002), or if the other methods fail.
     """
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    same_device = os.stat(source).st_dev == os.stat(dest).st_dev
+
     for path, dirs, files in os.walk(source):
         rel_path = os.path.relpath(path, source)
         dest_dir = os.path.join(dest, rel_path)
@@ -177,9 +322,73 @@ def move_files(source: str, dest: str = ".", cleanup: bool = True) -> None:
         for file in files:
             source_file = os.path.join(path, file)
             dest_file = os.path.join(dest_dir, file)
-            # Do not attempt to use os.rename here
-            # See #1002
-            shutil.copy2(source_file, dest_file)
+            if not (
+                same_device
+                and not os.path.islink(source_file)
+                and move_file(source_file, dest_file, keep=not cleanup)
+            ):
+                shutil.copy2(source_file, dest_file)
 
     if cleanup:
         remove_dir(source)
+
+
+def move_file(source: str, dest: str, keep: bool = False) -> bool:
+    """
+    Move a file to another path on the same filesystem without copying its content.
+
+    Tries, in order, to rename the file, hardlink it (both only if the source does not
+    need to be kept), and to clone it (on filesystems that support reflinks e.g.
+    Btrfs and XFS). Any existing file at `dest` is replaced. Returns `False` if
+    none of these methods succeeded, in which case the file should be copied.
+    """
+    if not keep:
+        try:
+            os.replace(source, dest)
+            return True
+        except OSError:
+            pass
+
+        # If a file can not be renamed (e.g. because the source directory is
+        # read only) it may still be able to be linked. This is not done if the
+        # source is kept because changes to either file would affect the other.
+        if replace_with(dest, lambda temp: os.link(source, temp)):
+            return True
+
+    return replace_with(dest, lambda temp: clone_file(source, temp))
+
+
+def replace_with(dest: str, create: Callable[[str], None]) -> bool:
+    """
+    Create a file at a temporary path alongside `dest` and then move it into place.
+
+    Returns `False` if the file could not be created.
+    """
+    temp = os.path.join(
+        os.path.dirname(dest), f".{os.path.basename(dest)}.{os.getpid()}.tmp"
+    )
+    try:
+        create(temp)
+        os.replace(temp, dest)
+        return True
+    except OSError:
+        if os.path.lexists(temp):
+            os.remove(temp)
+        return False
+
+
+def clone_file(source: str, dest: str) -> None:
+    """
+    Clone a file using a reflink (a copy-on-write copy of its content).
+
+    Raises an `OSError` if reflinks are not supported on the platform
+    or filesystem.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflinks are not supported on this platform")
+
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, dest)
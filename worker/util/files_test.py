@@ -1,4 +1,22 @@
-from .files import assert_within, is_within
+import errno
+import hashlib
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from .files import (
+    FINGERPRINT_MMAP_SIZE,
+    assert_within,
+    file_fingerprint,
+    fingerprinted_info,
+    is_within,
+    list_files,
+    move_files,
+    write_chunks,
+)
+from .manifest import Manifest
 
 
 def test_is_within():
@@ -15,3 +33,212 @@ def test_is_within():
 
 def test_assert_within():
     assert_within(".", "child")
+
+
+def test_write_chunks(tmp_path):
+    path = str(tmp_path / "dir" / "file.html")
+    fingerprint = write_chunks(iter([b"<h1>", b"Hello</h1>"]), path)
+    assert fingerprint == hashlib.sha256(b"<h1>Hello</h1>").hexdigest()
+    assert fingerprint == file_fingerprint(path)
+
+    info = fingerprinted_info(path, fingerprint)
+    assert info["size"] == 14
+    assert info["mimetype"] == "text/html"
+    assert info["fingerprint"] == fingerprint
+
+
+def make_files(directory, count, content="content"):
+    """Create files with modification times in the past (so they are not "racy")."""
+    past = time.time() - 60
+    for index in range(count):
+        path = os.path.join(directory, str(index % 100), f"{index}.txt")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(f"{content} {index}")
+        os.utime(path, (past, past))
+
+
+def test_list_files_manifest(tmp_path, monkeypatch):
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+    directory = str(tmp_path / "dir")
+    make_files(directory, 10)
+
+    # Cold: all files need to be fingerprinted
+    with mock.patch("util.files.file_fingerprint", wraps=file_fingerprint) as spy:
+        cold = list_files(directory, manifest=True)
+    assert spy.call_count == 10
+    assert len(cold) == 10
+    assert cold["1/1.txt"]["mimetype"] == "text/plain"
+
+    # Warm: no files need to be fingerprinted
+    with mock.patch("util.files.file_fingerprint", wraps=file_fingerprint) as spy:
+        warm = list_files(directory, manifest=True)
+    assert spy.call_count == 0
+    assert warm == cold
+
+    # Modified and removed files are detected
+    path = os.path.join(directory, "1", "1.txt")
+    with open(path, "w") as file:
+        file.write("changed")
+    os.utime(path, (time.time() - 30, time.time() - 30))
+    os.unlink(os.path.join(directory, "2", "2.txt"))
+    with mock.patch("util.files.file_fingerprint", wraps=file_fingerprint) as spy:
+        changed = list_files(directory, manifest=True)
+    assert spy.call_count == 1
+    assert changed["1/1.txt"]["fingerprint"] == hashlib.sha256(b"changed").hexdigest()
+    assert changed["1/1.txt"]["size"] == 7
+    assert "2/2.txt" not in changed
+
+    # Recently modified files are not trusted
+    os.utime(path, None)
+    list_files(directory, manifest=True)
+    with mock.patch("util.files.file_fingerprint", wraps=file_fingerprint) as spy:
+        list_files(directory, manifest=True)
+    assert spy.call_count == 1
+
+    # Verification detects stale entries (e.g. if modification
+    # time and size are unchanged)
+    past = time.time() - 30
+    os.utime(path, (past, past))
+    list_files(directory, manifest=True)
+    with open(path, "w") as file:
+        file.write("CHANGED")
+    os.utime(path, (past, past))
+    assert (
+        list_files(directory, manifest=True)["1/1.txt"]["fingerprint"]
+        == changed["1/1.txt"]["fingerprint"]
+    )
+    assert (
+        list_files(directory, manifest=True, verify=True)["1/1.txt"]["fingerprint"]
+        == hashlib.sha256(b"CHANGED").hexdigest()
+    )
+
+    # Without a manifest, nothing is saved
+    os.unlink(os.path.join(directory, "3", "3.txt"))
+    list_files(directory)
+    assert "3/3.txt" in Manifest.load(directory).previous
+
+
+@pytest.mark.skipif(not os.getenv("BENCHMARK"), reason="BENCHMARK not set")
+def test_list_files_manifest_benchmark(tmp_path, monkeypatch):
+    monkeypatch.setenv("MANIFESTS_ROOT", str(tmp_path / "manifests"))
+    directory = str(tmp_path / "dir")
+    make_files(directory, 50000, content="x" * 10000)
+
+    start = time.perf_counter()
+    cold = list_files(directory, manifest=True)
+    cold_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    warm = list_files(directory, manifest=True)
+    warm_seconds = time.perf_counter() - start
+
+    assert warm == cold
+    print(f"\nCold {cold_seconds:.2f}s, warm {warm_seconds:.2f}s for {len(cold)} files")
+
+
+def test_list_files_workers(tmp_path):
+    directory = str(tmp_path)
+    make_files(directory, 100)
+    with open(os.path.join(directory, "large.bin"), "wb") as file:
+        file.write(os.urandom(FINGERPRINT_MMAP_SIZE + 1))
+
+    sequential = list_files(directory, workers=1)
+    parallel = list_files(directory, workers=4)
+    assert len(parallel) == 101
+    assert parallel == sequential
+    assert list(parallel.keys()) == list(sequential.keys())
+
+    with open(os.path.join(directory, "large.bin"), "rb") as file:
+        assert (
+            parallel["large.bin"]["fingerprint"]
+            == hashlib.sha256(file.read()).hexdigest()
+        )
+
+
+@pytest.mark.skipif(not os.getenv("BENCHMARK"), reason="BENCHMARK not set")
+def test_list_files_workers_benchmark(tmp_path):
+    directory = str(tmp_path)
+    make_files(directory, 2000, content="x" * 1024 * 1024)
+    megabytes = 2000
+
+    for workers in (1, 2, 4, 8):
+        start = time.perf_counter()
+        list_files(directory, workers=workers)
+        seconds = time.perf_counter() - start
+        print(f"\n{workers} workers: {megabytes / seconds:.0f} MB/s")
+
+
+def make_move_dirs(tmp_path):
+    source = tmp_path / "source"
+    (source / "a").mkdir(parents=True)
+    (source / "a" / "b.txt").write_text("new b")
+    (source / "c.txt").write_text("new c")
+
+    dest = tmp_path / "dest"
+    (dest / "a").mkdir(parents=True)
+    (dest / "a" / "e.txt").write_text("old e")
+    (dest / "c.txt").write_text("old c")
+    (dest / "d.txt").write_text("old d")
+
+    return source, dest
+
+
+def assert_moved(dest):
+    # Existing files are overwritten, other files and directories are merged
+    assert sorted(
+        str(path.relative_to(dest)) for path in dest.rglob("*") if path.is_file()
+    ) == ["a/b.txt", "a/e.txt", "c.txt", "d.txt"]
+    assert (dest / "a" / "b.txt").read_text() == "new b"
+    assert (dest / "c.txt").read_text() == "new c"
+    assert (dest / "d.txt").read_text() == "old d"
+    assert (dest / "a" / "e.txt").read_text() == "old e"
+
+
+def test_move_files(tmp_path):
+    source, dest = make_move_dirs(tmp_path)
+    inode = os.stat(source / "c.txt").st_ino
+
+    move_files(str(source), str(dest))
+
+    assert_moved(dest)
+    assert not source.exists()
+    # Files on the same filesystem are renamed rather than copied
+    assert os.stat(dest / "c.txt").st_ino == inode
+
+
+def test_move_files_no_cleanup(tmp_path):
+    source, dest = make_move_dirs(tmp_path)
+
+    move_files(str(source), str(dest), cleanup=False)
+
+    assert_moved(dest)
+    assert (source / "c.txt").read_text() == "new c"
+    # Files are not linked because then changes to one would change the other
+    assert os.stat(dest / "c.txt").st_ino != os.stat(source / "c.txt").st_ino
+    (dest / "c.txt").write_text("changed c")
+    assert (source / "c.txt").read_text() == "new c"
+
+
+def test_move_files_new_dest(tmp_path):
+    source, dest = make_move_dirs(tmp_path)
+
+    move_files(str(source), str(tmp_path / "new" / "dest"))
+
+    assert (tmp_path / "new" / "dest" / "a" / "b.txt").read_text() == "new b"
+
+
+def test_move_files_copy(tmp_path):
+    source, dest = make_move_dirs(tmp_path)
+
+    # Simulate the source and destination being on different filesystems
+    with mock.patch(
+        "os.replace", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")
+    ), mock.patch(
+        "os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")
+    ):
+        move_files(str(source), str(dest))
+
+    assert_moved(dest)
+    assert not source.exists()
+    assert not list(dest.rglob("*.tmp"))
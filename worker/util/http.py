@@ -1,22 +1,190 @@
+import atexit
 import ipaddress
+import logging
 import mimetypes
 import os
 import re
 import shutil
 import tempfile
+import threading
+import time
 from pathlib import Path
 from socket import gethostbyname
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 from urllib.parse import urlparse
 
+import httpx
 import requests
+import urllib3
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait when connecting to, or reading from, a server
+# using the shared HTTP client
+HTTP_CLIENT_TIMEOUT = float(os.getenv("HTTP_CLIENT_TIMEOUT", 30))
+
+# Maximum number of idle connections kept open by the shared HTTP client
+HTTP_CLIENT_KEEPALIVE = int(os.getenv("HTTP_CLIENT_KEEPALIVE", 10))
+
+# Maximum number of times to resume an interrupted download
+HTTP_PULL_RETRIES = int(os.getenv("HTTP_PULL_RETRIES", 3))
+
+# Size of the chunks that downloads are written in
+HTTP_CHUNK_SIZE = 64 * 1024
+
+# Seconds that the validated address of a host is cached for
+HTTP_DNS_TTL = float(os.getenv("HTTP_DNS_TTL", 60))
+
+# Hosts that can not be fetched from
+BLOCKED_HOSTS = ("hub-test.stenci.la", "hub.stenci.la")
+
+
+class HostResolver:
+    """
+    A cache of the validated IP addresses of hosts.
+
+    Hosts are resolved, and checked not to be a local or private address
+    (to prevent server-side request forgery), at most once every `ttl` seconds.
+    Connections made by `HttpSession` are made to the validated address, rather
+    than resolving the host again, so that a host can not pass validation and
+    then be rebound to a different address before the connection is made.
+    """
+
+    def __init__(self, ttl: float = HTTP_DNS_TTL):
+        self.ttl = ttl
+        self.entries: Dict[str, Tuple[str, float]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+        self.connections = 0
+        self.requests = 0
+
+    def resolve(self, hostname: str) -> str:
+        """
+        Get the validated IP address of a host.
+
+        Raises a `ValueError` if the host is not allowed.
+        """
+        hostname = hostname.lower().rstrip(".")
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(hostname)
+            if entry and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+
+        if not hostname or hostname in BLOCKED_HOSTS:
+            raise ValueError("{} is not a valid hostname.".format(hostname))
+
+        try:
+            ipaddress.ip_address(hostname)
+        except ValueError:
+            pass
+        else:
+            # Trying to access a site by IP
+            raise ValueError("{} is not a valid hostname.".format(hostname))
+
+        start = time.monotonic()
+        address = gethostbyname(hostname)
+        seconds = time.monotonic() - start
+
+        ip = ipaddress.ip_address(address)
+        if ip.is_loopback or ip.is_private:
+            raise ValueError("{} is not a valid hostname.".format(hostname))
+
+        with self.lock:
+            self.lookups += 1
+            self.lookup_seconds += seconds
+            self.entries[hostname] = (address, start + self.ttl)
+        return address
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get metrics on DNS lookups and connection reuse.
+        """
+        with self.lock:
+            return dict(
+                dns_hits=self.hits,
+                dns_lookups=self.lookups,
+                dns_seconds=round(self.lookup_seconds, 6),
+                connections=self.connections,
+                requests=self.requests,
+                reused=max(0, self.requests - self.connections),
+            )
+
+
+resolver = HostResolver()
+
+
+class PinnedHTTPConnection(urllib3.connection.HTTPConnection):
+    """
+    A HTTP connection made to the validated address of its host.
+    """
+
+    def _new_conn(self):
+        # The host is used for the `Host` header and, for HTTPS, for SNI and
+        # certificate verification, so it is only replaced while connecting
+        host = self._dns_host
+        self._dns_host = resolver.resolve(self.host)
+        with resolver.lock:
+            resolver.connections += 1
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class PinnedHTTPSConnection(PinnedHTTPConnection, urllib3.connection.HTTPSConnection):
+    """
+    A HTTPS connection made to the validated address of its host.
+    """
+
+    pass
+
+
+class PinnedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = PinnedHTTPConnection
+
+
+class PinnedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = PinnedHTTPSConnection
+
+
+class PinnedAdapter(requests.adapters.HTTPAdapter):
+    """
+    A transport adapter which only connects to validated addresses.
+
+    Connections to proxies (if any) are not pinned.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": PinnedHTTPConnectionPool,
+            "https": PinnedHTTPSConnectionPool,
+        }
 
 
 class HttpSession(requests.sessions.Session):
+    """
+    A HTTP session which prevents requests to local or private addresses.
+
+    Use `get_http_session` to get the session shared by jobs in this
+    worker process (with connections pooled and kept alive between jobs).
+    """
+
     def __init__(self):
         super().__init__()
         self.max_redirects = 5
         self.headers = {"User-Agent": "Stencila Hub HTTP Client"}
+        self.mount("http://", PinnedAdapter())
+        self.mount("https://", PinnedAdapter())
+
+    def send(self, request, **kwargs):
+        with resolver.lock:
+            resolver.requests += 1
+        return super().send(request, **kwargs)
 
     def get_redirect_target(self, resp):
         # Override to run each redirect target through the malicious
@@ -37,35 +205,152 @@ class HttpSession(requests.sessions.Session):
         if self.is_malicious_host(url_obj.hostname):
             raise ValueError("{} is not a valid hostname.".format(url_obj.hostname))
 
-    def fetch_url(self, url, stream=False):
+    def fetch_url(self, url, stream=False, headers=None):
         self.check_host(url)
-        return self.get(url, stream=stream, allow_redirects=True)
+        return self.get(url, stream=stream, allow_redirects=True, headers=headers)
 
-    def pull(self, url, sink):
-        with self.fetch_url(url, stream=True) as response:
-            assert response.status_code == 200
-            with open(sink, "wb") as file:
-                for chunk in response:
-                    file.write(chunk)
+    def fetch_revision(self, url: str) -> Optional[str]:
+        """
+        Get a token identifying the current revision of a resource.
+
+        Makes a `HEAD` request and uses the `ETag`, or `Last-Modified`, header
+        along with the final URL (after any redirects e.g. to a versioned URL).
+        Returns `None` if the server does not provide either header.
+        """
+        self.check_host(url)
+        response = self.head(url, allow_redirects=True)
+        if response.status_code != 200:
+            return None
+        tag = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        if not tag:
+            return None
+        return f"{response.url} {tag}"
+
+    def pull(self, url, sink, retries: int = HTTP_PULL_RETRIES):
+        """
+        Download a file to `sink`.
+
+        If the download is interrupted it is resumed, using a `Range` request, up
+        to `retries` times. If the server does not support ranges, or the file has
+        changed in the meantime, the download is restarted. The content is requested
+        without any encoding (e.g. gzip) so that the size of a partial download
+        is the offset in the resource to resume from. Raises a `requests.HTTPError`
+        if the file can not be fetched.
+        """
+        offset = 0
+        validator = None
+        attempt = 0
+        while True:
+            headers = {"Accept-Encoding": "identity"}
+            if offset and validator:
+                headers.update({"Range": f"bytes={offset}-", "If-Range": validator})
+            try:
+                with self.fetch_url(url, stream=True, headers=headers) as response:
+                    if response.status_code == 206 and offset:
+                        if content_range_start(response.headers) != offset:
+                            # Not resumed from the end of the partial download
+                            # so start again
+                            offset, validator = 0, None
+                            continue
+                        mode = "ab"
+                    elif response.status_code == 200:
+                        mode, offset = "wb", 0
+                    elif "Range" in headers:
+                        # The range request failed (e.g. a `416` because the
+                        # download was interrupted after the last chunk) so start again
+                        offset, validator = 0, None
+                        continue
+                    else:
+                        response.raise_for_status()
+                        raise requests.HTTPError(
+                            f"Unexpected status when fetching {url}: "
+                            f"{response.status_code}",
+                            response=response,
+                        )
+                    validator = resume_validator(response.headers) or validator
+                    with open(sink, mode) as file:
+                        for chunk in response.iter_content(HTTP_CHUNK_SIZE):
+                            file.write(chunk)
+                            offset += len(chunk)
+                logger.debug(f"HTTP session metrics: {resolver.metrics()}")
+                return
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as exc:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.warning(f"Resuming interrupted download of {url}: {exc}")
 
     @classmethod
     def is_malicious_host(cls, hostname):
         """Detect if user is trying to do things like connect to localhost
         or a local IP address of some kind.
         """
-        if not hostname:
+        try:
+            resolver.resolve(hostname or "")
+        except ValueError:
             return True
+        return False
 
-        if hostname.lower() in ["hub-test.stenci.la", "hub.stenci.la"]:
-            return True
 
-        try:
-            ipaddress.ip_address(hostname)
-        except ValueError:
-            pass
-        else:
-            return True  # Trying to access a site by IP
+session: Optional[HttpSession] = None
 
-        address = gethostbyname(hostname)
-        ip = ipaddress.ip_address(address)
-        return ip.is_loopback or ip.is_private
+
+def get_http_session() -> HttpSession:
+    """
+    Get the HTTP session shared by jobs in this worker process.
+
+    Like `get_http_client`, but for code that needs the checks
+    on hosts done by `HttpSession`.
+    """
+    global session
+    if session is None:
+        session = HttpSession()
+        atexit.register(session.close)
+    return session
+
+
+def resume_validator(headers) -> Optional[str]:
+    """
+    Get the validator to use in an `If-Range` header when resuming a download.
+
+    Weak ETags can not be used for ranges so the `Last-Modified` header
+    is used instead (if any).
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def content_range_start(headers) -> Optional[int]:
+    """
+    Get the start of the range of bytes in a partial content (206) response.
+    """
+    match = re.match(r"bytes (\d+)-", headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+client: Optional[httpx.Client] = None
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Get the HTTP client shared by jobs in this worker process.
+
+    Reusing a client, rather than creating one for each request, allows
+    connections to be pooled and kept alive between jobs. The client is created
+    lazily so that each forked Celery worker process gets its own.
+    """
+    global client
+    if client is None:
+        client = httpx.Client(
+            timeout=HTTP_CLIENT_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=HTTP_CLIENT_KEEPALIVE),
+            headers={"User-Agent": "Stencila Hub HTTP Client"},
+        )
+        atexit.register(client.close)
+    return client
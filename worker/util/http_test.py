@@ -1,6 +1,12 @@
+import io
+import time
+from typing import Optional
+from unittest import mock
+
 import pytest
+import requests
 
-from .http import HttpSession
+from .http import HostResolver, HttpSession, PinnedHTTPSConnection
 
 
 def test_malicious_host(tempdir):
@@ -15,3 +21,136 @@ def test_malicious_host(tempdir):
     with pytest.raises(ValueError) as excinfo:
         HttpSession().fetch_url("https://localhost/abc")
     assert "localhost is not a valid hostname" in str(excinfo.value)
+
+
+class InterruptedAdapter(requests.adapters.BaseAdapter):
+    """
+    A transport adapter which interrupts the first response part way through.
+    """
+
+    def __init__(self, content: bytes, split: int, start: Optional[int] = None):
+        super().__init__()
+        self.content = content
+        self.split = split
+        self.start = split if start is None else start
+        self.requests: list = []
+
+    def send(self, request, **kwargs):
+        split = self.split
+        self.requests.append(request)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.headers["ETag"] = '"1"'
+        if len(self.requests) == 1:
+            response.status_code = 200
+            response.raw = io.BytesIO(self.content[:split])
+            read = response.raw.read
+
+            def interrupt(amount=None, **kwargs):
+                data = read(amount)
+                if not data:
+                    raise requests.exceptions.ChunkedEncodingError("Connection reset")
+                return data
+
+            response.raw.read = interrupt
+        elif "Range" not in request.headers:
+            response.status_code = 200
+            response.raw = io.BytesIO(self.content)
+        else:
+            response.status_code = 206
+            start = self.start
+            response.headers["Content-Range"] = f"bytes {start}-"
+            response.raw = io.BytesIO(self.content[start:])
+        return response
+
+    def close(self):
+        pass
+
+
+def test_pull_resume(tmp_path):
+    content = b"0123456789"
+    adapter = InterruptedAdapter(content, 4)
+    session = HttpSession()
+    session.mount("https://", adapter)
+    sink = tmp_path / "file"
+
+    with mock.patch.object(session, "check_host"):
+        session.pull("https://example.org/file", sink)
+
+    assert sink.read_bytes() == content
+    assert len(adapter.requests) == 2
+    assert adapter.requests[1].headers["Range"] == "bytes=4-"
+    assert adapter.requests[1].headers["If-Range"] == '"1"'
+    assert adapter.requests[1].headers["Accept-Encoding"] == "identity"
+
+
+def test_pull_resume_mismatched_range(tmp_path):
+    content = b"0123456789"
+    adapter = InterruptedAdapter(content, 4, start=2)
+    session = HttpSession()
+    session.mount("https://", adapter)
+    sink = tmp_path / "file"
+
+    with mock.patch.object(session, "check_host"):
+        session.pull("https://example.org/file", sink)
+
+    # Restarted without a range
+    assert sink.read_bytes() == content
+    assert len(adapter.requests) == 3
+    assert "Range" not in adapter.requests[2].headers
+
+
+def test_pull_error(tmp_path):
+    adapter = mock.Mock(requests=[])
+
+    def send(request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = 404
+        response.raw = io.BytesIO(b"")
+        return response
+
+    adapter.send.side_effect = send
+    session = HttpSession()
+    session.mount("https://", adapter)
+
+    with mock.patch.object(session, "check_host"), pytest.raises(
+        requests.HTTPError, match="404"
+    ):
+        session.pull("https://example.org/file", tmp_path / "file")
+    assert not (tmp_path / "file").exists()
+
+
+def test_resolver_cache():
+    resolver = HostResolver(ttl=60)
+    with mock.patch("util.http.gethostbyname", return_value="93.184.216.34") as lookup:
+        assert resolver.resolve("example.org") == "93.184.216.34"
+        assert resolver.resolve("Example.org.") == "93.184.216.34"
+        assert lookup.call_count == 1
+
+        metrics = resolver.metrics()
+        assert metrics["dns_lookups"] == 1
+        assert metrics["dns_hits"] == 1
+
+        # After the TTL, the host is looked up, and validated, again
+        with mock.patch("util.http.time.monotonic", return_value=time.monotonic() + 61):
+            lookup.return_value = "127.0.0.1"
+            with pytest.raises(ValueError, match="example.org is not a valid hostname"):
+                resolver.resolve("example.org")
+
+
+def test_pinned_connection():
+    """
+    Connections are made to the validated address, not by resolving the host again.
+    """
+    with mock.patch(
+        "util.http.gethostbyname", return_value="93.184.216.34"
+    ), mock.patch("urllib3.util.connection.create_connection") as create_connection:
+        connection = PinnedHTTPSConnection("pinned.example.org", 443)
+        connection._new_conn()
+
+    address = create_connection.call_args[0][0]
+    assert address == ("93.184.216.34", 443)
+    assert connection.host == "pinned.example.org"
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from config import get_manifests_root
+
+logger = logging.getLogger(__name__)
+
+# Files modified within this many nanoseconds of the manifest being
+# created are not trusted (their modification time may not change if
+# they are modified again within the granularity of the filesystem's timestamps).
+RACY_NANOSECONDS = 2 * 1000 ** 3
+
+# Checksums, other than the SHA256 fingerprint, that may be recorded for a file
+# (e.g. the CRC-32 of files extracted from a zip archive, or the MD5 of files
+# downloaded from Google Drive) and used to check if it differs from its source
+CHECKSUMS = ("crc", "md5")
+
+
+class Manifest:
+    """
+    A persistent record of information on the files in a directory.
+
+    Maps the path of each file (relative to the directory) to its size,
+    modification time, inode, fingerprint and mimetype (and, for files extracted
+    from a zip archive or downloaded from Google Drive, their CRC-32 or MD5; see
+    `CHECKSUMS`). If the size, modification
+    time and inode of a file have not changed since it was last recorded then its
+    fingerprint and mimetype are reused rather than being generated again.
+
+    Use `Manifest.load` to get the manifest for a directory, `Manifest.save`
+    to persist it for the next job that operates on the directory. Instances
+    can be used from several threads (e.g. by `list_files`).
+    """
+
+    version = 1
+
+    def __init__(self, directory: str, path: Optional[str] = None):
+        self.directory = directory
+        self.prefix = os.path.join(directory, "")
+        self.path = path
+        self.time = time.time_ns()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.previous: Dict[str, Dict[str, Any]] = {}
+        self.previous_time = 0
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory: str = ".", root: Optional[str] = None) -> "Manifest":
+        """
+        Load the manifest for a directory.
+
+        Manifests are stored under `root` (defaulting to the configured
+        manifests root) with a file name derived from the real path of the
+        directory. If there is no existing manifest, or it can not be read,
+        then an empty one is returned.
+        """
+        real = os.path.realpath(directory)
+        name = hashlib.sha256(real.encode()).hexdigest() + ".json"
+        path = os.path.join(root or get_manifests_root(), name)
+        manifest = cls(directory, path)
+
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return manifest
+        except Exception as exc:
+            logger.warning(f"Unable to read manifest {path}: {exc}")
+            return manifest
+
+        if data.get("version") == cls.version and data.get("directory") == real:
+            manifest.previous = data.get("files", {})
+            manifest.previous_time = data.get("time", 0)
+        return manifest
+
+    def key(self, path: str) -> str:
+        """
+        Get the key for a file path i.e. the path relative to the directory.
+        """
+        prefix = len(self.prefix)
+        if path[:prefix] == self.prefix:
+            return path[prefix:]
+        return os.path.relpath(path, self.directory)
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[Dict[str, Any]]:
+        """
+        Get the recorded information for a file if it has not changed.
+
+        Returns `None` if there is no entry for the file, or if the file's size,
+        modification time or inode differ from those recorded.
+        """
+        entry = self.previous.get(self.key(path))
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+            or entry["inode"] != stat.st_ino
+            or stat.st_mtime_ns >= self.previous_time - RACY_NANOSECONDS
+        ):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def set(self, path: str, stat: os.stat_result, info: Dict[str, Any]) -> None:
+        """
+        Record the information for a file.
+
+        If `info` has no checksum (e.g. `crc`), then any previously recorded
+        checksum for the file is kept (if the file has not changed).
+        """
+        key = self.key(path)
+        entry = dict(
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            inode=stat.st_ino,
+            fingerprint=info["fingerprint"],
+            mimetype=info["mimetype"],
+            encoding=info["encoding"],
+        )
+
+        previous = self.previous.get(key)
+        unchanged = (
+            previous
+            and previous.get("fingerprint") == entry["fingerprint"]
+            and previous["size"] == entry["size"]
+        )
+        for name in CHECKSUMS:
+            checksum = info.get(name)
+            if checksum is None and unchanged:
+                checksum = previous.get(name)  # type: ignore
+            if checksum is not None:
+                entry[name] = checksum
+
+        self.entries[key] = entry
+
+    def save(self, merge: bool = False) -> None:
+        """
+        Save the manifest.
+
+        Only the files recorded (using `set`) since the manifest was loaded are
+        saved so that entries for files that have since been removed are dropped.
+        Use `merge` to also keep the previous entries (e.g. when only some of the
+        files in the directory were recorded).
+        If nothing has changed, the manifest is not written. Otherwise, it is
+        written to a temporary file and then moved into place so that concurrent
+        readers never see a partially written manifest.
+        """
+        if not self.path:
+            return
+
+        logger.debug(
+            f"Manifest for {self.directory}: {self.hits} hits, {self.misses} misses, "
+            f"{self.mismatches} mismatches"
+        )
+
+        if merge:
+            # Previous entries that would not be trusted (see `get`) are dropped
+            # because they would be trusted given the time of this manifest
+            entries = dict(
+                (key, entry)
+                for key, entry in self.previous.items()
+                if entry["mtime"] < self.previous_time - RACY_NANOSECONDS
+            )
+            entries.update(self.entries)
+        else:
+            entries = self.entries
+        if (
+            self.misses == 0
+            and self.mismatches == 0
+            and entries.keys() == self.previous.keys()
+        ):
+            return
+
+        data = dict(
+            version=self.version,
+            directory=os.path.realpath(self.directory),
+            time=self.time,
+            files=entries,
+        )
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=dirname, suffix=".tmp", delete=False
+        ) as file:
+            file.write(json.dumps(data, separators=(",", ":")))
+        os.replace(file.name, self.path)